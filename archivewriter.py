@@ -0,0 +1,137 @@
+# Python 3
+
+""" Writing an extracted tree as a tar or zip stream
+
+ Entries are written one after another without seeking back, so the output
+ can be a pipe or the standard output. Nothing is created on disk besides
+ the output file itself.
+"""
+
+import io
+import sys
+import tarfile
+import time
+import zipfile
+
+import errors
+
+
+class TarBody(object):
+    """ Writes the body of a tar member straight to the stream, counting it """
+
+    def __init__(self, fileobj, path, size):
+        self.fileobj = fileobj
+        self.path = path
+        self.size = size
+        self.written = 0
+
+    def write(self, data):
+        self.written += len(data)
+        if self.written > self.size:
+            raise errors.FormatError("%s is longer than its %d bytes" % (
+                self.path, self.size))
+        self.fileobj.write(data)
+        return len(data)
+
+
+class TarWriter(object):
+    """ Writes a tar stream. Files of unknown size are buffered to know it
+     before the header
+    """
+
+    def __init__(self, file, closeFile=False):
+        self.file = file
+        self.closeFile = closeFile
+        self.tar = tarfile.open(fileobj=file, mode='w|', format=tarfile.PAX_FORMAT)
+        self.mtime = int(time.time())
+
+    def addDir(self, path):
+        info = tarfile.TarInfo(path)
+        info.type = tarfile.DIRTYPE
+        info.mode = 0o755
+        info.mtime = self.mtime
+        self.tar.addfile(info)
+
+    def addFile(self, path, writer, size=None):
+        """ Adds a file with what writer(file) writes
+
+         With size, the header is written first and the content is streamed
+         after it, which must then be size bytes. Without it, the content is
+         buffered.
+        """
+        info = tarfile.TarInfo(path)
+        info.mode = 0o644
+        info.mtime = self.mtime
+        if size is None:
+            buffer = io.BytesIO()
+            writer(buffer)
+            info.size = buffer.tell()
+            buffer.seek(0)
+            self.tar.addfile(info, buffer)
+            return
+
+        # As TarFile.addfile, with the body pushed by writer instead of read
+        info.size = size
+        tar = self.tar
+        header = info.tobuf(tar.format, tar.encoding, tar.errors)
+        tar.fileobj.write(header)
+        body = TarBody(tar.fileobj, path, size)
+        writer(body)
+        if body.written != size:
+            raise errors.FormatError("%s is %d bytes, not %d" % (
+                path, body.written, size))
+        blocks, remainder = divmod(size, tarfile.BLOCKSIZE)
+        if remainder > 0:
+            tar.fileobj.write(tarfile.NUL * (tarfile.BLOCKSIZE - remainder))
+            blocks += 1
+        tar.offset += len(header) + blocks * tarfile.BLOCKSIZE
+        tar.members.append(info)
+
+    def close(self):
+        self.tar.close()
+        if self.closeFile:
+            self.file.close()
+
+
+class ZipWriter(object):
+    """ Writes an uncompressed zip, streaming each file as it is written """
+
+    def __init__(self, file, closeFile=False):
+        self.file = file
+        self.closeFile = closeFile
+        self.zip = zipfile.ZipFile(file, 'w', zipfile.ZIP_STORED)
+        self.dateTime = time.localtime()[0:6]
+
+    def addDir(self, path):
+        info = zipfile.ZipInfo(path + '/', self.dateTime)
+        info.external_attr = (0o40755 << 16) | 0x10  # directory
+        self.zip.writestr(info, b'')
+
+    def addFile(self, path, writer, size=None):
+        """ Adds a file with what writer(file) writes
+
+         Without size, the entry has Zip64 sizes, as it may pass 2 GiB.
+        """
+        info = zipfile.ZipInfo(path, self.dateTime)
+        info.external_attr = 0o644 << 16
+        if size is not None:
+            info.file_size = size
+        with self.zip.open(info, 'w', force_zip64=size is None) as file:
+            writer(file)
+
+    def close(self):
+        self.zip.close()
+        if self.closeFile:
+            self.file.close()
+
+
+def openWriter(path, format):
+    """ Opens a TarWriter or ZipWriter on path, or on the standard output if it is "-"
+
+     format is "tar" or "zip". Closing the writer closes the file, except for
+     the standard output.
+    """
+    writerClass = TarWriter if format == "tar" else ZipWriter
+    if path == "-":
+        return writerClass(sys.stdout.buffer)
+    return writerClass(open(path, 'wb'), closeFile=True)
@@ -0,0 +1,221 @@
+#!/usr/bin/env python3
+
+import io
+import json
+import os
+import random
+import statistics
+import struct
+import sys
+import tempfile
+import time
+
+import difi
+import key_engine
+import savearchive
+import savefilesystem
+import savegen
+
+
+class BenchmarkSecrets(object):
+    """ Arbitrary keys. Generated files are signed and encrypted with the same """
+    keyConst = 0x0F1E2D3C4B5A69788796A5B4C3D2E1F0
+    key0x30X = 0x00112233445566778899AABBCCDDEEFF
+    key0x34X = 0xFFEEDDCCBBAA99887766554433221100
+    keyMovable = 0x0123456789ABCDEF0123456789ABCDEF
+
+
+def timeStage(function, repeat):
+    """ Runs function repeat times. Returns the times in seconds """
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+    return times
+
+
+def runBenchmark(workDir, sizeMB, fileCount, maxRun, repeat, workers):
+    """ Generates an encrypted SD save and times each stage of reading it
+
+     Returns a list of (stage name, bytes processed, times).
+    """
+    keyEngine = key_engine.KeyEngine(BenchmarkSecrets())
+    saveType, saveId = "sd", 0x0004000000164800
+    savePath = os.path.join(workDir, "bench.sav")
+    maxFileSize = sizeMB * 2 * 1024 * 1024 // max(fileCount, 1)
+    savegen.generateSave(savePath, random.Random(0), saveType, saveId, keyEngine,
+                         encrypt=True, dirCount=fileCount // 10,
+                         fileCount=fileCount, maxFileSize=maxFileSize,
+                         hasData=True, blockSize=0x1000, maxRun=maxRun)
+    sdPath = savearchive.getSdPath(saveType, saveId)
+    key = keyEngine.getKeySdDecrypt()
+
+    results = []
+
+    def stage(name, size, function):
+        results.append((name, size, timeStage(function, repeat)))
+
+    # CTR decrypt
+    with open(savePath, 'rb') as file:
+        ciphertext = file.read()
+    state = {}
+
+    def decrypt():
+        import sd_decrypt
+        state["plain"] = sd_decrypt.SdFile(io.BytesIO(ciphertext), sdPath, key,
+                                           workers).read()
+    stage("decrypt", len(ciphertext), decrypt)
+
+    disaHeader = savearchive.readDisaHeader(
+        io.BytesIO(state["plain"]), saveType, saveId, keyEngine)
+    partTable = disaHeader.partTable
+    image = memoryview(state["plain"])
+    partitions = []
+    for descriptorOff, descriptorSize, partOff, partSize in (
+            (disaHeader.partADiscriptorOff, disaHeader.partADiscriptorSize,
+             disaHeader.partAOff, disaHeader.partASize),
+            (disaHeader.partBDiscriptorOff, disaHeader.partBDiscriptorSize,
+             disaHeader.partBOff, disaHeader.partBSize)):
+        discriptor = difi.PartDiscriptor(
+            partTable[descriptorOff: descriptorOff + descriptorSize])
+        partitions.append((discriptor, image[partOff: partOff + partSize]))
+
+    # DPFS
+    def unwrapDPFS():
+        state["active"] = [difi.unwrapDPFS(part, discriptor)
+                           for discriptor, part in partitions]
+    stage("dpfs", sum(discriptor.DPFSL3Size for discriptor, _ in partitions),
+          unwrapDPFS)
+
+    # IVFC
+    def unwrapIVFC():
+        inner = []
+        for (discriptor, part), active in zip(partitions, state["active"]):
+            l4 = None
+            if discriptor.externalIVFCL4:
+                l4 = part[discriptor.IVFCL4OffExt:
+                          discriptor.IVFCL4OffExt + discriptor.IVFCL4Size]
+            inner.append(difi.unwrapIVFC(active, discriptor, l4, False, workers))
+        state["inner"] = inner
+    stage("ivfc", sum(discriptor.IVFCL4Size for discriptor, _ in partitions),
+          unwrapIVFC)
+
+    saveImage, dataImage = state["inner"]
+    filesystemHeaderOff = struct.unpack('<IIQ', saveImage[0:0x10])[2]
+    archive = savearchive.SaveArchive(saveImage, filesystemHeaderOff, dataImage)
+    fsHeader = archive.fsHeader
+
+    # FAT load
+    stage("fat", (fsHeader.fatSize + 1) * 8,
+          lambda: savefilesystem.FAT(fsHeader, saveImage))
+
+    # Table parse
+    def parseTables():
+        savefilesystem.getHashTable(fsHeader.dirHashTableOff,
+                                    fsHeader.dirHashTableSize, saveImage)
+        savefilesystem.getHashTable(fsHeader.fileHashTableOff,
+                                    fsHeader.fileHashTableSize, saveImage)
+        savefilesystem.getDirList(fsHeader, saveImage, archive.dataRegion, archive.fat)
+        savefilesystem.getFileList(fsHeader, saveImage, archive.dataRegion, archive.fat)
+    stage("tables", (len(archive.dirList) * 0x28 + len(archive.fileList) * 0x30),
+          parseTables)
+
+    # Extraction
+    totalSize = sum(entry.size for entry in archive.fileList[1:] if not entry.isDummy)
+    outputDir = os.path.join(workDir, "output")
+    os.makedirs(outputDir, exist_ok=True)
+    stage("extract", totalSize, lambda: archive.extractAll(outputDir))
+
+    # Everything together, the way disa-extract.py reads a save
+    def openAndExtract():
+        savearchive.open_disa(savePath, saveType, saveId, True, keyEngine,
+                              lazy=False, workers=workers).extractAll(outputDir)
+    stage("total", len(ciphertext), openAndExtract)
+
+    return results
+
+
+def main():
+    sizeMB = 16
+    fileCount = 200
+    maxRun = 8
+    repeat = 5
+    workers = os.cpu_count() or 1
+    savePath = None
+    comparePath = None
+    tolerance = 20
+
+    i = 1
+    while i < len(sys.argv):
+        if sys.argv[i] == "-size":
+            i += 1
+            sizeMB = int(sys.argv[i])
+        elif sys.argv[i] == "-files":
+            i += 1
+            fileCount = int(sys.argv[i])
+        elif sys.argv[i] == "-maxrun":
+            i += 1
+            maxRun = int(sys.argv[i])
+        elif sys.argv[i] == "-repeat":
+            i += 1
+            repeat = int(sys.argv[i])
+        elif sys.argv[i] == "-threads":
+            i += 1
+            workers = int(sys.argv[i])
+        elif sys.argv[i] == "-save":
+            i += 1
+            savePath = sys.argv[i]
+        elif sys.argv[i] == "-compare":
+            i += 1
+            comparePath = sys.argv[i]
+        elif sys.argv[i] == "-tolerance":
+            i += 1
+            tolerance = int(sys.argv[i])
+        else:
+            print("Usage: %s [OPTIONS]" % sys.argv[0])
+            print("")
+            print("Generates a synthetic encrypted SD save and times each stage of reading it.")
+            print("Options")
+            print("  -size MB         Approximate size of the file contents. Defaults to 16")
+            print("  -files N         Number of files. Defaults to 200")
+            print("  -maxrun N        Longest run of contiguous blocks in the FAT. Defaults to 8")
+            print("  -repeat N        Runs of each stage. Defaults to 5")
+            print("  -threads N       Number of threads. Defaults to the number of CPUs")
+            print("  -save FILE       Save the results as JSON")
+            print("  -compare FILE    Compare with saved results, and fail if any stage is slower")
+            print("  -tolerance PCT   Allowed slowdown for -compare. Defaults to 20")
+            exit(1)
+        i += 1
+
+    with tempfile.TemporaryDirectory() as workDir:
+        results = runBenchmark(workDir, sizeMB, fileCount, maxRun, repeat, workers)
+
+    print("%-10s %12s %12s %12s" % ("stage", "min ms", "median ms", "MB/s"))
+    summary = {}
+    for name, size, times in results:
+        best = min(times)
+        summary[name] = best
+        print("%-10s %12.2f %12.2f %12.1f" % (
+            name, best * 1000, statistics.median(times) * 1000,
+            size / best / 1024 / 1024 if best > 0 else 0))
+
+    if savePath is not None:
+        with open(savePath, 'w') as file:
+            json.dump(summary, file, indent=1)
+
+    if comparePath is not None:
+        with open(comparePath, 'r') as file:
+            baseline = json.load(file)
+        slower = False
+        for name, best in summary.items():
+            if name in baseline and best > baseline[name] * (1 + tolerance / 100):
+                print("Regression: %s took %.2f ms, was %.2f ms" % (
+                    name, best * 1000, baseline[name] * 1000))
+                slower = True
+        if slower:
+            exit(2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,147 @@
+# Python 3
+
+""" A content-addressed store for extracted files
+
+ Each distinct file content is stored once, named by its SHA-256, in
+ <storeDir>/<first two hex digits>/<hex digest>. Content is hashed while it
+ is written, and a blob that is already in the store isn't written again, so
+ extracting a backup whose files mostly didn't change costs little I/O.
+
+ Extracted paths are either hard links to the blobs or, with hardlink set
+ to False, only entries of the manifest. Blobs are made read-only because
+ every link shares them.
+"""
+
+import hashlib
+import io
+import json
+import os
+import os.path
+import shutil
+import tempfile
+import threading
+
+
+class BlobWriter(object):
+    """ A write-only file that hashes what is written
+
+     Content is kept in memory and only spilled to a temporary file in the
+     store when it grows over spillSize.
+    """
+
+    def __init__(self, store, spillSize=16 << 20):
+        self.store = store
+        self.spillSize = spillSize
+        self.hash = hashlib.sha256()
+        self.buffer = io.BytesIO()
+        self.file = None
+        self.tempPath = None
+        self.size = 0
+
+    def write(self, data):
+        self.hash.update(data)
+        self.size += len(data)
+        if self.file is None:
+            self.buffer.write(data)
+            if self.buffer.tell() > self.spillSize:
+                fd, self.tempPath = tempfile.mkstemp(dir=self.store.storeDir,
+                                                     suffix='.tmp')
+                self.file = os.fdopen(fd, 'wb')
+                self.file.write(self.buffer.getbuffer())
+                self.buffer = None
+        else:
+            self.file.write(data)
+        return len(data)
+
+    def commit(self):
+        """ Adds the content to the store unless it is there. Returns its digest """
+        digest = self.hash.hexdigest()
+        path = self.store.getPath(digest)
+        if self.file is not None:
+            self.file.close()
+        if os.path.exists(path):
+            self.discard()
+            return digest
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        if self.file is None:
+            self.store.writeFile(path, self.buffer.getbuffer())
+        else:
+            os.chmod(self.tempPath, 0o444)
+            os.replace(self.tempPath, path)
+            self.tempPath = None
+        self.store.addWritten(self.size)
+        return digest
+
+    def discard(self):
+        if self.file is not None:
+            self.file.close()
+        if self.tempPath is not None:
+            os.unlink(self.tempPath)
+            self.tempPath = None
+
+
+class BlobStore(object):
+    """ A store directory of blobs named by the SHA-256 of their content """
+
+    def __init__(self, storeDir, hardlink=True):
+        self.storeDir = storeDir
+        self.hardlink = hardlink
+        self.manifest = {}
+        self.bytesWritten = 0
+        self.lock = threading.Lock()
+        os.makedirs(storeDir, exist_ok=True)
+
+    def getPath(self, digest):
+        return os.path.join(self.storeDir, digest[0:2], digest)
+
+    def writeFile(self, path, data):
+        # Writes to a temporary file first so readers never see a partial blob
+        fd, tempPath = tempfile.mkstemp(dir=self.storeDir, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as file:
+                file.write(data)
+            os.chmod(tempPath, 0o444)
+            os.replace(tempPath, path)
+        except BaseException:
+            os.unlink(tempPath)
+            raise
+
+    def addWritten(self, size):
+        with self.lock:
+            self.bytesWritten += size
+
+    def save(self, path, writer):
+        """ Stores what writer(file) writes, and links path to it. Returns the digest
+
+         path can be None to only store the content.
+        """
+        blob = BlobWriter(self)
+        try:
+            writer(blob)
+        except BaseException:
+            blob.discard()
+            raise
+        digest = blob.commit()
+        if path is not None:
+            with self.lock:
+                self.manifest[path] = digest
+            if self.hardlink:
+                self.link(digest, path)
+        return digest
+
+    def link(self, digest, path):
+        if os.path.lexists(path):
+            os.unlink(path)
+        try:
+            os.link(self.getPath(digest), path)
+        except OSError:
+            # Another filesystem, or one without hard links
+            shutil.copyfile(self.getPath(digest), path)
+
+    def writeManifest(self, manifestPath, root):
+        """ Writes {path relative to root: digest} as JSON """
+        with self.lock:
+            manifest = {os.path.relpath(path, root).replace(os.sep, '/'): digest
+                        for path, digest in self.manifest.items()}
+        with open(manifestPath, 'w') as file:
+            json.dump(manifest, file, indent=1, sort_keys=True)
@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+
+import json
+import os
+import sys
+
+import key_engine
+import savescan
+
+try:
+    from secrets import Secrets
+except:
+    class Secrets(object):
+        pass
+
+
+def main():
+    if len(sys.argv) < 2:
+        print("Usage: %s input [output] [OPTIONS]" % sys.argv[0])
+        print("")
+        print("Arguments:")
+        print("  input            A SD or NAND dump directory, such as")
+        print("                   Nintendo 3DS/<id0>/<id1> or the NAND root")
+        print("  output           The directory for storing extracted files")
+        print("")
+        print("Save types and IDs are worked out from the directory layout.")
+        print("You need to provide secrets.py for CMAC verification and decryption.")
+        print("Options")
+        print("  -report FILE     Write the JSON report to FILE instead of the standard output")
+        print("  -triage          Only check the CMAC and the partition table hash of each file")
+        print("  -processes N     Number of worker processes. Defaults to the number of CPUs")
+        print("  -store DIR       Store each distinct file content once in DIR, named by its")
+        print("                   SHA-256, and hard link the extracted files to it")
+        exit(1)
+
+    inputPath = None
+    outputPath = None
+    reportPath = None
+    triage = False
+    storeDir = None
+    processes = os.cpu_count() or 1
+
+    i = 1
+    while i < len(sys.argv):
+        if sys.argv[i] == "-report":
+            i += 1
+            reportPath = sys.argv[i]
+        elif sys.argv[i] == "-triage":
+            triage = True
+        elif sys.argv[i] == "-store":
+            i += 1
+            storeDir = sys.argv[i]
+        elif sys.argv[i] == "-processes":
+            i += 1
+            processes = int(sys.argv[i])
+        else:
+            if inputPath is None:
+                inputPath = sys.argv[i]
+            else:
+                outputPath = sys.argv[i]
+        i += 1
+
+    if inputPath is None or not os.path.isdir(inputPath):
+        print("Error: no input directory given.")
+        exit(1)
+
+    # Keys are derived once here and sent to the workers
+    keys = key_engine.DerivedKeys(key_engine.KeyEngine(Secrets()))
+
+    reports = savescan.scan(inputPath, keys, outputPath, processes, triage,
+                            storeDir)
+
+    if reportPath is None:
+        json.dump(reports, sys.stdout, indent=1)
+        print("")
+    else:
+        with open(reportPath, 'w') as file:
+            json.dump(reports, file, indent=1)
+
+    if any(report["status"] != "ok" for report in reports):
+        exit(2)
+
+
+if __name__ == "__main__":
+    main()
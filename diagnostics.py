@@ -0,0 +1,106 @@
+""" Warnings and information reported while reading a save
+
+ Library modules never print. They report here instead, and the messages go
+ to handler, which is called with a level ("Info", "Warning" or "Error") and
+ a message. The default handler drops everything.
+
+ Messages are given as a format string and its arguments, and are only
+ formatted when they reach the handler. Messages below minLevel are dropped.
+ With repeatLimit set, each format string is passed on at most that many
+ times and further ones are only counted; flushRepeats() then reports how
+ many were held back, so a corrupted FAT gives one line per kind of problem
+ instead of one line per block.
+"""
+
+import collections
+import json
+import sys
+import threading
+
+
+levels = {"Info": 0, "Warning": 1, "Error": 2}
+
+handler = None
+minLevel = "Info"
+repeatLimit = None
+
+counts = collections.Counter()
+countsLock = threading.Lock()
+
+
+def report(level, message, args):
+    with countsLock:
+        counts[level, message] += 1
+        count = counts[level, message]
+    if handler is None or levels[level] < levels[minLevel]:
+        return
+    if repeatLimit is not None and count > repeatLimit:
+        return
+    handler(level, message % args if args else message)
+
+
+def info(message, *args):
+    report("Info", message, args)
+
+
+def warning(message, *args):
+    report("Warning", message, args)
+
+
+def error(message, *args):
+    report("Error", message, args)
+
+
+def getCounts(level=None):
+    """ Returns a dict from format string to the number of times it was reported """
+    with countsLock:
+        return {message: count for (messageLevel, message), count in counts.items()
+                if level is None or messageLevel == level}
+
+
+def resetCounts():
+    """ Clears the counts and returns what they were """
+    with countsLock:
+        items = sorted(counts.items())
+        counts.clear()
+    return items
+
+
+def flushRepeats():
+    """ Reports how many messages over repeatLimit were held back, and resets counts """
+    items = resetCounts()
+    if handler is None or repeatLimit is None:
+        return
+    for (level, message), count in items:
+        if count > repeatLimit and levels[level] >= levels[minLevel]:
+            handler(level, "%d more like: %s" % (count - repeatLimit, message))
+
+
+def configure(quiet=False, jsonLines=False):
+    """ Sets up the handler for the command line tools
+
+     quiet only shows warnings and errors, and shows at most 10 of each kind.
+     jsonLines writes each message as a JSON object on its own line.
+    """
+    global handler, minLevel, repeatLimit
+    handler = JsonLinesHandler(sys.stdout) if jsonLines else printHandler
+    minLevel = "Warning" if quiet else "Info"
+    repeatLimit = 10 if quiet else None
+
+
+def printHandler(level, message):
+    """ Prints messages the way the command line tools always did """
+    print("%s: %s" % (level, message))
+
+
+class JsonLinesHandler(object):
+    """ Writes each message as {"level": ..., "message": ...} on its own line """
+
+    def __init__(self, file):
+        self.file = file
+        self.lock = threading.Lock()
+
+    def __call__(self, level, message):
+        line = json.dumps({"level": level, "message": message}) + "\n"
+        with self.lock:
+            self.file.write(line)
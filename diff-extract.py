@@ -1,14 +1,18 @@
 #!/usr/bin/env python3
 
+import atexit
+import json
 import os
-import os.path
-import struct
 import sys
-import hashlib
 
-import difi
-import savefilesystem
+import archivewriter
+import blobstore
+import diagnostics
+import errors
 import key_engine
+import savearchive
+import savefilesystem
+import stats
 
 try:
     from secrets import Secrets
@@ -17,226 +21,76 @@ except:
         pass
 
 
-def cryptoUnwrap(diff, saveType, saveId, saveSubId, key):
-    if saveId is None:
-        print("Error: ID needed to decrypt the save.")
-        return None
-
-    if key is None:
-        print("No enough secrets provided to decrypt.")
-        return None
-
-    if saveType is None:
-        print("Error: save type needed to decrypt the save.")
-        return None
-    elif saveType == "extdata":
-        if saveSubId is None:
-            print("Error: sub ID needed to decrypt the save.")
-            return None
-        high = saveId >> 32
-        low = saveId & 0xFFFFFFFF
-        subHigh = saveSubId >> 32
-        subLow = saveSubId & 0xFFFFFFFF
-        path = "/extdata/%08x/%08x/%08x/%08x" % (high, low, subHigh, subLow)
-    elif saveType == "titledb":
-        if saveId == 2:
-            fileName = "title.db"
-        elif saveId == 3:
-            fileName = "import.db"
-        path = "/dbs/" + fileName
-
-    import sd_decrypt
-    return sd_decrypt.DecryptSdFile(diff, path, key)
-
-
-def unwrapDIFF(filePath, expectedUniqueId=None, saveType=None, saveId=None,
-               saveSubId=None, decrypt=False):
-    diff = open(filePath, 'rb')
-
-    secretsDb = Secrets()
-    keyEngine = key_engine.KeyEngine(secretsDb)
-
-    if decrypt:
-        diff = cryptoUnwrap(diff, saveType, saveId,
-                            saveSubId, keyEngine.getKeySdDecrypt())
-        if diff is None:
-            exit(1)
-
-    key = keyEngine.getKeySdNandCmac()
-
-    Cmac = diff.read(0x10)
-    diff.seek(0x100, os.SEEK_SET)
-    header = diff.read(0x100)
-
-    digestBlock = None
-    if key is None:
-        print("No enough secrets provided. Will skip CMAC verification.")
-    elif saveType is None:
-        print("No save type specified. Will skip CMAC verification.")
-    elif saveId is None:
-        print("No save ID specified. Will skip CMAC verification.")
-    elif saveType == "extdata":
-        if saveSubId is None:
-            saveSubId = 0
-            quotaFlag = 0
-        else:
-            quotaFlag = 1
-        digestBlock = b"CTR-EXT0" + \
-            struct.pack("<QIQ", saveId, quotaFlag, saveSubId) + header
-    elif saveType == "titledb":
-        digestBlock = b"CTR-9DB0" + struct.pack("<I", saveId) + header
-    else:
-        print("Unknown save type. Will skip CMAC verification.")
-
-    if digestBlock is not None:
-        import cmac
-        if Cmac != cmac.AesCmac(hashlib.sha256(digestBlock).digest(), key):
-            print("Error: CMAC mismatch.")
-            exit(1)
-        else:
-            print("Info: CMAC verified.")
-
-    DIFF, ver, \
-        secPartTableOff, priPartTableOff, partTableSize, \
-        partOff, partSize, \
-        activeTable, tableHash, uniqueId, \
-        = struct.unpack('<IIQQQQQI32sQ164x', header)
-
-    if DIFF != 0x46464944:
-        print("Error: Not a DIFF format")
-        exit(1)
-
-    if ver != 0x00030000:
-        print("Error: Wrong DIFF version")
-        exit(1)
+verbose = True
+listJson = False
 
-    if activeTable == 0:
-        partTableOff = priPartTableOff
-    elif activeTable == 1:
-        partTableOff = secPartTableOff
-    else:
-        print("Error: Wrong active table ID %d" % activeTable)
-        exit(1)
 
-    print("Info: Unique ID = %016X" % uniqueId)
-    if expectedUniqueId is not None:
-        if expectedUniqueId != uniqueId:
-            print("Warning: unique ID mismatch")
+def say(message):
+    """ Prints progress and listings, which are left out with -quiet or -json """
+    if verbose:
+        print(message)
 
-    # Verify partition table hash
-    diff.seek(partTableOff, os.SEEK_SET)
-    partTable = diff.read(partTableSize)
-    if hashlib.sha256(partTable).digest() != tableHash:
-        print("Error: Partition table hash mismatch!")
-        exit(1)
 
-    # Reads and unwraps partition
-    diff.seek(partOff, os.SEEK_SET)
-    part = diff.read(partSize)
-    image, externalIVFCL4 = difi.unwrap(partTable, part)
-    if externalIVFCL4:
-        print("Info: external IVFC level 4")
-
-    diff.close()
-    return image
-
-
-def trimBytes(bs):
-    """ Trims trailing zeros in a byte string """
-    n = bs.find(b'\0')
-    if n != -1:
-        return bs[:n]
-    return bs
-
-
-def extractExtdata(extdataDir, outputDir, saveId, decrypt):
-    def extdataFileById(idHigh, idLow):
-        return os.path.join(extdataDir, "%08x" % idHigh, "%08x" % idLow)
-    vsxe = unwrapDIFF(extdataFileById(0, 1), saveType="extdata",
-                      saveId=saveId, saveSubId=1, decrypt=decrypt)
-    # Reads VSXE header
-    VSXE, ver, filesystemHeaderOff, imageSize, imageBlockSize, x00, \
-        unk1, recentAction, unk2, recentId, unk3, recentPath \
-        = struct.unpack('<IIQQIIQIIII256s', vsxe[0:0x138])
-
-    if VSXE != 0x45585356:
-        print("Error: Wrong VSXE magic")
-        exit(1)
+def listEntry(kind, text, record):
+    """ Prints a line of the directory or file list, or with -json writes it
+     as a JSON record """
+    if verbose:
+        print(text)
+    elif listJson:
+        record["entry"] = kind
+        print(json.dumps(record))
 
-    if ver != 0x00030000:
-        print("Error: Wrong VSXE version")
-        exit(1)
 
-    if x00 != 0:
-        print("Warning: unknown 0 = 0x%X in VSXE header" % x00)
+def fail(message):
+    diagnostics.error("%s", message)
+    diagnostics.flushRepeats()
+    exit(1)
 
-    print("Info: unk1 = %d" % unk1)
-    print("Info: recent action = %d" % recentAction)
-    print("Info: unk2 = %d" % unk2)
-    print("Info: recent ID = %d" % recentId)
-    print("Info: unk3 = %d" % unk3)
-    print("Info: recentPath = %s" % trimBytes(recentPath).decode())
 
-    fsHeader = savefilesystem.Header(
-        vsxe[filesystemHeaderOff:filesystemHeaderOff + 0x68], False)
+def extractExtdata(extdataDir, outputDir, saveId, decrypt, keyEngine, workers=1,
+                   store=None, writer=None):
+    archive = savearchive.open_extdata(extdataDir, saveId, decrypt, keyEngine,
+                                       workers)
 
-    dataRegion = vsxe[
-        fsHeader.dataRegionOff: fsHeader.dataRegionOff +
-        fsHeader.dataRegionSize * fsHeader.blockSize]
+    say("Directory list:")
+    if verbose or listJson:
+        for i, entry in enumerate(archive.dirList):
+            listEntry("dir", entry.formatEntry(i), entry.getRecord(i))
 
-    # parse FAT
-    fat = savefilesystem.FAT(fsHeader, vsxe)
-
-    # parse hash tables
-    dirHashTable = savefilesystem.getHashTable(fsHeader.dirHashTableOff,
-                                               fsHeader.dirHashTableSize,
-                                               vsxe)
-
-    fileHashTable = savefilesystem.getHashTable(fsHeader.fileHashTableOff,
-                                                fsHeader.fileHashTableSize,
-                                                vsxe)
-
-    # Parses directory & file entry table
-    dirList = savefilesystem.getDirList(
-        fsHeader, vsxe, dataRegion, fat)
-
-    print("Directory list:")
-    for i in range(len(dirList)):
-        dirList[i].printEntry(i)
-
-    fileList = savefilesystem.getFileList(
-        fsHeader, vsxe, dataRegion, fat)
-
-    print("File list:")
-    for i in range(len(fileList)):
-        fileList[i].printEntryAsExtdata(i)
+    say("File list:")
+    if verbose or listJson:
+        for i, entry in enumerate(archive.fileList):
+            listEntry("file", entry.formatEntryAsExtdata(i), entry.getRecord(i, asExtdata=True))
 
     # Verifies directory & file hash table
-    print("Verifying directory hash table")
-    savefilesystem.verifyHashTable(dirHashTable, dirList)
-    print("Verifying file hash table")
-    savefilesystem.verifyHashTable(fileHashTable, fileList)
+    say("Verifying directory hash table")
+    savefilesystem.verifyHashTable(archive.dirHashTable, archive.dirList)
+    say("Verifying file hash table")
+    savefilesystem.verifyHashTable(archive.fileHashTable, archive.fileList)
 
     # Walks through free blocks
-    print("Walking through free blocks")
-    fat.visitFreeBlock()
+    say("Walking through free blocks")
+    archive.fat.visitFreeBlock()
+
+    archive.fat.allVisited()
 
-    fat.allVisited()
+    archive.extractAll(outputDir, store=store, writer=writer)
 
-    def extFileDumper(fileEntry, file, index):
-        print("Extracting %s" % fileEntry.getName())
-        fileId = index + 1
-        dirCapacity = 126  # ???
-        idHigh = fileId // dirCapacity
-        idLow = fileId % dirCapacity
-        content = unwrapDIFF(extdataFileById(idHigh, idLow), expectedUniqueId=fileEntry.uniqueId,
-                             saveType="extdata", saveId=saveId, saveSubId=(idHigh << 32) | idLow, decrypt=decrypt)
-        if file is not None:
-            file.write(content)
+    diagnostics.flushRepeats()
+    say("Finished!")
 
-    savefilesystem.extractAll(dirList, fileList, outputDir, extFileDumper)
 
-    print("Finished!")
+def extractSingleFile(extdataDir, filePath, outputPath, saveId, decrypt,
+                      keyEngine, workers=1):
+    """ Looks up one file in an extdata and extracts it """
+    archive = savearchive.open_extdata(extdataDir, saveId, decrypt, keyEngine,
+                                       workers)
+    try:
+        archive.extractFile(filePath, outputPath)
+    except (FileNotFoundError, NotADirectoryError, IsADirectoryError):
+        fail("%s is not a file in the extdata." % filePath)
+    diagnostics.flushRepeats()
+    say("Finished!")
 
 
 def main():
@@ -260,6 +114,23 @@ def main():
         print("  -decrypt         Decrypt SD save. Requires -extdata or -titledb options unless")
         print("                   a extdata directory is given as the input. -id is also required")
         print("                   --subid is required for single extdata file")
+        print("Other options")
+        print("  -triage          Only check the CMAC and the partition table hash")
+        print("  -quiet           Only show warnings and errors, at most 10 of each kind")
+        print("  -json            Write warnings and errors as JSON lines")
+        print("  -stats FILE      Write the time, bytes and hashed blocks of each stage")
+        print("                   as JSON to FILE, or to stdout if FILE is -")
+        print("  -tar FILE        Write the extracted files to a tar stream in FILE instead of")
+        print("                   a directory, or to stdout if FILE is -")
+        print("  -zip FILE        Like -tar, but writes an uncompressed zip")
+        print("  -store DIR       Store each distinct file content once in DIR, named by its")
+        print("                   SHA-256, and hard link the extracted files to it")
+        print("  -manifest FILE   With -store, write a JSON manifest of extracted paths and")
+        print("                   their SHA-256 to FILE instead of hard linking them")
+        print("  -file PATH       Only extract the file at PATH inside the extdata")
+        print("                   output is then the path of the extracted file")
+        print("  -threads N       Number of threads for decryption and hash verification")
+        print("                   Defaults to the number of CPUs")
         exit(1)
 
     inputPath = None
@@ -268,6 +139,16 @@ def main():
     saveSubId = None
     saveType = None
     decrypt = False
+    filePath = None
+    triage = False
+    quiet = False
+    jsonLines = False
+    statsPath = None
+    storeDir = None
+    manifestPath = None
+    archivePath = None
+    archiveFormat = None
+    workers = os.cpu_count() or 1
 
     i = 1
     while i < len(sys.argv):
@@ -283,6 +164,31 @@ def main():
             saveType = "titledb"
         elif sys.argv[i] == "-decrypt":
             decrypt = True
+        elif sys.argv[i] == "-triage":
+            triage = True
+        elif sys.argv[i] == "-quiet":
+            quiet = True
+        elif sys.argv[i] == "-json":
+            jsonLines = True
+        elif sys.argv[i] in ("-stats", "--stats"):
+            i += 1
+            statsPath = sys.argv[i]
+        elif sys.argv[i] in ("-tar", "-zip"):
+            archiveFormat = sys.argv[i][1:]
+            i += 1
+            archivePath = sys.argv[i]
+        elif sys.argv[i] == "-store":
+            i += 1
+            storeDir = sys.argv[i]
+        elif sys.argv[i] == "-manifest":
+            i += 1
+            manifestPath = sys.argv[i]
+        elif sys.argv[i] == "-file":
+            i += 1
+            filePath = sys.argv[i]
+        elif sys.argv[i] == "-threads":
+            i += 1
+            workers = int(sys.argv[i])
         else:
             if inputPath is None:
                 inputPath = sys.argv[i]
@@ -294,17 +200,86 @@ def main():
         print("Error: no input file given.")
         exit(1)
 
-    if outputPath is None:
-        print("No output directory given. Will only do data checking.")
+    writer = None
+    if archivePath is not None:
+        if storeDir is not None or filePath is not None:
+            print("Error: -tar and -zip can't be combined with -store or -file.")
+            exit(1)
+        writer = archivewriter.openWriter(archivePath, archiveFormat)
+        if archivePath == "-":
+            # Messages go to stderr, as the archive takes stdout
+            sys.stdout = sys.stderr
+
+    global verbose, listJson
+    verbose = not quiet and not jsonLines
+    listJson = not quiet and jsonLines
+    diagnostics.configure(quiet, jsonLines)
+    if statsPath is not None:
+        stats.enable()
+        # Also written when exiting early or failing
+        atexit.register(stats.writeSummary, statsPath)
 
-    if os.path.isdir(inputPath):
-        extractExtdata(inputPath, outputPath, saveId, decrypt)
-        exit(0)
+    secretsDb = Secrets()
+    keyEngine = key_engine.KeyEngine(secretsDb)
 
-    image = unwrapDIFF(inputPath, saveType=saveType,
-                       saveId=saveId, saveSubId=saveSubId, decrypt=decrypt)
+    if triage:
+        try:
+            if os.path.isdir(inputPath):
+                savearchive.check_extdata(inputPath, saveId, decrypt, keyEngine)
+            else:
+                savearchive.check_diff(inputPath, saveType, saveId, saveSubId,
+                                       decrypt, keyEngine)
+        except errors.SaveError as e:
+            fail(e)
+        say("Header OK!")
+        exit(0)
 
-    if outputPath is not None:
+    store = None
+    if storeDir is not None:
+        store = blobstore.BlobStore(storeDir, hardlink=manifestPath is None)
+    elif manifestPath is not None:
+        fail("-manifest requires -store.")
+
+    if filePath is not None and not os.path.isdir(inputPath):
+        fail("-file requires an extdata directory as the input.")
+
+    if outputPath is None and writer is None and store is None:
+        say("No output directory given. Will only do data checking.")
+
+    try:
+        if filePath is not None:
+            extractSingleFile(inputPath, filePath, outputPath, saveId, decrypt,
+                              keyEngine, workers)
+            exit(0)
+
+        if os.path.isdir(inputPath):
+            extractExtdata(inputPath, outputPath, saveId, decrypt, keyEngine,
+                           workers, store, writer)
+            if manifestPath is not None:
+                store.writeManifest(manifestPath, outputPath or ".")
+            if writer is not None:
+                writer.close()
+            exit(0)
+
+        image = savearchive.unwrapDiff(inputPath, saveType=saveType,
+                                       saveId=saveId, saveSubId=saveSubId,
+                                       decrypt=decrypt, keyEngine=keyEngine,
+                                       workers=workers).image
+    except errors.SaveError as e:
+        fail(e)
+
+    if writer is not None:
+        writer.addFile(os.path.basename(inputPath), lambda file: file.write(image),
+                       len(image))
+        writer.close()
+    elif store is not None:
+        if outputPath is None and not store.hardlink:
+            # Without links, the path is only the manifest key
+            outputPath = os.path.basename(inputPath)
+        store.save(outputPath, lambda file: file.write(image))
+        if manifestPath is not None:
+            store.writeManifest(manifestPath, os.path.dirname(outputPath or "") or ".")
+    elif outputPath is not None:
         output_file = open(outputPath, "wb")
         output_file.write(image)
         output_file.close()
@@ -1,8 +1,19 @@
 # Python 3
 
+import array
+import concurrent.futures
+import io
+import mmap
+import re
 import struct
+import sys
+import threading
 import hashlib
 
+import diagnostics
+import errors
+import stats
+
 
 class PartDiscriptor(object):
     """ Partition discriptor
@@ -19,24 +30,20 @@ class PartDiscriptor(object):
             = struct.unpack('<IIQQQQQQBB2xQ', raw[0:0x44])
 
         if DIFI != 0x49464944:
-            print("Error: Wrong DIFI magic")
-            exit(1)
+            raise errors.FormatError("Wrong DIFI magic")
 
         if ver != 0x00010000:
-            print("Error: Wrong DIFI version")
-            exit(1)
+            raise errors.FormatError("Wrong DIFI version")
 
         if externalIVFCL4 == 0:
             self.externalIVFCL4 = False
         elif externalIVFCL4 == 1:
             self.externalIVFCL4 = True
         else:
-            print("Error: Wrong externalIVFCL4 value %d" % externalIVFCL4)
-            exit(1)
+            raise errors.FormatError("Wrong externalIVFCL4 value %d" % externalIVFCL4)
 
         if self.DPFSL1Selector > 1:
-            print("Error: Wrong DPFSL1Selector value %d" % DPFSL1Selector)
-            exit(1)
+            raise errors.FormatError("Wrong DPFSL1Selector value %d" % self.DPFSL1Selector)
 
         # Reads IVFC descriptor
         IVFC, ver, masterHashSize, \
@@ -48,19 +55,16 @@ class PartDiscriptor(object):
                 '<IIQQQI4xQQI4xQQI4xQQI4xQ', raw[IVFCOff: (IVFCOff + IVFCSize)])
 
         if IVFC != 0x43465649:
-            print("Error: Wrong IVFC magic")
-            exit(1)
+            raise errors.FormatError("Wrong IVFC magic")
 
         if ver != 0x00020000:
-            print("Error: Wrong IVFC version")
-            exit(1)
+            raise errors.FormatError("Wrong IVFC version")
 
         if masterHashSize != hashSize:
-            print("Error: Master hash size mismatch")
-            exit(1)
+            raise errors.FormatError("Master hash size mismatch")
 
         if unknown != 0x78:
-            print("Warning: unknown = 0x%X" % unknown)
+            diagnostics.warning("unknown = 0x%X", unknown)
 
         self.IVFCL1BlockSize = 2 ** IVFCL1BlockSize
         self.IVFCL2BlockSize = 2 ** IVFCL2BlockSize
@@ -75,88 +79,374 @@ class PartDiscriptor(object):
             = struct.unpack('<IIQQI4xQQI4xQQI4x', raw[DPFSOff: (DPFSOff + DPFSSize)])
 
         if DPFS != 0x53465044:
-            print("Error: Wrong DPFS magic")
-            exit(1)
+            raise errors.FormatError("Wrong DPFS magic")
 
         if ver != 0x00010000:
-            print("Error: Wrong DPFS version")
-            exit(1)
+            raise errors.FormatError("Wrong DPFS version")
 
         self.DPFSL1BlockSize = 2 ** DPFSL1BlockSize
         self.DPFSL2BlockSize = 2 ** DPFSL2BlockSize
         self.DPFSL3BlockSize = 2 ** DPFSL3BlockSize
 
         # Reads partition hash
+        self.hashOff = hashOff
         self.hash = raw[hashOff: (hashOff + hashSize)]
 
 
+def mapImage(file):
+    """ Maps a whole container file as a read-only image without copying it
+
+     Real files are memory-mapped and in-memory files expose their buffer
+     directly. Slicing the returned memoryview doesn't copy the data. Other
+     file objects (e.g. decrypting ones) get a FileImage, which then owns
+     the file.
+    """
+    try:
+        return memoryview(mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ))
+    except (AttributeError, io.UnsupportedOperation, ValueError, OSError):
+        pass
+    if isinstance(file, io.BytesIO):
+        return memoryview(file.getvalue())
+    return FileImage(file)
+
+
+class FileImage(object):
+    """ An image over a seekable file, read only where it is sliced
+
+     Each slice reads the range with readinto, so for a sd_decrypt.SdFile
+     only the sliced bytes are decrypted. Reads are serialized, as they share
+     the file position.
+    """
+
+    def __init__(self, file):
+        self.file = file
+        self.size = file.seek(0, io.SEEK_END)
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return self.size
+
+    def __getitem__(self, key):
+        start, stop, _ = key.indices(self.size)
+        buffer = bytearray(max(0, stop - start))
+        view = memoryview(buffer)
+        pos = 0
+        with self.lock:
+            self.file.seek(start, io.SEEK_SET)
+            while pos < len(buffer):
+                readSize = self.file.readinto(view[pos:])
+                if not readSize:
+                    break
+                pos += readSize
+        if pos < len(buffer):
+            return buffer[0: pos]
+        return buffer
+
+
+class ImageWindow(object):
+    """ A window of an image, sliced without copying the whole window
+
+     Slices of a buffer image are memoryviews, so they don't copy either.
+    """
+
+    def __init__(self, image, off, size):
+        try:
+            image = memoryview(image)
+        except TypeError:
+            pass  # not a buffer, e.g. a LazyIVFCLevel
+        self.image = image
+        self.off = off
+        self.size = max(0, min(size, len(image) - off))
+
+    def __len__(self):
+        return self.size
+
+    def __getitem__(self, key):
+        start, stop, _ = key.indices(self.size)
+        return self.image[self.off + start: self.off + max(start, stop)]
+
+
+class ImageReader(io.RawIOBase):
+    """ A read-only file over an image, reading only what is asked for """
+
+    def __init__(self, image):
+        self.image = image
+        self.pos = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self.pos
+        elif whence == io.SEEK_END:
+            offset += len(self.image)
+        if offset < 0:
+            raise ValueError("negative seek position %d" % offset)
+        self.pos = offset
+        return self.pos
+
+    def tell(self):
+        return self.pos
+
+    def readinto(self, buffer):
+        data = self.image[self.pos: self.pos + len(buffer)]
+        size = len(data)
+        memoryview(buffer).cast('B')[0: size] = data
+        self.pos += size
+        return size
+
+    def close(self):
+        self.image = None
+        super().close()
+
+
 def getDPFSLevel(part, off, size):
-    """ Gets the data pair of a DPFS level """
-    return (part[off: off + size], part[off + size: off + 2 * size])
+    """ Gets the data pair of a DPFS level, as windows of part """
+    return (ImageWindow(part, off, size), ImageWindow(part, off + size, size))
+
+
+def getSelectorBits(selector, count):
+    """ Decodes the first count bits of a DPFS selector as a string of '0' and '1'
+
+     The selector is an u32 array with MSB as the first bit of each u32.
+    """
+    words = array.array('I')
+    words.frombytes(selector[0: len(selector) // 4 * 4])
+    if sys.byteorder == 'little':
+        words.byteswap()
+    bitCount = len(words) * 32
+    if bitCount < count:
+        raise errors.FormatError("DPFS selector too short")
+    bits = format(int.from_bytes(words.tobytes(), 'big'), '0%db' % bitCount)
+    return bits[0: count]
+
+
+def getSelectorBitPos(i):
+    """ Gets the byte index and the bit mask of the i-th bit of a DPFS selector """
+    bit = 31 - i % 32
+    return i // 32 * 4 + bit // 8, 1 << (bit % 8)
+
+
+def getSelectorBit(selector, i):
+    pos, mask = getSelectorBitPos(i)
+    return int(selector[pos] & mask != 0)
+
+
+def flipSelectorBit(selector, i):
+    pos, mask = getSelectorBitPos(i)
+    selector[pos] ^= mask
 
 
 def applyDPFSLevel(selector, data, dataBlockSize):
-    """ Reconstructs active data of a DPFS level using the previous level """
-    dataPos = 0
-    selectorPos = 0
-    output = bytearray()
+    """ Reconstructs active data of a DPFS level using the previous level
+
+     Runs of blocks selecting the same chunk are copied as one piece, and
+     only the selected copy of each run is read.
+    """
     dataLen = len(data[0])
-    while True:
-        u32, = struct.unpack('<I', selector[selectorPos: selectorPos + 4])
-        for i in range(32):
-            bit = (u32 >> (31 - i)) & 1
-            tranSize = min(dataLen, dataBlockSize)
-            output.extend(data[bit][dataPos: dataPos + tranSize])
-            dataPos += tranSize
-            dataLen -= tranSize
-            if dataLen <= 0:
-                return output
-
-        selectorPos += 4
-
-
-def unwrapDPFS(part, discriptor):
-    """ Reconstructs active data of the most inner DPFS level """
+    blockCount = (dataLen + dataBlockSize - 1) // dataBlockSize
+    output = bytearray(dataLen)
+    bits = getSelectorBits(selector, blockCount)
+    for run in re.finditer('0+|1+', bits):
+        start = run.start() * dataBlockSize
+        end = min(run.end() * dataBlockSize, dataLen)
+        output[start: end] = data[bits[run.start()] == '1'][start: end]
+    return output
+
+
+class LazyDPFSLevel(object):
+    """ A DPFS level whose active data is read when it is sliced
+
+     Behaves like the output of applyDPFSLevel when sliced, but each slice
+     only reads the selected copy of the blocks it covers.
+    """
+
+    def __init__(self, selector, data, dataBlockSize):
+        self.data = data
+        self.dataBlockSize = dataBlockSize
+        self.size = len(data[0])
+        self.bits = getSelectorBits(
+            selector, (self.size + dataBlockSize - 1) // dataBlockSize)
+
+    def __len__(self):
+        return self.size
+
+    def __getitem__(self, key):
+        start, stop, _ = key.indices(self.size)
+        if start >= stop:
+            return b''
+        blockSize = self.dataBlockSize
+        first = start // blockSize
+        bits = self.bits[first: (stop - 1) // blockSize + 1]
+        if '0' not in bits or '1' not in bits:
+            # A single run is passed through, so it isn't copied
+            return self.data[bits[0] == '1'][start: stop]
+        output = bytearray()
+        for run in re.finditer('0+|1+', bits):
+            runStart = max(start, (first + run.start()) * blockSize)
+            runEnd = min(stop, (first + run.end()) * blockSize)
+            output.extend(self.data[bits[run.start()] == '1'][runStart: runEnd])
+        return output
+
+
+def unwrapDPFS(part, discriptor, lazy=False):
+    """ Reconstructs active data of the most inner DPFS level
+
+     If lazy is set, level 3 is a LazyDPFSLevel read on demand. Only the
+     selectors of levels 1 and 2 are read upfront.
+    """
     l1 = getDPFSLevel(part, discriptor.DPFSL1Off, discriptor.DPFSL1Size)
     l2 = getDPFSLevel(part, discriptor.DPFSL2Off, discriptor.DPFSL2Size)
     l3 = getDPFSLevel(part, discriptor.DPFSL3Off, discriptor.DPFSL3Size)
     l1active = l1[discriptor.DPFSL1Selector]
-    l2active = applyDPFSLevel(l1active, l2, discriptor.DPFSL2BlockSize)
-    l3active = applyDPFSLevel(l2active, l3, discriptor.DPFSL3BlockSize)
+    if lazy:
+        stats.add("dpfs", calls=1)
+        l2active = applyDPFSLevel(l1active, l2, discriptor.DPFSL2BlockSize)
+        return LazyDPFSLevel(l2active, l3, discriptor.DPFSL3BlockSize)
+
+    with stats.stage("dpfs", discriptor.DPFSL3Size):
+        l2active = applyDPFSLevel(l1active, l2, discriptor.DPFSL2BlockSize)
+        l3active = applyDPFSLevel(l2active, l3, discriptor.DPFSL3BlockSize)
     return l3active
 
 
 def getIVFCLevel(part, off, size):
-    """ Gets the data of a IVFC level """
-    return part[off: off + size]
-
-
-def applyIVFCLevel(hash, data, dataBlockSize):
-    """ Poisons unhashed data of a IVFC level using the hash from the previous level """
-    hashPos = 0
-    dataPos = 0
-    output = bytearray()
-    dataLen = len(data)
-    while (hashPos < len(hash)):
-        hashChunk = hash[hashPos: hashPos + 0x20]
-        tranSize = min(dataLen, dataBlockSize)
-        dataChunk = data[dataPos: dataPos + tranSize]
-        dataChunkAlign = dataChunk + b'\x00' * (dataBlockSize - tranSize)
-        if hashlib.sha256(dataChunkAlign).digest() == hashChunk:
-            output.extend(dataChunk)
-        else:
-            # fill unhashed data with 0xDD
-            output.extend(b'\xDD' * len(dataChunk))
-        hashPos += 0x20
-        dataPos += dataBlockSize
-        dataLen -= tranSize
-        if dataLen <= 0:
-            break
+    """ Gets the data of a IVFC level, as a window of part """
+    return ImageWindow(part, off, size)
+
+
+def applyIVFCLevel(hash, data, dataBlockSize, workers=1):
+    """ Poisons unhashed data of a IVFC level using the hash from the previous level
+
+     With more than one worker, ranges of blocks are verified on a thread pool.
+     hashlib releases the GIL while hashing large blocks, so this scales with
+     the number of cores for big levels.
+    """
+    hashCount = (len(hash) + 0x1F) // 0x20
+    outputLen = min(len(data), hashCount * dataBlockSize)
+    blockCount = (outputLen + dataBlockSize - 1) // dataBlockSize
+    output = bytearray(outputLen)
+    try:
+        data = memoryview(data)
+    except TypeError:
+        # Not a buffer, e.g. a window of a FileImage, so it is read once
+        data = memoryview(data[0: outputLen])
+
+    def applyBlocks(first, last):
+        poisoned = 0
+        for i in range(first, last):
+            dataPos = i * dataBlockSize
+            dataChunk = data[dataPos: min(dataPos + dataBlockSize, outputLen)]
+            dataHash = hashlib.sha256(dataChunk)
+            dataHash.update(b'\x00' * (dataBlockSize - len(dataChunk)))
+            if dataHash.digest() == hash[i * 0x20: (i + 1) * 0x20]:
+                output[dataPos: dataPos + len(dataChunk)] = dataChunk
+            else:
+                # fill unhashed data with 0xDD
+                output[dataPos: dataPos + len(dataChunk)] = \
+                    b'\xDD' * len(dataChunk)
+                poisoned += 1
+        stats.add("ivfc", hashedBlocks=last - first, poisonedBlocks=poisoned)
+
+    if workers <= 1 or blockCount < workers * 2:
+        applyBlocks(0, blockCount)
+        return output
+
+    # a few ranges per worker to even out the load
+    rangeSize = (blockCount + workers * 4 - 1) // (workers * 4)
+    with concurrent.futures.ThreadPoolExecutor(workers) as pool:
+        ranges = [pool.submit(applyBlocks, first, min(first + rangeSize, blockCount))
+                  for first in range(0, blockCount, rangeSize)]
+        for r in ranges:
+            r.result()
     return output
 
 
-def unwrapIVFC(partActive, discriptor, l4):
-    """ Poisons IVFC tree to the most inner level """
+class LazyIVFCLevel(object):
+    """ A IVFC level that is verified block by block when it is read
+
+     Behaves like the output of applyIVFCLevel when sliced, but a block is
+     only hashed the first time a read touches it. The hash comes from the
+     previous level, which can be a LazyIVFCLevel itself, so only the
+     ancestor blocks on the path to the master hash get verified.
+    """
+
+    UNKNOWN = 0
+    GOOD = 1
+    POISONED = 2
+
+    def __init__(self, hash, data, dataBlockSize):
+        self.hash = hash
+        try:
+            data = memoryview(data)
+        except TypeError:
+            pass  # not a buffer, e.g. a window of a FileImage
+        self.data = data
+        self.dataBlockSize = dataBlockSize
+        hashCount = (len(hash) + 0x1F) // 0x20
+        self.size = min(len(data), hashCount * dataBlockSize)
+        self.blockState = bytearray(
+            (self.size + dataBlockSize - 1) // dataBlockSize)
+
+    def __len__(self):
+        return self.size
+
+    def verifyBlock(self, i, dataChunk=None):
+        """ Verifies the i-th block and returns whether it is properly hashed
+
+         dataChunk is the block if the caller already read it.
+        """
+        state = self.blockState[i]
+        if state == LazyIVFCLevel.UNKNOWN:
+            if dataChunk is None:
+                dataPos = i * self.dataBlockSize
+                dataChunk = self.data[dataPos: dataPos + self.dataBlockSize]
+            dataHash = hashlib.sha256(dataChunk)
+            dataHash.update(b'\x00' * (self.dataBlockSize - len(dataChunk)))
+            if dataHash.digest() == self.hash[i * 0x20: (i + 1) * 0x20]:
+                state = LazyIVFCLevel.GOOD
+            else:
+                state = LazyIVFCLevel.POISONED
+            self.blockState[i] = state
+            if stats.enabled:
+                stats.add("ivfc", hashedBlocks=1,
+                          poisonedBlocks=int(state == LazyIVFCLevel.POISONED))
+        return state == LazyIVFCLevel.GOOD
+
+    def __getitem__(self, key):
+        start, stop, _ = key.indices(self.size)
+        if start >= stop:
+            return b''
+        output = bytearray()
+        blockSize = self.dataBlockSize
+        for i in range(start // blockSize, (stop - 1) // blockSize + 1):
+            chunkStart = max(start, i * blockSize)
+            chunkEnd = min(stop, (i + 1) * blockSize)
+            if self.blockState[i] == LazyIVFCLevel.UNKNOWN:
+                # The block is read once, for both the hash and the output
+                block = self.data[i * blockSize: (i + 1) * blockSize]
+                if self.verifyBlock(i, block):
+                    output.extend(block[chunkStart - i * blockSize:
+                                        chunkEnd - i * blockSize])
+                    continue
+            elif self.blockState[i] == LazyIVFCLevel.GOOD:
+                output.extend(self.data[chunkStart: chunkEnd])
+                continue
+            # fill unhashed data with 0xDD
+            output.extend(b'\xDD' * (chunkEnd - chunkStart))
+        return output
+
+
+def unwrapIVFC(partActive, discriptor, l4, lazy=False, workers=1):
+    """ Poisons IVFC tree to the most inner level
+
+     If lazy is set, returns a LazyIVFCLevel that verifies data on demand.
+     Otherwise, each level is verified with the given number of threads.
+    """
     l1 = getIVFCLevel(partActive, discriptor.IVFCL1Off, discriptor.IVFCL1Size)
     l2 = getIVFCLevel(partActive, discriptor.IVFCL2Off, discriptor.IVFCL2Size)
     l3 = getIVFCLevel(partActive, discriptor.IVFCL3Off, discriptor.IVFCL3Size)
@@ -164,21 +454,107 @@ def unwrapIVFC(partActive, discriptor, l4):
         l4 = getIVFCLevel(partActive, discriptor.IVFCL4Off,
                           discriptor.IVFCL4Size)
 
-    l1p = applyIVFCLevel(discriptor.hash, l1, discriptor.IVFCL1BlockSize)
-    l2p = applyIVFCLevel(l1p, l2, discriptor.IVFCL2BlockSize)
-    l3p = applyIVFCLevel(l2p, l3, discriptor.IVFCL3BlockSize)
-    l4p = applyIVFCLevel(l3p, l4, discriptor.IVFCL4BlockSize)
+    if lazy:
+        stats.add("ivfc", calls=1)
+        l1p = LazyIVFCLevel(discriptor.hash, l1, discriptor.IVFCL1BlockSize)
+        l2p = LazyIVFCLevel(l1p, l2, discriptor.IVFCL2BlockSize)
+        l3p = LazyIVFCLevel(l2p, l3, discriptor.IVFCL3BlockSize)
+        return LazyIVFCLevel(l3p, l4, discriptor.IVFCL4BlockSize)
+
+    with stats.stage("ivfc", discriptor.IVFCL4Size):
+        l1p = applyIVFCLevel(discriptor.hash, l1,
+                             discriptor.IVFCL1BlockSize, workers)
+        l2p = applyIVFCLevel(l1p, l2, discriptor.IVFCL2BlockSize, workers)
+        l3p = applyIVFCLevel(l2p, l3, discriptor.IVFCL3BlockSize, workers)
+        l4p = applyIVFCLevel(l3p, l4, discriptor.IVFCL4BlockSize, workers)
 
     return l4p
 
 
-def unwrap(discriptorRaw, partitionRaw):
-    """ Unwraps DPFS and IVFC tree of a partition according to the partiton discriptor """
+def diffIVFCLevel(hashA, hashB, blocks, blockSize, count):
+    """ Compares the hashes stored in the given blocks of two IVFC levels
+
+     Returns the indices of the next level blocks whose hashes differ.
+    """
+    perBlock = blockSize // 0x20
+    changed = []
+    for i in blocks:
+        # Each block is read once, as the levels can be read on demand
+        blockA = hashA[i * blockSize: (i + 1) * blockSize]
+        blockB = hashB[i * blockSize: (i + 1) * blockSize]
+        for j in range(i * perBlock, min((i + 1) * perBlock, count)):
+            pos = (j - i * perBlock) * 0x20
+            if blockA[pos: pos + 0x20] != blockB[pos: pos + 0x20]:
+                changed.append(j)
+    return changed
+
+
+def getIVFCLayout(discriptor):
+    return (discriptor.IVFCL1Size, discriptor.IVFCL1BlockSize,
+            discriptor.IVFCL2Size, discriptor.IVFCL2BlockSize,
+            discriptor.IVFCL3Size, discriptor.IVFCL3BlockSize,
+            discriptor.IVFCL4Size, discriptor.IVFCL4BlockSize)
+
+
+def diffIVFC(discriptorA, partActiveA, discriptorB, partActiveB):
+    """ Compares two IVFC trees top-down, only descending into differing hashes
+
+     Returns the (start, end) ranges of level 4 whose hashes differ. Hashes
+     are compared, not verified. If the trees have different layouts, all of
+     level 4 is returned. Only the hash blocks compared are sliced from
+     partActiveA and partActiveB.
+    """
+    layout = getIVFCLayout(discriptorA)
+    if layout != getIVFCLayout(discriptorB) or \
+            len(discriptorA.hash) != len(discriptorB.hash):
+        return [(0, max(discriptorA.IVFCL4Size, discriptorB.IVFCL4Size))]
+
+    hashLevels = []
+    for discriptor, partActive in ((discriptorA, partActiveA),
+                                   (discriptorB, partActiveB)):
+        hashLevels.append((
+            discriptor.hash,
+            ImageWindow(partActive, discriptor.IVFCL1Off, discriptor.IVFCL1Size),
+            ImageWindow(partActive, discriptor.IVFCL2Off, discriptor.IVFCL2Size),
+            ImageWindow(partActive, discriptor.IVFCL3Off, discriptor.IVFCL3Size)))
+
+    # The master hash is treated as a single block above level 1
+    blocks = [0]
+    blockSize = len(discriptorA.hash)
+    for level in range(4):
+        size, nextBlockSize = layout[level * 2], layout[level * 2 + 1]
+        blocks = diffIVFCLevel(hashLevels[0][level], hashLevels[1][level], blocks,
+                               blockSize, (size + nextBlockSize - 1) // nextBlockSize)
+        blockSize = nextBlockSize
+
+    # Merges runs of blocks
+    ranges = []
+    l4Size = discriptorA.IVFCL4Size
+    for i in blocks:
+        start, end = i * blockSize, min((i + 1) * blockSize, l4Size)
+        if ranges and ranges[-1][1] == start:
+            ranges[-1] = (ranges[-1][0], end)
+        else:
+            ranges.append((start, end))
+    return ranges
+
+
+def getExternalIVFCL4(partitionRaw, discriptor):
+    """ Gets IVFC level 4 if it is stored outside of DPFS, otherwise None """
+    if not discriptor.externalIVFCL4:
+        return None
+    return ImageWindow(partitionRaw, discriptor.IVFCL4OffExt, discriptor.IVFCL4Size)
+
+
+def unwrap(discriptorRaw, partitionRaw, lazy=False, workers=1):
+    """ Unwraps DPFS and IVFC tree of a partition according to the partiton discriptor
+
+     If lazy is set, DPFS and IVFC are both applied as the image is read, so
+     only the blocks read and their hashes are touched. Otherwise, they are
+     applied upfront, verifying with the given number of threads.
+    """
     discriptor = PartDiscriptor(discriptorRaw)
-    active = unwrapDPFS(partitionRaw, discriptor)
-    if discriptor.externalIVFCL4:
-        IVFCL4 = partitionRaw[discriptor.IVFCL4OffExt:
-                              discriptor.IVFCL4OffExt + discriptor.IVFCL4Size]
-    else:
-        IVFCL4 = None
-    return (unwrapIVFC(active, discriptor, IVFCL4), discriptor.externalIVFCL4)
+    active = unwrapDPFS(partitionRaw, discriptor, lazy)
+    IVFCL4 = getExternalIVFCL4(partitionRaw, discriptor)
+    return (unwrapIVFC(active, discriptor, IVFCL4, lazy, workers),
+            discriptor.externalIVFCL4)
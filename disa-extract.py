@@ -1,14 +1,19 @@
 #!/usr/bin/env python3
 
+import atexit
+import json
 import os
-import os.path
-import struct
 import sys
-import hashlib
 
-import difi
-import savefilesystem
+import archivewriter
+import blobstore
+import diagnostics
+import errors
 import key_engine
+import savearchive
+import savecache
+import savefilesystem
+import stats
 
 try:
     from secrets import Secrets
@@ -17,32 +22,46 @@ except:
         pass
 
 
-def getDigestBlock(saveType, saveId, header):
-    if saveType == "nand":
-        return b"CTR-SYS0" + struct.pack("<Q", saveId) + header
-    sav0Block = hashlib.sha256(b"CTR-SAV0" + header).digest()
-    return b"CTR-SIGN" + struct.pack("<Q", saveId) + sav0Block
+verbose = True
+listJson = False
+
+
+def say(message):
+    """ Prints progress and listings, which are left out with -quiet or -json """
+    if verbose:
+        print(message)
 
 
-def cryptoUnwrap(disa, saveType, saveId, key):
-    if saveType != "sd":
-        print("Error: only SD save supports decryption.")
-        return None
+def listEntry(kind, text, record):
+    """ Prints a line of the directory or file list, or with -json writes it
+     as a JSON record """
+    if verbose:
+        print(text)
+    elif listJson:
+        record["entry"] = kind
+        print(json.dumps(record))
 
-    if saveId is None:
-        print("Error: ID needed to decrypt the save.")
-        return None
 
-    if key is None:
-        print("No enough secrets provided to decrypt.")
-        return None
+def fail(message):
+    diagnostics.error("%s", message)
+    diagnostics.flushRepeats()
+    exit(1)
 
-    high = saveId >> 32
-    low = saveId & 0xFFFFFFFF
-    path = "/title/%08x/%08x/data/00000001.sav" % (high, low)
 
-    import sd_decrypt
-    return sd_decrypt.DecryptSdFile(disa, path, key)
+def extractSingleFile(inputPath, filePath, outputPath, saveType, saveId,
+                      decrypt, keyEngine, workers, cache=None):
+    """ Looks up one file and extracts it, only verifying the blocks it uses """
+    try:
+        archive = savearchive.open_disa(inputPath, saveType, saveId, decrypt,
+                                        keyEngine, lazy=True, workers=workers,
+                                        cache=cache)
+        archive.extractFile(filePath, outputPath)
+    except errors.SaveError as e:
+        fail(e)
+    except (FileNotFoundError, NotADirectoryError, IsADirectoryError):
+        fail("%s is not a file in the save." % filePath)
+    diagnostics.flushRepeats()
+    say("Finished!")
 
 
 def main():
@@ -60,6 +79,27 @@ def main():
         print("  -id ID           The save ID of the file in hex")
         print("Decryption for SD save is also supported by the following option")
         print("  -decrypt         Decrypt SD save. Requires -sd and -id arguments")
+        print("Other options")
+        print("  -file PATH       Only extract the file at PATH inside the save")
+        print("                   output is then the path of the extracted file")
+        print("  -threads N       Number of threads for decryption and hash verification")
+        print("                   Defaults to the number of CPUs")
+        print("  -triage          Only check the CMAC and the partition table hash")
+        print("  -diff OLD        List the files that changed since OLD, an older copy")
+        print("                   of the same save, by comparing the IVFC hash trees")
+        print("  -quiet           Only show warnings and errors, at most 10 of each kind")
+        print("  -json            Write warnings and errors as JSON lines")
+        print("  -stats FILE      Write the time, bytes and hashed blocks of each stage")
+        print("                   as JSON to FILE, or to stdout if FILE is -")
+        print("  -tar FILE        Write the extracted files to a tar stream in FILE instead of")
+        print("                   a directory, or to stdout if FILE is -")
+        print("  -zip FILE        Like -tar, but writes an uncompressed zip")
+        print("  -store DIR       Store each distinct file content once in DIR, named by its")
+        print("                   SHA-256, and hard link the extracted files to it")
+        print("  -manifest FILE   With -store, write a JSON manifest of extracted paths and")
+        print("                   their SHA-256 to FILE instead of hard linking them")
+        print("  -cache DIR       Keep unwrapped saves in DIR and reuse them for unchanged input")
+        print("  -cachesize MB    Size limit of the cache directory. Defaults to 1024")
 
         exit(1)
 
@@ -68,6 +108,19 @@ def main():
     saveId = None
     saveType = None
     decrypt = False
+    filePath = None
+    triage = False
+    diffPath = None
+    quiet = False
+    jsonLines = False
+    statsPath = None
+    storeDir = None
+    manifestPath = None
+    archivePath = None
+    archiveFormat = None
+    cacheDir = None
+    cacheSize = 1024
+    workers = os.cpu_count() or 1
 
     i = 1
     while i < len(sys.argv):
@@ -82,6 +135,40 @@ def main():
             saveType = "card"
         elif sys.argv[i] == "-decrypt":
             decrypt = True
+        elif sys.argv[i] == "-file":
+            i += 1
+            filePath = sys.argv[i]
+        elif sys.argv[i] == "-triage":
+            triage = True
+        elif sys.argv[i] == "-diff":
+            i += 1
+            diffPath = sys.argv[i]
+        elif sys.argv[i] == "-quiet":
+            quiet = True
+        elif sys.argv[i] == "-json":
+            jsonLines = True
+        elif sys.argv[i] in ("-stats", "--stats"):
+            i += 1
+            statsPath = sys.argv[i]
+        elif sys.argv[i] in ("-tar", "-zip"):
+            archiveFormat = sys.argv[i][1:]
+            i += 1
+            archivePath = sys.argv[i]
+        elif sys.argv[i] == "-store":
+            i += 1
+            storeDir = sys.argv[i]
+        elif sys.argv[i] == "-manifest":
+            i += 1
+            manifestPath = sys.argv[i]
+        elif sys.argv[i] == "-cache":
+            i += 1
+            cacheDir = sys.argv[i]
+        elif sys.argv[i] == "-cachesize":
+            i += 1
+            cacheSize = int(sys.argv[i])
+        elif sys.argv[i] == "-threads":
+            i += 1
+            workers = int(sys.argv[i])
         else:
             if inputPath is None:
                 inputPath = sys.argv[i]
@@ -93,195 +180,112 @@ def main():
         print("Error: no input file given.")
         exit(1)
 
-    disa = open(inputPath, 'rb')
+    writer = None
+    if archivePath is not None:
+        if storeDir is not None or filePath is not None:
+            print("Error: -tar and -zip can't be combined with -store or -file.")
+            exit(1)
+        writer = archivewriter.openWriter(archivePath, archiveFormat)
+        if archivePath == "-":
+            # Messages go to stderr, as the archive takes stdout
+            sys.stdout = sys.stderr
+
+    global verbose, listJson
+    verbose = not quiet and not jsonLines
+    listJson = not quiet and jsonLines
+    diagnostics.configure(quiet, jsonLines)
+    if statsPath is not None:
+        stats.enable()
+        # Also written when exiting early or failing
+        atexit.register(stats.writeSummary, statsPath)
 
     secretsDb = Secrets()
     keyEngine = key_engine.KeyEngine(secretsDb)
 
-    if decrypt:
-        disa = cryptoUnwrap(disa, saveType, saveId,
-                            keyEngine.getKeySdDecrypt())
-        if disa is None:
-            exit(1)
-
-    Cmac = disa.read(0x10)
-    disa.seek(0x100, os.SEEK_SET)
-    header = disa.read(0x100)
-
-    if outputPath is None:
-        print("No output directory given. Will only do data checking.")
-
-    if saveType is None:
-        print("No save type specified. Will skip CMAC verification.")
-    elif saveType == "nand" or saveType == "sd":
-        if saveId is None:
-            print("No save ID specified. Will skip CMAC verification.")
-        else:
-            key = keyEngine.getKeySdNandCmac()
-            if key is None:
-                print("No enough secrets provided. Will skip CMAC verification.")
+    if triage:
+        try:
+            savearchive.check_disa(inputPath, saveType, saveId, decrypt,
+                                   keyEngine)
+        except errors.SaveError as e:
+            fail(e)
+        say("Header OK!")
+        exit(0)
+
+    if diffPath is not None:
+        try:
+            changes = savearchive.diff_disa(diffPath, inputPath, saveType, saveId,
+                                            decrypt, keyEngine)
+        except errors.SaveError as e:
+            fail(e)
+        for path, status in changes:
+            if jsonLines:
+                print(json.dumps({"path": path, "status": status}))
             else:
-                digest = hashlib.sha256(getDigestBlock(
-                    saveType, saveId, header)).digest()
-                import cmac
-                if Cmac != cmac.AesCmac(digest, key):
-                    print("Error: CMAC mismatch.")
-                    exit(1)
-                else:
-                    print("Info: CMAC verified.")
-    else:
-        print("Unsupported save type. Will skip CMAC verification.")
-
-    # Reads DISA header
-    disa.seek(0x100, os.SEEK_SET)
-    DISA, ver, \
-        partCount, secPartTableOff, priPartTableOff, partTableSize, \
-        partADiscriptorOff, partADiscriptorSize, \
-        partBDiscriptorOff, partBDiscriptorSize, \
-        partAOff, partASize, partBOff, partBSize, \
-        activeTable, tableHash = struct.unpack(
-            '<III4xQQQQQQQQQQQB3x32s116x', header)
-
-    if DISA != 0x41534944:
-        print("Error: Not a DISA format")
-        exit(1)
-
-    if ver != 0x00040000:
-        print("Error: Wrong DISA version")
-        exit(1)
-
-    if partCount == 1:
-        hasData = False
-        print("Info: No partition B")
-    elif partCount == 2:
-        hasData = True
-        print("Info: Has partition B")
-    else:
-        print("Error: Wrong partition count %d" % parCount)
-        exit(1)
-
-    if activeTable == 0:
-        partTableOff = priPartTableOff
-    elif activeTable == 1:
-        partTableOff = secPartTableOff
-    else:
-        print("Error: Wrong active table ID %d" % activeTable)
-        exit(1)
-
-    # Verify partition table hash
-    disa.seek(partTableOff, os.SEEK_SET)
-    partTable = disa.read(partTableSize)
-
-    if hashlib.sha256(partTable).digest() != tableHash:
-        print("Error: Partition table hash mismatch!")
-        exit(1)
-
-    # Reads and unwraps SAVE image
-    partADescriptor = partTable[partADiscriptorOff:
-                                partADiscriptorOff + partADiscriptorSize]
-    disa.seek(partAOff, os.SEEK_SET)
-    partA = disa.read(partASize)
-    partAInner, externalIVFCL4 = difi.unwrap(partADescriptor, partA)
-    if externalIVFCL4:
-        print("Warning: partition A has an external IVFC level 4")
-
-    # Reads and unwraps DATA image
-    if hasData:
-        partBDescriptor = partTable[partBDiscriptorOff:
-                                    partBDiscriptorOff + partBDiscriptorSize]
-        disa.seek(partBOff, os.SEEK_SET)
-        partB = disa.read(partBSize)
-        dataRegion, externalIVFCL4 = difi.unwrap(partBDescriptor, partB)
-        if not externalIVFCL4:
-            print("Warning: partition B does not have an external IVFC level 4")
-
-    disa.close()
-
-    # Reads SAVE header
-    SAVE, ver, filesystemHeaderOff, imageSize, imageBlockSize, x00 \
-        = struct.unpack('<IIQQII', partAInner[0:0x20])
-
-    if SAVE != 0x45564153:
-        print("Error: Wrong SAVE magic")
-        exit(1)
-
-    if ver != 0x00040000:
-        print("Error: Wrong SAVE version")
-        exit(1)
-
-    if x00 != 0:
-        print("Warning: unknown 0 = 0x%X in SAVE header" % x00)
-
-    fsHeader = savefilesystem.Header(
-        partAInner[filesystemHeaderOff:filesystemHeaderOff + 0x68], hasData)
-
-    if not hasData:
-        dataRegion = partAInner[
-            fsHeader.dataRegionOff: fsHeader.dataRegionOff +
-            fsHeader.dataRegionSize * fsHeader.blockSize]
-
-    # Parses hash tables
-    dirHashTable = savefilesystem.getHashTable(fsHeader.dirHashTableOff,
-                                               fsHeader.dirHashTableSize,
-                                               partAInner)
-
-    fileHashTable = savefilesystem.getHashTable(fsHeader.fileHashTableOff,
-                                                fsHeader.fileHashTableSize,
-                                                partAInner)
-
-    # Parses FAT
-    fat = savefilesystem.FAT(fsHeader, partAInner)
-
-    # Parses directory & file entry table
-    dirList = savefilesystem.getDirList(
-        fsHeader, partAInner, dataRegion, fat)
-
-    print("Directory list:")
-    for i in range(len(dirList)):
-        dirList[i].printEntry(i)
-
-    fileList = savefilesystem.getFileList(
-        fsHeader, partAInner, dataRegion, fat)
-
-    print("File list:")
-    for i in range(len(fileList)):
-        fileList[i].printEntryAsSave(i)
-
-    # Verifies directory & file hash table
-    print("Verifying directory hash table")
-    savefilesystem.verifyHashTable(dirHashTable, dirList)
-    print("Verifying file hash table")
-    savefilesystem.verifyHashTable(fileHashTable, fileList)
-
-    # Walks through free blocks
-    print("Walking through free blocks")
-    fat.visitFreeBlock()
-
-    def saveFileDumper(fileEntry, file, _):
-        fileSize = fileEntry.size
-
-        def blockDumper(index):
-            nonlocal fileSize
-            if fileSize == 0:
-                print("Warning: excessive block")
-                return
-            tranSize = min(fileSize, fsHeader.blockSize)
-            pos = index * fsHeader.blockSize
-            if file is not None:
-                file.write(dataRegion[pos: pos + tranSize])
-            fileSize -= tranSize
-
-        if fileSize != 0:
-            fat.walk(fileEntry.blockIndex, blockDumper)
-        if fileSize != 0:
-            print("Warning: not enough block")
-
-    print("Walking through files and dumping")
-    savefilesystem.extractAll(dirList, fileList, outputPath, saveFileDumper)
-
-    fat.allVisited()
-
-    print("Finished!")
+                print("%-9s %s" % (status, path))
+        diagnostics.flushRepeats()
+        exit(0)
+
+    store = None
+    if storeDir is not None:
+        store = blobstore.BlobStore(storeDir, hardlink=manifestPath is None)
+    elif manifestPath is not None:
+        fail("-manifest requires -store.")
+
+    cache = None
+    if cacheDir is not None:
+        try:
+            cache = savecache.SaveCache(cacheDir, cacheSize * 1024 * 1024)
+        except errors.SaveError as e:
+            fail(e)
+
+    if filePath is not None:
+        extractSingleFile(inputPath, filePath, outputPath, saveType, saveId,
+                          decrypt, keyEngine, workers, cache)
+        exit(0)
+
+    if outputPath is None and writer is None and store is None:
+        say("No output directory given. Will only do data checking.")
+
+    try:
+        # Only verify what is read if we don't dump
+        archive = savearchive.open_disa(inputPath, saveType, saveId, decrypt,
+                                        keyEngine, lazy=outputPath is None and writer is None,
+                                        workers=workers, cache=cache)
+
+        say("Directory list:")
+        if verbose or listJson:
+            for i, entry in enumerate(archive.dirList):
+                listEntry("dir", entry.formatEntry(i), entry.getRecord(i))
+
+        say("File list:")
+        if verbose or listJson:
+            for i, entry in enumerate(archive.fileList):
+                listEntry("file", entry.formatEntryAsSave(i), entry.getRecord(i))
+
+        # Verifies directory & file hash table
+        say("Verifying directory hash table")
+        savefilesystem.verifyHashTable(archive.dirHashTable, archive.dirList)
+        say("Verifying file hash table")
+        savefilesystem.verifyHashTable(archive.fileHashTable, archive.fileList)
+
+        # Walks through free blocks
+        say("Walking through free blocks")
+        archive.fat.visitFreeBlock()
+
+        say("Walking through files and dumping")
+        archive.extractAll(outputPath, visit=True, store=store, writer=writer)
+
+        archive.fat.allVisited()
+    except errors.SaveError as e:
+        fail(e)
+
+    if store is not None and manifestPath is not None:
+        store.writeManifest(manifestPath, outputPath or ".")
+    if writer is not None:
+        writer.close()
+
+    diagnostics.flushRepeats()
+    say("Finished!")
 
 
 if __name__ == "__main__":
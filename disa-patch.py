@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+
+import diagnostics
+import errors
+import key_engine
+import savewriter
+
+try:
+    from secrets import Secrets
+except:
+    class Secrets(object):
+        pass
+
+
+def fail(message):
+    diagnostics.error("%s", message)
+    diagnostics.flushRepeats()
+    exit(1)
+
+
+def main():
+    if len(sys.argv) < 4:
+        print("Usage: %s input PATH FILE [PATH FILE ...] [OPTIONS]" % sys.argv[0])
+        print("")
+        print("Arguments:")
+        print("  input            A DISA file, which is modified in place")
+        print("  PATH FILE        Replace the content of the file at PATH inside the save")
+        print("                   with the content of FILE. It must need as many blocks")
+        print("                   as the file already has")
+        print("")
+        print("The following arguments are needed to sign the save again.")
+        print("You need to provide secrets.py for signing.")
+        print("  -sd              Specify that the DISA file is a SD save file")
+        print("  -nand            Specify that the DISA file is a NAND save file")
+        print("  -id ID           The save ID of the file in hex")
+        print("Encrypted SD saves are supported by the following option")
+        print("  -decrypt         The save is encrypted. Requires -sd and -id arguments")
+        print("Other options")
+        print("  -quiet           Only show warnings and errors")
+        print("  -json            Write warnings and errors as JSON lines")
+        exit(1)
+
+    inputPath = None
+    paths = []
+    saveId = None
+    saveType = None
+    decrypt = False
+    quiet = False
+    jsonLines = False
+
+    i = 1
+    while i < len(sys.argv):
+        if sys.argv[i] == "-id":
+            i += 1
+            saveId = int(sys.argv[i], 16)
+        elif sys.argv[i] == "-sd":
+            saveType = "sd"
+        elif sys.argv[i] == "-nand":
+            saveType = "nand"
+        elif sys.argv[i] == "-decrypt":
+            decrypt = True
+        elif sys.argv[i] == "-quiet":
+            quiet = True
+        elif sys.argv[i] == "-json":
+            jsonLines = True
+        elif inputPath is None:
+            inputPath = sys.argv[i]
+        else:
+            paths.append(sys.argv[i])
+        i += 1
+
+    diagnostics.configure(quiet, jsonLines)
+
+    if inputPath is None or not paths or len(paths) % 2 != 0:
+        fail("input and pairs of PATH and FILE are needed.")
+
+    if not os.path.isfile(inputPath):
+        fail("%s is not a file." % inputPath)
+
+    contents = {}
+    for path, sourcePath in zip(paths[0::2], paths[1::2]):
+        with open(sourcePath, 'rb') as file:
+            contents[path] = file.read()
+
+    keyEngine = key_engine.KeyEngine(Secrets())
+    try:
+        savewriter.patch_disa(inputPath, contents, saveType, saveId, decrypt,
+                              keyEngine)
+    except errors.SaveError as e:
+        fail(e)
+    except (FileNotFoundError, NotADirectoryError, IsADirectoryError) as e:
+        fail("%s is not a file in the save." % e)
+    diagnostics.flushRepeats()
+    if not quiet and not jsonLines:
+        print("Finished!")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,14 @@
+class SaveError(Exception):
+    """ Base class of the errors raised when reading a save """
+
+
+class FormatError(SaveError):
+    """ The data is not a well-formed container or filesystem """
+
+
+class CmacError(FormatError):
+    """ The CMAC doesn't match. Usually the keys or the save ID are wrong """
+
+
+class ParameterError(SaveError):
+    """ The parameters are not enough or don't fit the save """
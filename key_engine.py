@@ -23,3 +23,17 @@ class KeyEngine(object):
             return scrambleKey(self.secrets.key0x34X, self.secrets.keyMovable, self.secrets.keyConst)
         except AttributeError:
             return None
+
+
+class DerivedKeys(object):
+    """ Keys derived once by a KeyEngine, which can be passed to other processes """
+
+    def __init__(self, keyEngine):
+        self.keySdNandCmac = keyEngine.getKeySdNandCmac()
+        self.keySdDecrypt = keyEngine.getKeySdDecrypt()
+
+    def getKeySdNandCmac(self):
+        return self.keySdNandCmac
+
+    def getKeySdDecrypt(self):
+        return self.keySdDecrypt
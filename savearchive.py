@@ -0,0 +1,1000 @@
+# Python 3
+
+""" Reading saves as archives, for use as a library
+
+ open_disa() opens a save file (DISA) and open_diff() opens an extdata
+ directory or a single DIFF file. Nothing is printed and errors are raised
+ as errors.SaveError. Warnings go to the diagnostics module.
+"""
+
+import array
+import bisect
+import collections
+import concurrent.futures
+import hashlib
+import io
+import os
+import os.path
+import struct
+
+import difi
+import diagnostics
+import errors
+import savecache
+import savefilesystem
+import stats
+
+
+EntryStat = collections.namedtuple('EntryStat', ['name', 'isDir', 'size', 'index'])
+
+
+def getDigestBlock(saveType, saveId, header):
+    """ Gets the block authenticated by the CMAC of a DISA file """
+    if saveType == "nand":
+        return b"CTR-SYS0" + struct.pack("<Q", saveId) + header
+    sav0Block = hashlib.sha256(b"CTR-SAV0" + header).digest()
+    return b"CTR-SIGN" + struct.pack("<Q", saveId) + sav0Block
+
+
+def getDiffDigestBlock(saveType, saveId, saveSubId, header):
+    """ Gets the block authenticated by the CMAC of a DIFF file """
+    if saveType == "extdata":
+        if saveSubId is None:
+            saveSubId = 0
+            quotaFlag = 0
+        else:
+            quotaFlag = 1
+        return b"CTR-EXT0" + \
+            struct.pack("<QIQ", saveId, quotaFlag, saveSubId) + header
+    return b"CTR-9DB0" + struct.pack("<I", saveId) + header
+
+
+def getCmac(digestBlock, key):
+    import cmac
+    return cmac.AesCmac(hashlib.sha256(digestBlock).digest(), key)
+
+
+def checkCmac(Cmac, digestBlock, key):
+    if Cmac != getCmac(digestBlock, key):
+        raise errors.CmacError("CMAC mismatch.")
+    diagnostics.info("CMAC verified.")
+
+
+def readHeader(file):
+    """ Reads the CMAC and the DISA/DIFF header of a container file """
+    file.seek(0, os.SEEK_SET)
+    Cmac = file.read(0x10)
+    file.seek(0x100, os.SEEK_SET)
+    header = file.read(0x100)
+    if len(header) != 0x100:
+        raise errors.FormatError("truncated header")
+    return Cmac, header
+
+
+def getSdPath(saveType, saveId, saveSubId=None):
+    """ Gets the path of a file on SD, which is used as its decryption IV """
+    if saveId is None:
+        raise errors.ParameterError("ID needed to decrypt the save.")
+
+    high = saveId >> 32
+    low = saveId & 0xFFFFFFFF
+    if saveType == "sd":
+        return "/title/%08x/%08x/data/00000001.sav" % (high, low)
+    elif saveType == "extdata":
+        if saveSubId is None:
+            raise errors.ParameterError("sub ID needed to decrypt the save.")
+        subHigh = saveSubId >> 32
+        subLow = saveSubId & 0xFFFFFFFF
+        return "/extdata/%08x/%08x/%08x/%08x" % (high, low, subHigh, subLow)
+    elif saveType == "titledb":
+        if saveId == 2:
+            return "/dbs/title.db"
+        elif saveId == 3:
+            return "/dbs/import.db"
+        raise errors.ParameterError("Wrong title database ID %d" % saveId)
+    elif saveType is None:
+        raise errors.ParameterError("save type needed to decrypt the save.")
+    raise errors.ParameterError("Unknown save type %s" % saveType)
+
+
+def cryptoUnwrap(file, path, keyEngine, workers=1):
+    """ Wraps an encrypted SD file in a decrypting file object """
+    key = keyEngine.getKeySdDecrypt() if keyEngine is not None else None
+    if key is None:
+        raise errors.ParameterError("No enough secrets provided to decrypt.")
+
+    import sd_decrypt
+    return sd_decrypt.SdFile(file, path, key, workers)
+
+
+def openInput(file):
+    """ Opens file if it is a path. Returns the file and whether we own it """
+    if isinstance(file, (str, bytes, os.PathLike)):
+        return open(file, 'rb'), True
+    return file, False
+
+
+def getStoreOutputDir(outputDir, store):
+    """ Gets the output directory to extract to a blobstore.BlobStore
+
+     A store without links only uses the paths as manifest keys, so they are
+     made relative to the root if there is no outputDir.
+    """
+    if outputDir is None and store is not None and not store.hardlink:
+        return ""
+    return outputDir
+
+
+class SaveArchive(object):
+    """ The filesystem inside a SAVE image, or a VSXE image for extdata
+
+     Paths are separated by '/' and are relative to the root directory.
+    """
+
+    def __init__(self, image, filesystemHeaderOff, dataImage=None, tables=None):
+        hasData = dataImage is not None
+        self.image = image
+        self.treeIndex = None
+        self.fsHeader = savefilesystem.Header(
+            image[filesystemHeaderOff:filesystemHeaderOff + 0x68], hasData)
+
+        if hasData:
+            self.dataRegion = difi.ImageWindow(dataImage, 0, len(dataImage))
+        else:
+            self.dataRegion = difi.ImageWindow(
+                image, self.fsHeader.dataRegionOff,
+                self.fsHeader.dataRegionSize * self.fsHeader.blockSize)
+
+        if tables is not None:
+            self.loadTables(tables)
+            return
+
+        # Parses FAT
+        self.fat = savefilesystem.FAT(self.fsHeader, image)
+
+        with stats.stage("tables"):
+            # Parses hash tables
+            self.dirHashTable = savefilesystem.getHashTable(
+                self.fsHeader.dirHashTableOff, self.fsHeader.dirHashTableSize, image)
+            self.fileHashTable = savefilesystem.getHashTable(
+                self.fsHeader.fileHashTableOff, self.fsHeader.fileHashTableSize, image)
+
+            # Parses directory & file entry table
+            self.dirList = savefilesystem.getDirList(
+                self.fsHeader, image, self.dataRegion, self.fat)
+            self.fileList = savefilesystem.getFileList(
+                self.fsHeader, image, self.dataRegion, self.fat)
+        stats.add("tables", bytes=(len(self.dirHashTable) + len(self.fileHashTable)) * 4 +
+                  len(self.dirList) * 0x28 + len(self.fileList) * 0x30)
+
+    def getTables(self):
+        """ Returns the filesystem tables as raw bytes, which can be passed back
+         as tables
+        """
+        tables = self.fat.getTables()
+        for name in ('dirHashTable', 'fileHashTable'):
+            tables[name] = array.array(savefilesystem.U32_TYPE, getattr(self, name)).tobytes()
+        tables['dirList'] = self.dirList.tobytes()
+        tables['fileList'] = self.fileList.tobytes()
+        return tables
+
+    def loadTables(self, tables):
+        """ Loads the filesystem tables from what getTables returned
+
+         Raises ValueError if they don't fit the filesystem header.
+        """
+        self.fat = savefilesystem.FAT(self.fsHeader, self.image, tables)
+        for name, size in (('dirHashTable', self.fsHeader.dirHashTableSize),
+                           ('fileHashTable', self.fsHeader.fileHashTableSize)):
+            hashTable = array.array(savefilesystem.U32_TYPE, tables[name])
+            if len(hashTable) != size:
+                raise ValueError("%s doesn't match its size" % name)
+            setattr(self, name, hashTable.tolist())
+        self.dirList = savefilesystem.EntryTable(savefilesystem.DirEntry,
+                                                 tables['dirList'])
+        self.fileList = savefilesystem.EntryTable(savefilesystem.FileEntry,
+                                                  tables['fileList'])
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self.image = None
+        self.dataRegion = None
+
+    def getTreeIndex(self):
+        """ Returns the savefilesystem.TreeIndex of the tree, building it once """
+        if self.treeIndex is None:
+            self.treeIndex = savefilesystem.TreeIndex(self.dirList, self.fileList)
+        return self.treeIndex
+
+    def lookup(self, path):
+        """ Finds an entry by path. Returns (isDir, index in dirList or fileList)
+
+         Once the tree index is built, the path is looked up in it. Otherwise
+         each path component is resolved through the directory and file hash
+         tables, so only the entries on the path are touched.
+        """
+        names = [name for name in path.split('/') if name not in ('', '.')]
+        if self.treeIndex is not None:
+            found = self.treeIndex.lookup('/'.join(names))
+            if found is not None:
+                return found
+        current = 1  # root
+        for depth, name in enumerate(names):
+            i = savefilesystem.lookupEntry(
+                self.dirHashTable, self.dirList, current, name)
+            if i != 0:
+                current = i
+                continue
+            i = savefilesystem.lookupEntry(
+                self.fileHashTable, self.fileList, current, name)
+            if i == 0:
+                raise FileNotFoundError(path)
+            if depth != len(names) - 1:
+                raise NotADirectoryError(path)
+            return False, i
+        return True, current
+
+    def getFileSize(self, fileEntry, index):
+        return fileEntry.size
+
+    def walkFiles(self):
+        """ Yields (path, index in fileList) of every file, in extraction order """
+        treeIndex = self.getTreeIndex()
+        filePaths = treeIndex.filePaths
+        for isDir, i in treeIndex.order:
+            if not isDir:
+                yield filePaths[i], i
+
+    def listdir(self, path=''):
+        """ Lists names of the subdirectories and files in a directory """
+        isDir, index = self.lookup(path)
+        if not isDir:
+            raise NotADirectoryError(path)
+        treeIndex = self.getTreeIndex()
+        return ([self.dirList[i].getName() for i in treeIndex.subdirs.get(index, ())] +
+                [self.fileList[i].getName() for i in treeIndex.files.get(index, ())])
+
+    def stat(self, path):
+        isDir, index = self.lookup(path)
+        if isDir:
+            return EntryStat(self.dirList[index].getName(), True, 0, index)
+        fileEntry = self.fileList[index]
+        return EntryStat(fileEntry.getName(), False,
+                         self.getFileSize(fileEntry, index), index)
+
+    def open(self, path):
+        """ Opens a file for reading. Its content is read as it is asked for """
+        isDir, index = self.lookup(path)
+        if isDir:
+            raise IsADirectoryError(path)
+        return io.BufferedReader(difi.ImageReader(
+            self.getFileView(self.fileList[index], index)))
+
+    def getFileView(self, fileEntry, index, visit=False):
+        """ Returns the content of a file as a sliceable view of the data region
+
+         With visit, the blocks are marked visited in the FAT for checking.
+        """
+        if fileEntry.size == 0:
+            return b''
+        return savefilesystem.getChainView(
+            self.dataRegion, self.fsHeader.blockSize, self.fat,
+            fileEntry.blockIndex, fileEntry.size, visit)
+
+    def readFile(self, fileEntry, index):
+        output = io.BytesIO()
+        self.dumpFile(fileEntry, index, output, visit=False)
+        return output.getvalue()
+
+    def dumpFile(self, fileEntry, index, file, visit=False):
+        """ Writes the content of a file entry to file, which can be None
+
+         With visit, the blocks are marked visited in the FAT for checking.
+        """
+        view = self.getFileView(fileEntry, index, visit)
+        if file is not None and len(view) != 0:
+            # Each extent is a run of contiguous blocks, written at once
+            for chunk in view.getChunks():
+                file.write(chunk)
+        stats.add("extract", bytes=len(view))
+
+    def extractFile(self, path, outputPath=None):
+        """ Extracts a single file to outputPath, or only reads it if it is None """
+        isDir, index = self.lookup(path)
+        if isDir:
+            raise IsADirectoryError(path)
+        with stats.stage("extract"):
+            if outputPath is None:
+                self.dumpFile(self.fileList[index], index, None)
+                return
+            with open(outputPath, 'wb') as file:
+                self.dumpFile(self.fileList[index], index, file)
+
+    def extractAll(self, outputDir, visit=False, store=None, writer=None):
+        """ Extracts all files to outputDir, or only reads them if it is None
+
+         With a blobstore.BlobStore, the content of each file goes to the store
+         and the output paths are linked to it. If the store doesn't make links,
+         the paths are only recorded in its manifest and nothing is created in
+         outputDir, which can then be None to record paths relative to the
+         root. With an archivewriter writer, the files are written to it
+         instead of outputDir.
+        """
+        with stats.stage("extract"):
+            outputDir = getStoreOutputDir(outputDir, store)
+            if store is None:
+                savefilesystem.extractAll(
+                    self.dirList, self.fileList, outputDir,
+                    lambda fileEntry, file, index: self.dumpFile(fileEntry, index, file, visit),
+                    writer=writer, index=self.getTreeIndex(),
+                    fileSize=lambda fileEntry, index: fileEntry.size)
+                return
+            savefilesystem.extractAll(
+                self.dirList, self.fileList, outputDir,
+                lambda fileEntry, filePath, index: store.save(
+                    filePath, lambda file: self.dumpFile(fileEntry, index, file, visit)),
+                openFiles=False, index=self.getTreeIndex(), createDirs=store.hardlink)
+
+
+class ExtdataArchive(SaveArchive):
+    """ An extdata, whose files are stored in DIFF subfiles """
+
+    dirCapacity = 126  # ???
+
+    def __init__(self, extdataDir, image, filesystemHeaderOff, saveId=None,
+                 decrypt=False, keyEngine=None, workers=1):
+        super().__init__(image, filesystemHeaderOff)
+        self.extdataDir = extdataDir
+        self.saveId = saveId
+        self.decrypt = decrypt
+        self.keyEngine = keyEngine
+        self.workers = workers
+
+    def getSubfileId(self, index):
+        fileId = index + 1
+        return fileId // self.dirCapacity, fileId % self.dirCapacity
+
+    def getSubfilePath(self, idHigh, idLow):
+        return os.path.join(self.extdataDir, "%08x" % idHigh, "%08x" % idLow)
+
+    def unwrapSubfile(self, fileEntry, index, lazy=False, workers=1):
+        idHigh, idLow = self.getSubfileId(index)
+        return unwrapDiff(self.getSubfilePath(idHigh, idLow),
+                          expectedUniqueId=fileEntry.uniqueId,
+                          saveType="extdata", saveId=self.saveId,
+                          saveSubId=(idHigh << 32) | idLow, decrypt=self.decrypt,
+                          keyEngine=self.keyEngine, lazy=lazy, workers=workers)
+
+    def getFileSize(self, fileEntry, index):
+        return len(self.unwrapSubfile(fileEntry, index, lazy=True).image)
+
+    def getFileView(self, fileEntry, index, visit=False):
+        return self.unwrapSubfile(fileEntry, index, lazy=True).image
+
+    def dumpFile(self, fileEntry, index, file, visit=False, workers=None):
+        content = self.unwrapSubfile(
+            fileEntry, index,
+            workers=self.workers if workers is None else workers).image
+        if file is not None:
+            file.write(content)
+        stats.add("extract", bytes=len(content))
+
+    def extractAll(self, outputDir, visit=False, store=None, writer=None):
+        """ Extracts all files to outputDir, or only reads them if it is None
+
+         With more than one worker, subfiles are unwrapped on a thread pool
+         while walking the directory tree, with a bounded number in flight.
+         See SaveArchive.extractAll for store and writer. The writer still
+         gets the files in order.
+        """
+        with stats.stage("extract"):
+            self.extractSubfiles(getStoreOutputDir(outputDir, store), store, writer)
+
+    def extractSubfiles(self, outputDir, store, writer):
+        def extFileDumper(fileEntry, file, index):
+            diagnostics.info("Extracting %s", fileEntry.getName())
+            self.dumpFile(fileEntry, index, file)
+
+        if self.workers <= 1 and store is None:
+            savefilesystem.extractAll(
+                self.dirList, self.fileList, outputDir, extFileDumper,
+                writer=writer, index=self.getTreeIndex())
+            return
+
+        def subfileDumper(fileEntry, filePath, index):
+            if store is not None:
+                store.save(filePath, lambda file: self.dumpFile(
+                    fileEntry, index, file, workers=1))
+                return
+            if filePath is None:
+                self.dumpFile(fileEntry, index, None, workers=1)
+                return
+            with open(filePath, 'wb') as file:
+                self.dumpFile(fileEntry, index, file, workers=1)
+
+        if self.workers <= 1:
+            def storeDumper(fileEntry, filePath, index):
+                diagnostics.info("Extracting %s", fileEntry.getName())
+                subfileDumper(fileEntry, filePath, index)
+            savefilesystem.extractAll(self.dirList, self.fileList, outputDir,
+                                      storeDumper, openFiles=False,
+                                      index=self.getTreeIndex(),
+                                      createDirs=store.hardlink)
+            return
+
+        def subfileReader(fileEntry, index):
+            output = io.BytesIO()
+            self.dumpFile(fileEntry, index, output, workers=1)
+            return output.getvalue()
+
+        pending = collections.deque()
+
+        def finishSubfile():
+            future, filePath = pending.popleft()
+            content = future.result()
+            if writer is not None:
+                writer.addFile(filePath, lambda file: file.write(content),
+                               len(content))
+
+        def extFilePipeliner(fileEntry, filePath, index):
+            diagnostics.info("Extracting %s", fileEntry.getName())
+            if writer is not None:
+                future = pool.submit(subfileReader, fileEntry, index)
+            else:
+                future = pool.submit(subfileDumper, fileEntry, filePath, index)
+            pending.append((future, filePath))
+            while len(pending) > self.workers * 2:
+                finishSubfile()
+
+        with concurrent.futures.ThreadPoolExecutor(self.workers) as pool:
+            savefilesystem.extractAll(self.dirList, self.fileList, outputDir,
+                                      extFilePipeliner, openFiles=False,
+                                      writer=writer, index=self.getTreeIndex(),
+                                      createDirs=store is None or store.hardlink)
+            while pending:
+                finishSubfile()
+
+
+class DiffImage(object):
+    """ The inner image of a single DIFF file """
+
+    def __init__(self, image, uniqueId, externalIVFCL4):
+        self.image = image
+        self.uniqueId = uniqueId
+        self.externalIVFCL4 = externalIVFCL4
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self.image = None
+
+    def open(self):
+        return io.BufferedReader(difi.ImageReader(self.image))
+
+
+DisaHeader = collections.namedtuple('DisaHeader', [
+    'header', 'partTable', 'hasData',
+    'partADiscriptorOff', 'partADiscriptorSize',
+    'partBDiscriptorOff', 'partBDiscriptorSize',
+    'partAOff', 'partASize', 'partBOff', 'partBSize', 'cmacVerified'])
+
+
+def readDisaHeader(file, saveType=None, saveId=None, keyEngine=None):
+    """ Reads the header and the partition table of a DISA file
+
+     Checks the CMAC if possible and the partition table hash. Only these
+     bytes are read, so for an encrypted file only they are decrypted.
+    """
+    Cmac, header = readHeader(file)
+    cmacVerified = False
+
+    if saveType is None:
+        diagnostics.info("No save type specified. Will skip CMAC verification.")
+    elif saveType == "nand" or saveType == "sd":
+        key = keyEngine.getKeySdNandCmac() if keyEngine is not None else None
+        if saveId is None:
+            diagnostics.info("No save ID specified. Will skip CMAC verification.")
+        elif key is None:
+            diagnostics.info(
+                "No enough secrets provided. Will skip CMAC verification.")
+        else:
+            checkCmac(Cmac, getDigestBlock(saveType, saveId, header), key)
+            cmacVerified = True
+    else:
+        diagnostics.info("Unsupported save type. Will skip CMAC verification.")
+
+    # Reads DISA header
+    DISA, ver, \
+        partCount, secPartTableOff, priPartTableOff, partTableSize, \
+        partADiscriptorOff, partADiscriptorSize, \
+        partBDiscriptorOff, partBDiscriptorSize, \
+        partAOff, partASize, partBOff, partBSize, \
+        activeTable, tableHash = struct.unpack(
+            '<III4xQQQQQQQQQQQB3x32s116x', header)
+
+    if DISA != 0x41534944:
+        raise errors.FormatError("Not a DISA format")
+
+    if ver != 0x00040000:
+        raise errors.FormatError("Wrong DISA version")
+
+    if partCount == 1:
+        hasData = False
+        diagnostics.info("No partition B")
+    elif partCount == 2:
+        hasData = True
+        diagnostics.info("Has partition B")
+    else:
+        raise errors.FormatError("Wrong partition count %d" % partCount)
+
+    if activeTable == 0:
+        partTableOff = priPartTableOff
+    elif activeTable == 1:
+        partTableOff = secPartTableOff
+    else:
+        raise errors.FormatError("Wrong active table ID %d" % activeTable)
+
+    # Verify partition table hash
+    file.seek(partTableOff, os.SEEK_SET)
+    partTable = file.read(partTableSize)
+
+    if hashlib.sha256(partTable).digest() != tableHash:
+        raise errors.FormatError("Partition table hash mismatch!")
+
+    return DisaHeader(header, partTable, hasData,
+                      partADiscriptorOff, partADiscriptorSize,
+                      partBDiscriptorOff, partBDiscriptorSize,
+                      partAOff, partASize, partBOff, partBSize, cmacVerified)
+
+
+def getDisaPartitions(image, disaHeader):
+    """ Returns (discriptor, partition) of partition A and, if present, B """
+    partitions = []
+    for discriptorOff, discriptorSize, partOff, partSize in (
+            (disaHeader.partADiscriptorOff, disaHeader.partADiscriptorSize,
+             disaHeader.partAOff, disaHeader.partASize),
+            (disaHeader.partBDiscriptorOff, disaHeader.partBDiscriptorSize,
+             disaHeader.partBOff, disaHeader.partBSize))[0: 2 if disaHeader.hasData else 1]:
+        partitions.append((
+            disaHeader.partTable[discriptorOff: discriptorOff + discriptorSize],
+            difi.ImageWindow(image, partOff, partSize)))
+    return partitions
+
+
+def readSaveHeader(image):
+    """ Reads the SAVE header of partition A. Returns the filesystem header offset """
+    SAVE, ver, filesystemHeaderOff, imageSize, imageBlockSize, x00 \
+        = struct.unpack('<IIQQII', image[0:0x20])
+
+    if SAVE != 0x45564153:
+        raise errors.FormatError("Wrong SAVE magic")
+
+    if ver != 0x00040000:
+        raise errors.FormatError("Wrong SAVE version")
+
+    if x00 != 0:
+        diagnostics.warning("unknown 0 = 0x%X in SAVE header", x00)
+
+    return filesystemHeaderOff
+
+
+def open_disa(file, saveType=None, saveId=None, decrypt=False, keyEngine=None,
+              lazy=True, workers=1, cache=None):
+    """ Opens a DISA save file as a SaveArchive
+
+     file is a path or a binary file object. saveType ("sd", "nand" or "card")
+     and saveId are needed for CMAC verification and for decrypting a SD save,
+     using the keys from keyEngine. With lazy, IVFC hashes are only verified for
+     the data that is read. Otherwise all hashes are verified upfront using the
+     given number of threads, which is also used for decryption. An encrypted
+     save is only decrypted where it is read, so a file object passed in must
+     stay open while the archive is used.
+
+     With a savecache.SaveCache, the verified partitions and the raw tables
+     are reused if the file is unchanged since it was cached. The header and
+     CMAC are still checked on every open.
+    """
+    identity = None
+    if cache is not None:
+        identity = savecache.getFileIdentity(file)
+    cacheKey = None
+
+    file, owned = openInput(file)
+    try:
+        if decrypt:
+            if saveType != "sd":
+                raise errors.ParameterError("only SD save supports decryption.")
+            file = cryptoUnwrap(file, getSdPath(saveType, saveId), keyEngine,
+                                workers)
+
+        disaHeader = readDisaHeader(file, saveType, saveId, keyEngine)
+        header = disaHeader.header
+
+        if identity is not None:
+            cacheKey = cache.getKey("disa", identity, decrypt,
+                                    saveId if decrypt else None, header)
+            cached = cache.load(cacheKey)
+            if cached is not None:
+                try:
+                    return SaveArchive(cached[0], readSaveHeader(cached[0]),
+                                       cached[1], cached[2])
+                except (ValueError, KeyError, errors.FormatError):
+                    diagnostics.warning("cache entry is damaged, dropping it")
+                    cache.remove(cacheKey)
+            # Only fully verified images are stored
+            lazy = False
+
+        image = difi.mapImage(file)
+        if isinstance(image, difi.FileImage):
+            # An encrypted save is decrypted as it is read, so it stays open
+            owned = False
+        partitions = getDisaPartitions(image, disaHeader)
+
+        # Unwraps SAVE image
+        partAInner, externalIVFCL4 = difi.unwrap(
+            partitions[0][0], partitions[0][1], lazy, workers)
+        if externalIVFCL4:
+            diagnostics.warning("partition A has an external IVFC level 4")
+
+        # Unwraps DATA image
+        partBInner = None
+        if disaHeader.hasData:
+            partBInner, externalIVFCL4 = difi.unwrap(
+                partitions[1][0], partitions[1][1], lazy, workers)
+            if not externalIVFCL4:
+                diagnostics.warning(
+                    "partition B does not have an external IVFC level 4")
+    finally:
+        if owned:
+            file.close()
+
+    archive = SaveArchive(partAInner, readSaveHeader(partAInner), partBInner)
+    if cacheKey is not None:
+        cache.store(cacheKey, partAInner, partBInner, archive.getTables())
+    return archive
+
+
+DiffHeader = collections.namedtuple('DiffHeader', [
+    'header', 'partTable', 'partOff', 'partSize', 'uniqueId', 'cmacVerified'])
+
+
+def readDiffHeader(file, expectedUniqueId=None, saveType=None, saveId=None,
+                   saveSubId=None, keyEngine=None):
+    """ Reads the header and the partition table of a DIFF file
+
+     Like readDisaHeader, only the header region is read.
+    """
+    key = keyEngine.getKeySdNandCmac() if keyEngine is not None else None
+
+    Cmac, header = readHeader(file)
+    cmacVerified = False
+
+    if key is None:
+        diagnostics.info(
+            "No enough secrets provided. Will skip CMAC verification.")
+    elif saveType is None:
+        diagnostics.info("No save type specified. Will skip CMAC verification.")
+    elif saveId is None:
+        diagnostics.info("No save ID specified. Will skip CMAC verification.")
+    elif saveType == "extdata" or saveType == "titledb":
+        checkCmac(Cmac, getDiffDigestBlock(
+            saveType, saveId, saveSubId, header), key)
+        cmacVerified = True
+    else:
+        diagnostics.info("Unknown save type. Will skip CMAC verification.")
+
+    DIFF, ver, \
+        secPartTableOff, priPartTableOff, partTableSize, \
+        partOff, partSize, \
+        activeTable, tableHash, uniqueId, \
+        = struct.unpack('<IIQQQQQI32sQ164x', header)
+
+    if DIFF != 0x46464944:
+        raise errors.FormatError("Not a DIFF format")
+
+    if ver != 0x00030000:
+        raise errors.FormatError("Wrong DIFF version")
+
+    if activeTable == 0:
+        partTableOff = priPartTableOff
+    elif activeTable == 1:
+        partTableOff = secPartTableOff
+    else:
+        raise errors.FormatError("Wrong active table ID %d" % activeTable)
+
+    diagnostics.info("Unique ID = %016X", uniqueId)
+    if expectedUniqueId is not None:
+        if expectedUniqueId != uniqueId:
+            diagnostics.warning("unique ID mismatch")
+
+    # Verify partition table hash
+    file.seek(partTableOff, os.SEEK_SET)
+    partTable = file.read(partTableSize)
+    if hashlib.sha256(partTable).digest() != tableHash:
+        raise errors.FormatError("Partition table hash mismatch!")
+
+    return DiffHeader(header, partTable, partOff, partSize, uniqueId,
+                      cmacVerified)
+
+
+def unwrapDiff(file, expectedUniqueId=None, saveType=None, saveId=None,
+               saveSubId=None, decrypt=False, keyEngine=None, lazy=False,
+               workers=1):
+    """ Unwraps a single DIFF file. Returns a DiffImage
+
+     saveType ("extdata" or "titledb"), saveId and saveSubId are needed for
+     CMAC verification and decryption. See open_diff for other parameters.
+    """
+    file, owned = openInput(file)
+    try:
+        if decrypt:
+            file = cryptoUnwrap(file, getSdPath(saveType, saveId, saveSubId),
+                                keyEngine, workers)
+
+        diffHeader = readDiffHeader(file, expectedUniqueId, saveType, saveId,
+                                    saveSubId, keyEngine)
+
+        # Reads and unwraps partition
+        fileImage = difi.mapImage(file)
+        if isinstance(fileImage, difi.FileImage):
+            # An encrypted file is decrypted as it is read, so it stays open
+            owned = False
+        part = difi.ImageWindow(fileImage, diffHeader.partOff, diffHeader.partSize)
+        image, externalIVFCL4 = difi.unwrap(
+            diffHeader.partTable, part, lazy, workers)
+        if externalIVFCL4:
+            diagnostics.info("external IVFC level 4")
+    finally:
+        if owned:
+            file.close()
+
+    return DiffImage(image, diffHeader.uniqueId, externalIVFCL4)
+
+
+def open_extdata(extdataDir, saveId=None, decrypt=False, keyEngine=None,
+                 workers=1):
+    """ Opens an extdata directory (extdata/<ExtdataID-High>/<ExtdataID-low>) """
+    vsxe = unwrapDiff(os.path.join(extdataDir, "00000000", "00000001"),
+                      saveType="extdata", saveId=saveId, saveSubId=1,
+                      decrypt=decrypt, keyEngine=keyEngine, lazy=True).image
+
+    # Reads VSXE header
+    VSXE, ver, filesystemHeaderOff, imageSize, imageBlockSize, x00, \
+        unk1, recentAction, unk2, recentId, unk3, recentPath \
+        = struct.unpack('<IIQQIIQIIII256s', vsxe[0:0x138])
+
+    if VSXE != 0x45585356:
+        raise errors.FormatError("Wrong VSXE magic")
+
+    if ver != 0x00030000:
+        raise errors.FormatError("Wrong VSXE version")
+
+    if x00 != 0:
+        diagnostics.warning("unknown 0 = 0x%X in VSXE header", x00)
+
+    diagnostics.info("unk1 = %d", unk1)
+    diagnostics.info("recent action = %d", recentAction)
+    diagnostics.info("unk2 = %d", unk2)
+    diagnostics.info("recent ID = %d", recentId)
+    diagnostics.info("unk3 = %d", unk3)
+    diagnostics.info("recentPath = %s",
+                     savefilesystem.trimBytes(recentPath).decode())
+
+    return ExtdataArchive(extdataDir, vsxe, filesystemHeaderOff, saveId,
+                          decrypt, keyEngine, workers)
+
+
+def open_diff(file, saveType=None, saveId=None, saveSubId=None, decrypt=False,
+              keyEngine=None, lazy=False, workers=1):
+    """ Opens an extdata directory as an ExtdataArchive, or a DIFF file as a DiffImage
+
+     file is a path or, for a single DIFF file, a binary file object. For
+     extdata, saveId is the extdata ID and the other save parameters are
+     ignored. See open_disa for the other parameters.
+    """
+    if isinstance(file, (str, bytes, os.PathLike)) and os.path.isdir(file):
+        return open_extdata(file, saveId, decrypt, keyEngine, workers)
+    return unwrapDiff(file, saveType=saveType, saveId=saveId,
+                      saveSubId=saveSubId, decrypt=decrypt,
+                      keyEngine=keyEngine, lazy=lazy, workers=workers)
+
+
+def check_disa(file, saveType=None, saveId=None, decrypt=False, keyEngine=None):
+    """ Checks only the CMAC and the partition table of a DISA file
+
+     Nothing beyond the header region is read, and only those bytes are
+     decrypted. Returns whether the CMAC was verified, which needs the save
+     type, the save ID and the keys. Raises errors.SaveError on failure.
+    """
+    file, owned = openInput(file)
+    try:
+        if decrypt:
+            if saveType != "sd":
+                raise errors.ParameterError("only SD save supports decryption.")
+            file = cryptoUnwrap(file, getSdPath(saveType, saveId), keyEngine)
+        return readDisaHeader(file, saveType, saveId, keyEngine).cmacVerified
+    finally:
+        if owned:
+            file.close()
+
+
+def check_diff(file, saveType=None, saveId=None, saveSubId=None, decrypt=False,
+               keyEngine=None):
+    """ Checks only the CMAC and the partition table of a DIFF file
+
+     See check_disa.
+    """
+    file, owned = openInput(file)
+    try:
+        if decrypt:
+            file = cryptoUnwrap(file, getSdPath(saveType, saveId, saveSubId),
+                                keyEngine)
+        return readDiffHeader(file, None, saveType, saveId, saveSubId,
+                              keyEngine).cmacVerified
+    finally:
+        if owned:
+            file.close()
+
+
+def check_extdata(extdataDir, saveId=None, decrypt=False, keyEngine=None):
+    """ Checks the CMAC and the partition table of every subfile of an extdata
+
+     Subfile IDs are taken from the file names. Returns a list of
+     (subfile path, whether the CMAC was verified). Raises errors.SaveError on
+     the first failure.
+    """
+    import savescan
+    results = []
+    for high in sorted(os.listdir(extdataDir)):
+        highDir = os.path.join(extdataDir, high)
+        if not savescan.isHexId(high) or not os.path.isdir(highDir):
+            continue  # Quota.dat and other stray entries
+        for low in sorted(os.listdir(highDir)):
+            path = os.path.join(highDir, low)
+            if not savescan.isHexId(low) or not os.path.isfile(path):
+                continue
+            saveSubId = (int(high, 16) << 32) | int(low, 16)
+            try:
+                results.append((path, check_diff(
+                    path, "extdata", saveId, saveSubId, decrypt, keyEngine)))
+            except errors.SaveError as e:
+                raise type(e)("%s: %s" % (os.path.join(high, low), e))
+    return results
+
+
+def readSnapshot(file, saveType, saveId, decrypt, keyEngine):
+    """ Opens each partition of an opened DISA file for reading on demand
+
+     Only the header and the DPFS selectors are read upfront. Everything
+     else is read, and decrypted with decrypt, when it is sliced, so file
+     must stay open while the partitions are used. Returns a list of
+     (discriptor, DPFS active data, inner image verified block by block).
+    """
+    import savewriter
+    sdFile = None
+    if decrypt:
+        if saveType != "sd":
+            raise errors.ParameterError("only SD save supports decryption.")
+        sdFile = cryptoUnwrap(file, getSdPath(saveType, saveId), keyEngine)
+    disaHeader = readDisaHeader(sdFile if sdFile is not None else file,
+                                saveType, saveId, keyEngine)
+    writers, _ = savewriter.getPartitionWriters(
+        savewriter.ContainerFile(file, sdFile), disaHeader)
+    return [(writer.discriptor, savewriter.ActiveImage(writer),
+             savewriter.InnerImage(writer)) for writer in writers]
+
+
+def getChangedBlocks(archive, changedRanges):
+    """ Converts changed ranges of the inner images to sorted data region block indices """
+    if len(changedRanges) > 1:  # files are in the DATA image
+        ranges, regionOff = changedRanges[1], 0
+    else:
+        ranges, regionOff = changedRanges[0], archive.fsHeader.dataRegionOff
+    blockSize = archive.fsHeader.blockSize
+    regionSize = len(archive.dataRegion)
+    blocks = []
+    for start, end in ranges:
+        start = max(start - regionOff, 0)
+        end = min(end - regionOff, regionSize)
+        if start < end:
+            blocks.extend(range(start // blockSize, (end - 1) // blockSize + 1))
+    return blocks
+
+
+def diff_disa(oldFile, newFile, saveType=None, saveId=None, decrypt=False,
+              keyEngine=None):
+    """ Lists the files that differ between two snapshots of a DISA save
+
+     The IVFC hash trees are compared top-down, only descending into blocks
+     whose hashes differ, and the changed blocks are mapped through the FAT to
+     files. Apart from the hash blocks on the compared paths, only the
+     filesystem tables, the FAT and the changed blocks are read and decrypted,
+     each through the DPFS selectors, so the cost follows the size of the
+     change. Blocks of the inner images are verified against their hashes as
+     they are read, but the hashes above them are only compared; open_disa
+     checks a snapshot in full.
+
+     Returns a list of (path, status) sorted by path, where status is "added",
+     "removed" or "modified".
+    """
+    oldFile, oldOwned = openInput(oldFile)
+    newFile, newOwned = openInput(newFile)
+    try:
+        return diffSnapshots(
+            readSnapshot(oldFile, saveType, saveId, decrypt, keyEngine),
+            readSnapshot(newFile, saveType, saveId, decrypt, keyEngine))
+    finally:
+        if oldOwned:
+            oldFile.close()
+        if newOwned:
+            newFile.close()
+
+
+def diffSnapshots(old, new):
+    """ Lists the changed files between partitions returned by readSnapshot """
+    archives = []
+    for partitions in (old, new):
+        partAInner = partitions[0][2]
+        archives.append(SaveArchive(
+            partAInner, readSaveHeader(partAInner),
+            partitions[1][2] if len(partitions) > 1 else None))
+    oldArchive, newArchive = archives
+
+    changedBlocks = None  # everything
+    layout = ('tableInDataRegion', 'blockSize', 'dataRegionOff')
+    if len(old) == len(new) and all(
+            getattr(oldArchive.fsHeader, name) ==
+            getattr(newArchive.fsHeader, name) for name in layout):
+        changedBlocks = getChangedBlocks(newArchive, [
+            difi.diffIVFC(oldDiscriptor, oldActive, newDiscriptor, newActive)
+            for (oldDiscriptor, oldActive, _), (newDiscriptor, newActive, _)
+            in zip(old, new)])
+
+    def isModified(oldEntry, newEntry):
+        if oldEntry.size != newEntry.size:
+            return True
+        if newEntry.size == 0:
+            return False
+        extents = newArchive.fat.getExtents(newEntry.blockIndex, visit=False)
+        if changedBlocks is None or extents != oldArchive.fat.getExtents(
+                oldEntry.blockIndex, visit=False):
+            return True
+        # Hashes cover IVFC blocks, which can be larger than filesystem blocks,
+        # so the file's own bytes in the changed blocks are compared
+        blockSize = newArchive.fsHeader.blockSize
+        fileOff = 0
+        for blockIndex, count in extents:
+            i = bisect.bisect_left(changedBlocks, blockIndex)
+            while i < len(changedBlocks) and changedBlocks[i] < blockIndex + count:
+                block = changedBlocks[i]
+                start = block * blockSize
+                size = min(blockSize, newEntry.size - fileOff -
+                           (block - blockIndex) * blockSize)
+                if size > 0 and oldArchive.dataRegion[start: start + size] != \
+                        newArchive.dataRegion[start: start + size]:
+                    return True
+                i += 1
+            fileOff += count * blockSize
+        return False
+
+    oldFiles = dict(oldArchive.walkFiles())
+    newFiles = dict(newArchive.walkFiles())
+    changes = []
+    for path in sorted(set(oldFiles) | set(newFiles)):
+        if path not in newFiles:
+            changes.append((path, "removed"))
+        elif path not in oldFiles:
+            changes.append((path, "added"))
+        elif isModified(oldArchive.fileList[oldFiles[path]],
+                        newArchive.fileList[newFiles[path]]):
+            changes.append((path, "modified"))
+    return changes
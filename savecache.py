@@ -0,0 +1,183 @@
+# Python 3
+
+""" An on-disk cache of unwrapped save partitions
+
+ Each entry holds the fully verified partition images of a save and its
+ filesystem tables as raw bytes, so opening an unchanged save again skips
+ decryption, DPFS/IVFC unwrapping and walking the tables. Entries are evicted
+ least recently used first when the cache grows over its size cap.
+
+ The tables file is a JSON line naming each table and its size, followed by
+ the tables. Nothing in the cache is run as code, but its content is trusted
+ as verified, so the directory must not be writable by other users.
+"""
+
+import hashlib
+import json
+import os
+import os.path
+import stat
+import tempfile
+
+import difi
+import errors
+
+
+def getFileIdentity(file):
+    """ Gets (size, mtime, inode, device) of a path or an opened file, or None
+
+     The identity changes whenever the file is rewritten in place or replaced.
+    """
+    try:
+        if isinstance(file, (str, bytes, os.PathLike)):
+            st = os.stat(file)
+        else:
+            st = os.fstat(file.fileno())
+    except (OSError, AttributeError, ValueError):
+        return None
+    return (st.st_size, st.st_mtime_ns, st.st_ino, st.st_dev)
+
+
+class SaveCache(object):
+    """ A cache directory of unwrapped partitions, capped at maxSize bytes """
+
+    suffixes = ('.a', '.b', '.tables')
+    version = 3  # of the tables file, changing it drops older entries
+
+    def __init__(self, cacheDir, maxSize=1 << 30):
+        self.cacheDir = cacheDir
+        self.maxSize = maxSize
+        os.makedirs(cacheDir, mode=0o700, exist_ok=True)
+        st = os.stat(cacheDir)
+        if st.st_mode & (stat.S_IWGRP | stat.S_IWOTH):
+            raise errors.ParameterError(
+                "cache directory %s is writable by other users" % cacheDir)
+        if hasattr(os, 'getuid') and st.st_uid != os.getuid():
+            raise errors.ParameterError(
+                "cache directory %s belongs to another user" % cacheDir)
+
+    def getKey(self, *parts):
+        """ Builds an entry key from the file identity and header fields """
+        hash = hashlib.sha256()
+        for part in (self.version,) + parts:
+            if not isinstance(part, bytes):
+                part = repr(part).encode()
+            hash.update(len(part).to_bytes(8, 'little'))
+            hash.update(part)
+        return hash.hexdigest()
+
+    def getPath(self, key, suffix):
+        return os.path.join(self.cacheDir, key + suffix)
+
+    def load(self, key):
+        """ Returns (partA, partB, tables) for key, or None on a miss
+
+         The partition images are memory-mapped from the cache files, and
+         tables maps each table name to its bytes.
+        """
+        tablesPath = self.getPath(key, '.tables')
+        try:
+            with open(tablesPath, 'rb') as file:
+                hasData, tables = self.readTables(file.read())
+            with open(self.getPath(key, '.a'), 'rb') as file:
+                partA = difi.mapImage(file)
+            partB = None
+            if hasData:
+                with open(self.getPath(key, '.b'), 'rb') as file:
+                    partB = difi.mapImage(file)
+        except (OSError, ValueError, KeyError, TypeError):
+            return None
+        # Marks the entry as recently used
+        try:
+            os.utime(tablesPath)
+        except OSError:
+            pass
+        return partA, partB, tables
+
+    def store(self, key, partA, partB, tables):
+        """ Stores an entry then evicts old entries over the size cap """
+        self.writeFile(self.getPath(key, '.a'), partA)
+        if partB is not None:
+            self.writeFile(self.getPath(key, '.b'), partB)
+        # The tables file is written last and marks the entry as complete
+        self.writeFile(self.getPath(key, '.tables'),
+                       self.packTables(partB is not None, tables))
+        self.evict()
+
+    def packTables(self, hasData, tables):
+        names = sorted(tables)
+        header = json.dumps({'version': self.version, 'hasData': hasData,
+                             'tables': [[name, len(tables[name])] for name in names]})
+        return b''.join([header.encode(), b'\n'] + [tables[name] for name in names])
+
+    def readTables(self, data):
+        """ Splits a tables file into (hasData, tables). Raises ValueError if it
+         is malformed
+        """
+        header, _, body = data.partition(b'\n')
+        header = json.loads(header)
+        if not isinstance(header, dict) or header.get('version') != self.version:
+            raise ValueError("unknown tables version")
+        tables = {}
+        pos = 0
+        for name, size in header['tables']:
+            if not isinstance(name, str) or not isinstance(size, int) or size < 0:
+                raise ValueError("malformed table list")
+            tables[name] = body[pos: pos + size]
+            pos += size
+        if pos != len(body):
+            raise ValueError("tables file size mismatch")
+        return bool(header['hasData']), tables
+
+    def writeFile(self, path, data):
+        # Writes to a temporary file first so readers never see a partial file
+        fd, tempPath = tempfile.mkstemp(dir=self.cacheDir, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as file:
+                file.write(data)
+            os.replace(tempPath, path)
+        except BaseException:
+            os.unlink(tempPath)
+            raise
+
+    def getEntries(self):
+        """ Returns (last use time, total size, key) of each complete entry """
+        entries = []
+        for name in os.listdir(self.cacheDir):
+            if not name.endswith('.tables'):
+                continue
+            key = name[:-len('.tables')]
+            try:
+                lastUse = os.stat(self.getPath(key, '.tables')).st_mtime_ns
+            except OSError:
+                continue
+            size = 0
+            for suffix in self.suffixes:
+                try:
+                    size += os.stat(self.getPath(key, suffix)).st_size
+                except OSError:
+                    pass
+            entries.append((lastUse, size, key))
+        return entries
+
+    def evict(self):
+        """ Removes least recently used entries until the cache fits maxSize """
+        entries = sorted(self.getEntries())
+        total = sum(size for _, size, _ in entries)
+        for _, size, key in entries:
+            if total <= self.maxSize:
+                break
+            self.remove(key)
+            total -= size
+
+    def remove(self, key):
+        # Removes the tables file first so the entry stops being complete
+        for suffix in reversed(self.suffixes):
+            try:
+                os.unlink(self.getPath(key, suffix))
+            except OSError:
+                pass
+
+    def clear(self):
+        for _, _, key in self.getEntries():
+            self.remove(key)
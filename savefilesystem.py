@@ -1,6 +1,13 @@
+import array
+import bisect
 import os
 import os.path
+import re
 import struct
+import sys
+
+import diagnostics
+import stats
 
 
 def trimBytes(bs):
@@ -21,14 +28,14 @@ class Header(object):
             = struct.unpack('<IIQI4xQI4xQI4xQI4x', raw[0: 0x48])
 
         if x00 != 0:
-            print("Warning: unknown 0 = 0x%X in filesystem header" % x00)
+            diagnostics.warning("unknown 0 = 0x%X in filesystem header", x00)
 
-        print("Info: dirHashTableSize = %d" % self.dirHashTableSize)
-        print("Info: fileHashTableSize = %d" % self.fileHashTableSize)
-        print("Info: fatSize = %d" % self.fatSize)
-        print("Info: dataRegionSize = %d" % self.dataRegionSize)
+        diagnostics.info("dirHashTableSize = %d", self.dirHashTableSize)
+        diagnostics.info("fileHashTableSize = %d", self.fileHashTableSize)
+        diagnostics.info("fatSize = %d", self.fatSize)
+        diagnostics.info("dataRegionSize = %d", self.dataRegionSize)
         if self.fatSize != self.dataRegionSize:
-            printf("Warning: fatSize != dataRegionSize")
+            diagnostics.warning("fatSize != dataRegionSize")
 
         if not hasData:
             self.dirTableBlockIndex, self.dirTableBlockCount, self.dirMaxCount, \
@@ -37,201 +44,307 @@ class Header(object):
             self.dirTableOff = 0
             self.fileTableOff = 0
             self.tableInDataRegion = True
-            print("Info: dirTableBlockCount = %d" % self.dirTableBlockCount)
-            print("Info: fileTableBlockCount = %d" % self.fileTableBlockCount)
+            diagnostics.info("dirTableBlockCount = %d", self.dirTableBlockCount)
+            diagnostics.info("fileTableBlockCount = %d", self.fileTableBlockCount)
         else:
             self.dirTableOff, self.dirMaxCount, \
                 self.fileTableOff, self.fileMaxCount, \
                 = struct.unpack('<QI4xQI4x', raw[0x48:0x68])
             self.tableInDataRegion = False
 
-        print("Info: dirMaxCount = %d" % self.dirMaxCount)
-        print("Info: fileMaxCount = %d" % self.fileMaxCount)
+        diagnostics.info("dirMaxCount = %d", self.dirMaxCount)
+        diagnostics.info("fileMaxCount = %d", self.fileMaxCount)
+
+
+def getEntryHash(parentIndex, name):
+    """ Hashes an entry by its parent index and its 16-byte raw name """
+    hash = parentIndex ^ 0x091A2B3C
+    for i in range(4):
+        hash = ((hash >> 1) | (hash << 31)) & 0xFFFFFFFF
+        hash ^= name[i * 4]
+        hash ^= name[i * 4 + 1] << 8
+        hash ^= name[i * 4 + 2] << 16
+        hash ^= name[i * 4 + 3] << 24
+    return hash
 
 
 class HashableEntry(object):
-    """ A common hash function for directory and file entries """
+    """ A common hash function for directory and file entries
+
+     Dummy entries reuse the first fields as count and max count, and the
+     last field as the next dummy index.
+    """
 
     def getHash(self):
-        hash = self.parentIndex ^ 0x091A2B3C
-        for i in range(4):
-            hash = ((hash >> 1) | (hash << 31)) & 0xFFFFFFFF
-            hash ^= self.name[i * 4]
-            hash ^= self.name[i * 4 + 1] << 8
-            hash ^= self.name[i * 4 + 2] << 16
-            hash ^= self.name[i * 4 + 3] << 24
-        return hash
+        return getEntryHash(self.parentIndex, self.name)
+
+    @property
+    def count(self):
+        return self.parentIndex
+
+    @property
+    def maxCount(self):
+        return int.from_bytes(self.name[0:4], 'little')
+
+    @property
+    def nextDummyIndex(self):
+        return self.nextCollision
+
+    def formatDummyEntry(self, i):
+        return "[%3d]~~Dummy~~ count=%3d max=%3d next=%3d" % (
+            i, self.count, self.maxCount, self.nextDummyIndex)
+
+    def getDummyRecord(self, i):
+        return {"index": i, "dummy": True, "count": self.count,
+                "maxCount": self.maxCount, "next": self.nextDummyIndex}
 
 
 class DirEntry(HashableEntry):
     """ Directory table entry """
 
-    def __init__(self, raw):
-        # Reads normal entry data
+    format = '<I16sIIIII'
+    fields = ('parentIndex', 'name', 'nextIndex', 'firstDirIndex',
+              'firstFileIndex', 'unknown', 'nextCollision')
+
+    def __init__(self, values, isDummy=False):
+        # Normal entry data, unpacked with format
         self.parentIndex, self.name, \
             self.nextIndex, self.firstDirIndex, self.firstFileIndex, \
             self.unknown, self.nextCollision \
-            = struct.unpack('<I16sIIIII', raw)
-
-        if self.unknown != 0:
-            print("Warning: unknown = %d" % self.unknown)
+            = values
 
-        # Reads dummy entry data
-        self.count, self.maxCount, self.nextDummyIndex \
-            = struct.unpack('<II28xI', raw)
-
-        self.isDummy = False  # will be set later
+        self.isDummy = isDummy
 
     def getName(self):
         return trimBytes(self.name).decode()
 
-    def printEntry(self, i):
+    def formatEntry(self, i):
+        """ Formats the entry as a line of a directory listing """
         if self.isDummy:
-            print("[%3d]~~Dummy~~ count=%3d max=%3d next=%3d" % (
-                i, self.count, self.maxCount,
-                self.nextDummyIndex))
-        else:
-            print("[%3d]parent=%3d '%16s' next=%3d child=%3d"
-                  " file=%3d collision=%3d unknown=%d" % (
-                      i, self.parentIndex, self.getName(),
-                      self.nextIndex, self.firstDirIndex,
-                      self.firstFileIndex,
-                      self.nextCollision, self.unknown))
+            return self.formatDummyEntry(i)
+        return ("[%3d]parent=%3d '%16s' next=%3d child=%3d"
+                " file=%3d collision=%3d unknown=%d" % (
+                    i, self.parentIndex, self.getName(),
+                    self.nextIndex, self.firstDirIndex,
+                    self.firstFileIndex,
+                    self.nextCollision, self.unknown))
+
+    def getRecord(self, i):
+        """ Returns the entry as a dict, for structured listings """
+        if self.isDummy:
+            return self.getDummyRecord(i)
+        return {"index": i, "parent": self.parentIndex, "name": self.getName(),
+                "next": self.nextIndex, "child": self.firstDirIndex,
+                "file": self.firstFileIndex, "collision": self.nextCollision,
+                "unknown": self.unknown}
 
 
 class FileEntry(HashableEntry):
     """ File table entry """
 
-    def __init__(self, raw):
-        # Reads normal entry data
+    format = '<I16sI4xIQII'
+    fields = ('parentIndex', 'name', 'nextIndex', 'blockIndex', 'size', 'u2',
+              'nextCollision')
+
+    def __init__(self, values, isDummy=False):
+        # Normal entry data, unpacked with format
         self.parentIndex, self.name, \
             self.nextIndex, self.blockIndex, self.size, \
             self.u2, self.nextCollision \
-            = struct.unpack('<I16sI4xIQII', raw)
+            = values
 
         # for extdata
         self.uniqueId = self.size
 
-        # Reads dummy entry data
-        self.count, self.maxCount, self.nextDummyIndex \
-            = struct.unpack('<II36xI', raw)
-
-        self.isDummy = False  # will be set later
+        self.isDummy = isDummy
 
     def getName(self):
         return trimBytes(self.name).decode()
 
-    def printDummyEntry(self, i):
-        print("[%3d]~~Dummy~~ count=%3d max=%3d next=%3d" % (
-            i, self.count, self.maxCount,
-            self.nextDummyIndex))
-
-    def printEntryAsSave(self, i):
+    def formatEntryAsSave(self, i):
+        """ Formats the entry as a line of a file listing of a save """
         if self.isDummy:
-            self.printDummyEntry(i)
-        else:
-            print("[%3d]parent=%3d '%16s' next=%3d collision=%3d"
-                  " size=%10d block=%5d unknown=%10d" % (
-                      i, self.parentIndex, self.getName(),
-                      self.nextIndex, self.nextCollision,
-                      self.size, self.blockIndex, self.u2))
-
-    def printEntryAsExtdata(self, i):
+            return self.formatDummyEntry(i)
+        return ("[%3d]parent=%3d '%16s' next=%3d collision=%3d"
+                " size=%10d block=%5d unknown=%10d" % (
+                    i, self.parentIndex, self.getName(),
+                    self.nextIndex, self.nextCollision,
+                    self.size, self.blockIndex, self.u2))
+
+    def formatEntryAsExtdata(self, i):
+        """ Formats the entry as a line of a file listing of an extdata """
+        if self.isDummy:
+            return self.formatDummyEntry(i)
+        return ("[%3d]parent=%3d '%16s' next=%3d collision=%3d"
+                " ID=0x%016X unknown=%10d" % (
+                    i, self.parentIndex, self.getName(),
+                    self.nextIndex, self.nextCollision,
+                    self.uniqueId, self.u2))
+
+    def getRecord(self, i, asExtdata=False):
+        """ Returns the entry as a dict, for structured listings """
         if self.isDummy:
-            self.printDummyEntry(i)
+            return self.getDummyRecord(i)
+        record = {"index": i, "parent": self.parentIndex, "name": self.getName(),
+                  "next": self.nextIndex, "collision": self.nextCollision,
+                  "unknown": self.u2}
+        if asExtdata:
+            record["id"] = self.uniqueId
         else:
-            print("[%3d]parent=%3d '%16s' next=%3d collision=%3d"
-                  " ID=0x%016X unknown=%10d" % (
-                      i, self.parentIndex, self.getName(),
-                      self.nextIndex, self.nextCollision,
-                      self.uniqueId, self.u2))
+            record["size"] = self.size
+            record["block"] = self.blockIndex
+        return record
 
 
-class FATEntry(object):
-    """ FAT entry """
+# Array type code of u32
+U32_TYPE = 'I' if array.array('I').itemsize == 4 else 'L'
 
-    def __init__(self, raw):
-        self.u, self.v = struct.unpack('II', raw)
-        if self.u >= 0x80000000:
-            self.u -= 0x80000000
-            self.uFlag = True
-        else:
-            self.uFlag = False
-        if self.v >= 0x80000000:
-            self.v -= 0x80000000
-            self.vFlag = True
-        else:
-            self.vFlag = False
-
-        self.visited = False
+# Byte translation tables splitting the top byte of a u32 into flag and index
+FLAG_TABLE = bytes(i >> 7 for i in range(0x100))
+INDEX_TABLE = bytes(i & 0x7F for i in range(0x100))
 
 
 class FAT(object):
-    def __init__(self, fsHeader, partitionImage):
-        self.fatList = []
-        for i in range(0, fsHeader.fatSize + 1):  # the actual FAT size is one larger
-            self.fatList.append(FATEntry(
-                partitionImage[fsHeader.fatOff + i * 8: fsHeader.fatOff + (i + 1) * 8]))
-
-    def walk(self, start, blockHandler):
+    """ File allocation table
+
+     Entries are stored as packed arrays: u and v hold the indices with the
+     flags stripped, uFlag and vFlag hold one 0/1 byte per entry, and visited
+     marks the entries walked so far. With tables from getTables, the arrays
+     are loaded from them instead of the image.
+    """
+
+    def __init__(self, fsHeader, partitionImage, tables=None):
+        count = fsHeader.fatSize + 1  # the actual FAT size is one larger
+        if tables is not None:
+            self.u = array.array(U32_TYPE, tables['fatU'])
+            self.v = array.array(U32_TYPE, tables['fatV'])
+            self.uFlag = bytes(tables['fatUFlag'])
+            self.vFlag = bytes(tables['fatVFlag'])
+            self.visited = bytearray(tables['fatVisited'])
+            if not (len(self.u) == len(self.v) == len(self.uFlag) ==
+                    len(self.vFlag) == len(self.visited) == count):
+                raise ValueError("FAT tables don't match the FAT size")
+            return
+        with stats.stage("fat", count * 8):
+            raw = bytearray(partitionImage[fsHeader.fatOff: fsHeader.fatOff + count * 8])
+            self.uFlag = raw[3::8].translate(FLAG_TABLE)
+            self.vFlag = raw[7::8].translate(FLAG_TABLE)
+            raw[3::8] = raw[3::8].translate(INDEX_TABLE)
+            raw[7::8] = raw[7::8].translate(INDEX_TABLE)
+            entries = array.array(U32_TYPE)
+            entries.frombytes(raw)
+            if sys.byteorder != 'little':
+                entries.byteswap()
+            self.u = entries[0::2]
+            self.v = entries[1::2]
+            self.visited = bytearray(count)
+
+    def getTables(self):
+        """ Returns the arrays as raw bytes, which can be passed back as tables """
+        return {'fatU': self.u.tobytes(), 'fatV': self.v.tobytes(),
+                'fatUFlag': bytes(self.uFlag), 'fatVFlag': bytes(self.vFlag),
+                'fatVisited': bytes(self.visited)}
+
+    def walkNodes(self, start):
+        """ Yields the first and the last entry index of each node in a chain
+
+         A chain with more blocks than the FAT is a cycle, and is cut there.
+        """
+        u, v, uFlag, vFlag = self.u, self.v, self.uFlag, self.vFlag
         start += 1  # shift index
         current = start
         previous = 0
+        blocksLeft = len(u) - 1
         while current != 0:
             if current == start:
-                if not self.fatList[current].uFlag:
-                    print("Warning: first node not marked start @ %i" % current)
+                if not uFlag[current]:
+                    diagnostics.warning("first node not marked start @ %i", current)
             else:
-                if self.fatList[current].uFlag:
-                    print("Warning: other node marked start @ %i" % current)
-            if self.fatList[current].u != previous:
-                print("Warning: previous node mismatch @ %i" % current)
-
-            if self.fatList[current].vFlag:
-                nodeEnd = self.fatList[current + 1].v
-                if self.fatList[current + 1].u != current:
-                    print("Warning: expansion node first block mismatch @ %i" %
-                          (current + 1))
-                if not self.fatList[current + 1].uFlag:
-                    print("Warning: expansion node first block not marked @ %i" % (
-                        current + 1))
-                if self.fatList[current + 1].vFlag:
-                    print("Warning: expansion node first block with wrong mark @ %i" % (
-                        current + 1))
-                if self.fatList[nodeEnd].u != current or \
-                        self.fatList[nodeEnd].v != nodeEnd:
-                    print("Warning: expansion node last block mismatch @ %i" % nodeEnd)
-                if not self.fatList[nodeEnd].uFlag:
-                    print(
-                        "Warning: expansion node first block not marked @ %i" % nodeEnd)
-                if self.fatList[nodeEnd].vFlag:
-                    print(
-                        "Warning: expansion node last block with wrong mark @ %i" % nodeEnd)
+                if uFlag[current]:
+                    diagnostics.warning("other node marked start @ %i", current)
+            if u[current] != previous:
+                diagnostics.warning("previous node mismatch @ %i", current)
+
+            if vFlag[current]:
+                nodeEnd = v[current + 1]
+                if u[current + 1] != current:
+                    diagnostics.warning("expansion node first block mismatch @ %i",
+                                        current + 1)
+                if not uFlag[current + 1]:
+                    diagnostics.warning("expansion node first block not marked @ %i",
+                                        current + 1)
+                if vFlag[current + 1]:
+                    diagnostics.warning("expansion node first block with wrong mark @ %i",
+                                        current + 1)
+                if u[nodeEnd] != current or v[nodeEnd] != nodeEnd:
+                    diagnostics.warning("expansion node last block mismatch @ %i", nodeEnd)
+                if not uFlag[nodeEnd]:
+                    diagnostics.warning(
+                        "expansion node first block not marked @ %i", nodeEnd)
+                if vFlag[nodeEnd]:
+                    diagnostics.warning(
+                        "expansion node last block with wrong mark @ %i", nodeEnd)
             else:
                 nodeEnd = current
 
-            for i in range(current, nodeEnd + 1):
-                if self.fatList[i].visited:
-                    print("Warning: already visited @ %i" % i)
-                blockHandler(i - 1)  # shift index back
-                self.fatList[i].visited = True
+            blocksLeft -= max(1, nodeEnd + 1 - current)
+            if blocksLeft < 0:
+                diagnostics.warning("chain longer than the FAT @ %i", current)
+                return
+
+            yield current, nodeEnd
 
             previous = current
-            current = self.fatList[current].v
+            current = v[current]
+
+    def walk(self, start, blockHandler):
+        visited = self.visited
+        for current, nodeEnd in self.walkNodes(start):
+            if visited.find(1, current, nodeEnd + 1) == -1:
+                for i in range(current, nodeEnd + 1):
+                    blockHandler(i - 1)  # shift index back
+                visited[current: nodeEnd + 1] = b'\x01' * (nodeEnd + 1 - current)
+            else:
+                for i in range(current, nodeEnd + 1):
+                    if visited[i]:
+                        diagnostics.warning("already visited @ %i", i)
+                    blockHandler(i - 1)  # shift index back
+                    visited[i] = 1
+
+    def getExtents(self, start, visit=True):
+        """ Walks a chain and returns it as a list of (block index, block count)
+
+         With visit, blocks are marked visited like walk does. Otherwise the
+         walk doesn't leave any trace, so a chain can be read many times.
+        """
+        visited = self.visited
+        extents = []
+        for current, nodeEnd in self.walkNodes(start):
+            if nodeEnd < current:
+                continue
+            if visit:
+                i = visited.find(1, current, nodeEnd + 1)
+                while i != -1:
+                    diagnostics.warning("already visited @ %i", i)
+                    i = visited.find(1, i + 1, nodeEnd + 1)
+                visited[current: nodeEnd + 1] = b'\x01' * (nodeEnd + 1 - current)
+            extents.append((current - 1, nodeEnd + 1 - current))  # shift index back
+        return extents
 
     def visitFreeBlock(self):
-        self.fatList[0].visited = True
-        if self.fatList[0].u != 0:
-            print("Warning: free leading block has u = %d" % fatList[0].u)
-        if self.fatList[0].uFlag or self.fatList[0].vFlag:
-            print("Warning: free leading block has flag set")
-        start = self.fatList[0].v
+        self.visited[0] = 1
+        if self.u[0] != 0:
+            diagnostics.warning("free leading block has u = %d", self.u[0])
+        if self.uFlag[0] or self.vFlag[0]:
+            diagnostics.warning("free leading block has flag set")
+        start = self.v[0]
         self.walk(start - 1, lambda _: None)
 
     def allVisited(self):
-        for i in range(len(self.fatList)):
-            if not self.fatList[i].visited:
-                print("Warning: block %d not visited" % i)
+        i = self.visited.find(0)
+        while i != -1:
+            diagnostics.warning("block %d not visited", i)
+            i = self.visited.find(0, i + 1)
 
 
 def getHashTable(offset, size, partitionImage):
@@ -242,33 +355,162 @@ def getHashTable(offset, size, partitionImage):
     return hashTable
 
 
-def scanDummyEntry(list):
-    list[0].isDummy = True
-    i = list[0].nextDummyIndex
-    count = list[0].count
-    maxCount = list[0].maxCount
-    while i != 0:
-        if list[i].count != count or list[i].maxCount != maxCount:
-            print("Warning: dummy entries have different content")
-        list[i].isDummy = True
-        i = list[i].nextDummyIndex
+COLUMN_TYPES = {'I': U32_TYPE, 'Q': 'Q', 's': None}
+
+
+class EntryTable(object):
+    """ A directory or file entry table, parsed in one step into columns
+
+     columns maps each field of entryClass to a column indexed by entry index:
+     a list for names and an array for integers. isDummy has 1 for each dummy
+     entry. The columns are the only copy of the table, and indexing builds a
+     DirEntry or FileEntry from them, so only the entries that are used become
+     objects. raw can be any buffer and is not kept.
+    """
+
+    def __init__(self, entryClass, raw):
+        self.entryClass = entryClass
+        entrySize = struct.calcsize(entryClass.format)
+        self.count = len(raw) // entrySize
+        if len(raw) != self.count * entrySize:
+            raw = raw[0: self.count * entrySize]
+        codes = [code for _, code in re.findall(r'(\d*)([a-zA-Z])', entryClass.format)
+                 if code != 'x']
+        values = list(zip(*struct.iter_unpack(entryClass.format, raw)))
+        self.columns = {}
+        for i, field in enumerate(entryClass.fields):
+            column = values[i] if values else ()
+            columnType = COLUMN_TYPES[codes[i]]
+            if columnType is None:
+                self.columns[field] = list(column)
+            else:
+                self.columns[field] = array.array(columnType, column)
+        self.fieldColumns = [self.columns[field] for field in entryClass.fields]
+        self.isDummy = self.getDummyMask()
+
+    def getDummyMask(self):
+        """ Marks entry 0 and the entries chained from it as dummies """
+        if self.count == 0:
+            # A truncated table doesn't even have entry 0
+            return bytearray()
+        counts = self.columns['parentIndex']
+        names = self.columns['name']
+        nextDummies = self.columns['nextCollision']
+        mask = bytearray(self.count)
+        mask[0] = 1
+        i = nextDummies[0]
+        while i != 0:
+            if i >= self.count or mask[i]:
+                diagnostics.warning("dummy chain broken @ %d", i)
+                break
+            # Count and max count are the parent index and the start of the name
+            if counts[i] != counts[0] or names[i][0:4] != names[0][0:4]:
+                diagnostics.warning("dummy entries have different content")
+            mask[i] = 1
+            i = nextDummies[i]
+        return mask
+
+    def tobytes(self):
+        """ Packs the table back into its raw form """
+        pack = struct.Struct(self.entryClass.format).pack
+        return b''.join(pack(*values) for values in zip(*self.fieldColumns))
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(self.count))]
+        if index < 0:
+            index += self.count
+        if not 0 <= index < self.count:
+            raise IndexError("entry index out of range")
+        return self.entryClass([column[index] for column in self.fieldColumns],
+                               self.isDummy[index] != 0)
+
+    def __iter__(self):
+        for i in range(self.count):
+            yield self[i]
+
+
+def getEntryTable(entryClass, data, offset):
+    """ Parses the table at offset, whose entry 0 holds the entry count
+
+     The table is unpacked straight from the slice of data, which only copies
+     when it spans several extents.
+    """
+    entrySize = struct.calcsize(entryClass.format)
+    count = max(1, struct.unpack('<I', data[offset: offset + 4])[0])
+    return EntryTable(entryClass, data[offset: offset + count * entrySize])
+
+
+class ExtentView(object):
+    """ Runs of blocks of an image, sliced as one contiguous image
+
+     extents is a list of (block index, block count). Slicing only gathers
+     the blocks in range, and a slice within one extent is passed through to
+     the image, so slices of an ImageWindow over a buffer don't copy.
+    """
+
+    def __init__(self, image, blockSize, extents, size):
+        self.image = image
+        self.starts = []
+        self.offsets = []
+        pos = 0
+        for blockIndex, count in extents:
+            self.starts.append(pos)
+            self.offsets.append(blockIndex * blockSize)
+            pos += count * blockSize
+        self.size = min(size, pos)
+
+    def __len__(self):
+        return self.size
+
+    def __getitem__(self, key):
+        start, stop, _ = key.indices(self.size)
+        parts = []
+        i = bisect.bisect_right(self.starts, start) - 1
+        while start < stop:
+            extentEnd = self.starts[i + 1] if i + 1 < len(self.starts) else self.size
+            end = min(stop, extentEnd)
+            off = self.offsets[i] + start - self.starts[i]
+            parts.append(self.image[off: off + end - start])
+            start = end
+            i += 1
+        if len(parts) == 1:
+            return parts[0]
+        return b''.join(parts)
+
+    def getChunks(self):
+        """ Yields the content of each extent in order """
+        for i in range(len(self.starts)):
+            end = self.starts[i + 1] if i + 1 < len(self.starts) else self.size
+            if end > self.starts[i]:
+                yield self.image[self.offsets[i]: self.offsets[i] + end - self.starts[i]]
+
+
+def getChainView(dataRegion, blockSize, fat, index, size, visit=True):
+    """ Returns an ExtentView of the first size bytes of a chain in the data region
+
+     With visit, the blocks are marked visited in the FAT.
+    """
+    extents = []
+    left = (size + blockSize - 1) // blockSize
+    for blockIndex, count in fat.getExtents(index, visit):
+        usedCount = min(left, count)
+        for _ in range(count - usedCount):
+            diagnostics.warning("excessive block")
+        if usedCount != 0:
+            extents.append((blockIndex, usedCount))
+        left -= usedCount
+    if left != 0:
+        diagnostics.warning("not enough block")
+    return ExtentView(dataRegion, blockSize, extents, size)
 
 
 def getAllocatedList(dataRegion, blockSize, fat, index, count):
-    result = bytearray()
-    left = count
-
-    def transferBlock(i):
-        nonlocal count
-        if count == 0:
-            print("Warning: excessive block")
-            return
-        result.extend(dataRegion[blockSize * i: blockSize * (i + 1)])
-        count -= 1
-    fat.walk(index, transferBlock)
-    if count != 0:
-        print("Warning: not enough block")
-    return result
+    """ Returns an ExtentView of count blocks of a chain, marking them visited """
+    return getChainView(dataRegion, blockSize, fat, index, count * blockSize)
 
 
 def getDirList(fsHeader, partitionImage, dataRegion, fat):
@@ -278,12 +520,12 @@ def getDirList(fsHeader, partitionImage, dataRegion, fat):
                                 fsHeader.dirTableBlockIndex, fsHeader.dirTableBlockCount)
     else:
         data = partitionImage
-    dirList = [DirEntry(data[offset: offset + 0x28])]
-    dirCount = dirList[0].count
-    for i in range(1, dirCount):
-        dirList.append(DirEntry(data[
-            offset + i * 0x28: offset + (i + 1) * 0x28]))
-    scanDummyEntry(dirList)
+    dirList = getEntryTable(DirEntry, data, offset)
+    unknown = dirList.columns['unknown']
+    if unknown.count(0) != len(unknown):
+        for value in unknown:
+            if value != 0:
+                diagnostics.warning("unknown = %d", value)
     return dirList
 
 
@@ -294,60 +536,240 @@ def getFileList(fsHeader, partitionImage, dataRegion, fat):
                                 fsHeader.fileTableBlockIndex, fsHeader.fileTableBlockCount)
     else:
         data = partitionImage
-    fileList = [FileEntry(data[offset: offset + 0x30])]
-    fileCount = fileList[0].count
-    for i in range(1, fileCount):
-        fileList.append(FileEntry(data[
-            offset + i * 0x30: offset + (i + 1) * 0x30]))
-    scanDummyEntry(fileList)
-    return fileList
-
-
-def verifyHashTable(hashTable, entryList):
-    for i in range(len(hashTable)):
-        current = hashTable[i]
-        while current != 0:
-            if entryList[current].getHash() % len(hashTable) != i:
-                print("Warning: wrong bucket")
-            current = entryList[current].nextCollision
-
-
-def extractAll(dirList, fileList, outputDir, fileDumper):
-    def ExtractDir(i, parent):
-        if outputDir is not None:
-            dir = os.path.join(outputDir, parent, dirList[i].getName())
-            if not os.path.isdir(dir):
-                os.mkdir(dir)
-
-        # Extracts subdirectories
-        if dirList[i].firstDirIndex != 0:
-            ExtractDir(dirList[i].firstDirIndex,
-                       os.path.join(parent, dirList[i].getName()))
-
-        # Extract files
-        if dirList[i].firstFileIndex != 0:
-            ExtractFile(dirList[i].firstFileIndex,
-                        os.path.join(parent, dirList[i].getName()))
-
-        # Extract sibling directories
-        if dirList[i].nextIndex != 0:
-            ExtractDir(dirList[i].nextIndex, parent)
-
-    def ExtractFile(i, parent):
-        full_name = os.path.join(parent, fileList[i].getName())
-        if outputDir is not None:
-            file = open(os.path.join(outputDir, full_name), 'wb')
-        else:
-            file = None
-
-        fileDumper(fileList[i], file, i)
-
-        if file is not None:
-            file.close()
+    return getEntryTable(FileEntry, data, offset)
+
+
+def rotateLanesRight(value, count, lowMask, highMask):
+    """ Rotates each u32 lane packed in value right by count bits
+
+     lowMask has the low 32 - count bits of each lane set, and highMask the
+     other bits.
+    """
+    return ((value >> count) & lowMask) | ((value << (32 - count)) & highMask)
+
+
+def getEntryHashes(entryTable):
+    """ Computes getEntryHash of every entry at once
+
+     The parents and the four name words of all entries are packed into big
+     integers, one u32 lane per entry, so each rotation and XOR step runs
+     over the whole table instead of per byte. Rotating is linear over XOR,
+     so the hash is rotr4(parent ^ C) ^ rotr3(w0) ^ rotr2(w1) ^ rotr1(w2) ^ w3.
+     Returns an array of u32.
+    """
+    count = len(entryTable)
+    size = count * 4
+    names = array.array(U32_TYPE)
+    names.frombytes(b''.join(entryTable.columns['name']))
+    # The words are only moved around, so their byte order doesn't matter
+    words = [int.from_bytes(names[i::4].tobytes(), 'little') for i in range(4)]
+    parents = int.from_bytes(
+        struct.pack('<%dI' % count, *entryTable.columns['parentIndex']),
+        'little')
+    constant = int.from_bytes(struct.pack('<I', 0x091A2B3C) * count, 'little')
+    allLanes = (1 << (size * 8)) - 1
+
+    hashes = words[3]
+    for rotation, value in ((4, parents ^ constant), (3, words[0]),
+                            (2, words[1]), (1, words[2])):
+        lowMask = int.from_bytes(
+            struct.pack('<I', 0xFFFFFFFF >> rotation) * count, 'little')
+        hashes ^= rotateLanesRight(value, rotation, lowMask, allLanes ^ lowMask)
+
+    result = array.array(U32_TYPE)
+    result.frombytes(hashes.to_bytes(size, 'little'))
+    if sys.byteorder != 'little':
+        result.byteswap()
+    return result
 
-        # Extract sibling files
-        if fileList[i].nextIndex != 0:
-            ExtractFile(fileList[i].nextIndex, parent)
 
-    # Extracts ALL
-    ExtractDir(1, "")
+def verifyHashTable(hashTable, entryTable):
+    """ Checks that each entry is chained once, from the bucket of its hash
+
+     Warns about entries in the wrong bucket, collision chains that leave the
+     table or reach an entry twice, and entries that no bucket reaches.
+    """
+    with stats.stage("hashtable", len(hashTable) * 4):
+        bucketCount = len(hashTable)
+        buckets = [hash % bucketCount for hash in getEntryHashes(entryTable)] \
+            if bucketCount != 0 else []
+        nextCollisions = entryTable.columns['nextCollision']
+        chained = bytearray(len(entryTable))
+        for i, current in enumerate(hashTable):
+            while current != 0:
+                if current >= len(entryTable):
+                    diagnostics.warning("hash chain out of range @ %d", current)
+                    break
+                if chained[current]:
+                    diagnostics.warning("hash chain reaches entry twice @ %d", current)
+                    break
+                chained[current] = 1
+                if buckets[current] != i:
+                    diagnostics.warning("wrong bucket")
+                current = nextCollisions[current]
+
+        # Reported once, as an empty table would leave out every entry
+        orphans = []
+        i = chained.find(0, 1)
+        while i != -1:
+            if not entryTable.isDummy[i]:
+                orphans.append(i)
+            i = chained.find(0, i + 1)
+        if orphans:
+            if not any(hashTable):
+                diagnostics.warning("hash table is empty, %d entries not in it",
+                                    len(orphans))
+            else:
+                diagnostics.warning("%d entries not in hash table, first @ %d",
+                                    len(orphans), orphans[0])
+
+
+def lookupEntry(hashTable, entryTable, parentIndex, name):
+    """ Finds an entry by parent index and name through the hash table
+
+     Returns the entry index, or 0 if there is no such entry.
+    """
+    rawName = name.encode()
+    if len(rawName) > 16 or len(hashTable) == 0:
+        return 0
+    rawName = rawName.ljust(16, b'\0')
+    current = hashTable[getEntryHash(parentIndex, rawName) % len(hashTable)]
+    parents = entryTable.columns['parentIndex']
+    names = entryTable.columns['name']
+    nextCollisions = entryTable.columns['nextCollision']
+    # Bounds the chain in case of a collision loop
+    for _ in range(len(entryTable)):
+        if current == 0 or current >= len(entryTable):
+            return 0
+        if parents[current] == parentIndex and names[current] == rawName:
+            return current
+        current = nextCollisions[current]
+    return 0
+
+
+class TreeIndex(object):
+    """ A flat index of the directory tree, built in one iterative pass
+
+     dirPaths and filePaths map entry indices to full paths, separated by '/'
+     and relative to the root, whose path is ''. Entries that aren't in the
+     tree map to None. subdirs and files map a directory index to the indices
+     of its children, in chain order. order lists (isDir, index) of every
+     entry but the root in extraction order: a directory, the subtrees of its
+     subdirectories, then its files.
+    """
+
+    def __init__(self, dirList, fileList):
+        self.dirList = dirList
+        self.fileList = fileList
+        self.dirPaths = [None] * len(dirList)
+        self.filePaths = [None] * len(fileList)
+        self.subdirs = {}
+        self.files = {}
+        self.order = []
+        self.paths = None
+
+        firstDirs = dirList.columns['firstDirIndex']
+        firstFiles = dirList.columns['firstFileIndex']
+        self.dirPaths[1] = ""  # root
+        pending = [(True, 1)]
+        while pending:
+            isDir, i = pending.pop()
+            if not isDir:
+                # The files come after the subtrees of the subdirectories
+                self.order.extend((False, j) for j in self.files[i])
+                continue
+            if i != 1:
+                self.order.append((True, i))
+            prefix = self.dirPaths[i] + "/" if i != 1 else ""
+            subdirs = self.walkChain(dirList, firstDirs[i], self.dirPaths, prefix)
+            self.subdirs[i] = subdirs
+            self.files[i] = self.walkChain(fileList, firstFiles[i],
+                                           self.filePaths, prefix)
+            pending.append((False, i))
+            pending.extend((True, j) for j in reversed(subdirs))
+
+    def walkChain(self, entryTable, i, paths, prefix):
+        """ Follows a sibling chain, recording the path of each entry """
+        names = entryTable.columns['name']
+        nextIndices = entryTable.columns['nextIndex']
+        chain = []
+        while i != 0:
+            if i >= len(entryTable) or paths[i] is not None:
+                diagnostics.warning("entry %d out of range or already in the tree", i)
+                break
+            paths[i] = prefix + trimBytes(names[i]).decode()
+            chain.append(i)
+            i = nextIndices[i]
+        return chain
+
+    def lookup(self, path):
+        """ Returns (isDir, index) of a path relative to the root, or None """
+        if self.paths is None:
+            paths = {}
+            for i, filePath in enumerate(self.filePaths):
+                if filePath is not None:
+                    paths[filePath] = (False, i)
+            for i, dirPath in enumerate(self.dirPaths):
+                if dirPath is not None:
+                    paths[dirPath] = (True, i)
+            self.paths = paths
+        return self.paths.get(path)
+
+    def getFileInfo(self, index):
+        """ Returns (path, parent index, size, first block index) of a file """
+        fileEntry = self.fileList[index]
+        return (self.filePaths[index], fileEntry.parentIndex, fileEntry.size,
+                fileEntry.blockIndex)
+
+
+def extractAll(dirList, fileList, outputDir, fileDumper, openFiles=True,
+               writer=None, index=None, createDirs=True, fileSize=None):
+    """ Creates the directory tree in outputDir and calls fileDumper for each file
+
+     fileDumper is called with the file entry, the opened output file and the
+     file index. If openFiles is False, the output file path is passed instead
+     and the dumper is responsible for writing it. Without outputDir, None is
+     passed.
+
+     With an archivewriter writer, the tree is added to it instead of
+     outputDir, and paths are relative and separated by '/'. If the dumper
+     writes fileSize(fileEntry, index) bytes, the writer can stream them
+     instead of buffering the file. index is a TreeIndex of the lists, built if not given. Without createDirs, paths
+     under outputDir are passed but no directory is created, which only makes
+     sense with openFiles False.
+    """
+    if index is None:
+        index = TreeIndex(dirList, fileList)
+
+    createDirs = createDirs and writer is None and outputDir is not None
+    if createDirs and not os.path.isdir(outputDir):
+        os.mkdir(outputDir)
+
+    dirPaths, filePaths = index.dirPaths, index.filePaths
+    for isDir, i in index.order:
+        if isDir:
+            if writer is not None:
+                writer.addDir(dirPaths[i])
+            elif createDirs:
+                dir = os.path.join(outputDir, dirPaths[i].replace('/', os.sep))
+                if not os.path.isdir(dir):
+                    os.mkdir(dir)
+            continue
+
+        fileEntry = fileList[i]
+        if writer is not None:
+            if openFiles:
+                writer.addFile(filePaths[i],
+                               lambda file: fileDumper(fileEntry, file, i),
+                               None if fileSize is None else fileSize(fileEntry, i))
+            else:
+                fileDumper(fileEntry, filePaths[i], i)
+        elif outputDir is None:
+            fileDumper(fileEntry, None, i)
+        else:
+            filePath = os.path.join(outputDir, filePaths[i].replace('/', os.sep))
+            if not openFiles:
+                fileDumper(fileEntry, filePath, i)
+            else:
+                with open(filePath, 'wb') as file:
+                    fileDumper(fileEntry, file, i)
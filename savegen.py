@@ -0,0 +1,586 @@
+# Python 3
+
+""" Generating synthetic DISA and DIFF containers
+
+ The containers are valid for the parsers in this repo: DPFS pairs with
+ selector bitmaps, a 4-level IVFC tree, a SAVE or VSXE filesystem with hash
+ tables, a fragmented FAT and dummy entries. Contents are random. This is
+ meant for benchmarking and for checking changes without console dumps.
+"""
+
+import hashlib
+import io
+import os
+import os.path
+import struct
+
+import savearchive
+import savefilesystem
+
+
+def alignUp(value, alignment):
+    return (value + alignment - 1) // alignment * alignment
+
+
+def log2(value):
+    return value.bit_length() - 1
+
+
+class SaveTree(object):
+    """ A random directory tree
+
+     dirs is a list of (parent, name) and files a list of (parent, name,
+     size), where parent indexes dirs and dirs[0] is the root. For extdata,
+     the size is used as the unique ID of the subfile.
+    """
+
+    def __init__(self, rng, dirCount, fileCount, maxFileSize):
+        self.dirs = [(0, b'')]
+        for i in range(dirCount):
+            name = b'd%d_%s' % (i, rng.randbytes(3).hex().encode())
+            self.dirs.append((rng.randrange(len(self.dirs)), name[:16]))
+        self.files = []
+        for i in range(fileCount):
+            name = b'f%d_%s.bin' % (i, rng.randbytes(2).hex().encode())
+            size = rng.randrange(0, maxFileSize + 1) if rng.random() > 0.1 else 0
+            self.files.append((rng.randrange(len(self.dirs)), name[:16], size))
+
+    def getDirPath(self, i):
+        names = []
+        while i != 0:
+            i, name = self.dirs[i]
+            names.append(name.decode())
+        return '/'.join(reversed(names))
+
+    def getFilePath(self, i):
+        parent, name, _ = self.files[i]
+        return os.path.join(self.getDirPath(parent), name.decode())
+
+
+def buildIVFC(l4, blockSizes, rng=None, poisonRate=0):
+    """ Builds IVFC levels 1-4 over l4. Returns (levels, master hash)
+
+     With poisonRate, that fraction of level 4 blocks gets a wrong hash.
+    """
+    def hashLevel(data, blockSize, poisonRate=0):
+        hashes = bytearray()
+        for pos in range(0, len(data), blockSize):
+            block = data[pos: pos + blockSize]
+            hash = hashlib.sha256(block)
+            hash.update(bytes(blockSize - len(block)))
+            if poisonRate and rng.random() < poisonRate:
+                hashes += bytes(0x20)
+            else:
+                hashes += hash.digest()
+        return bytes(hashes)
+
+    l3 = hashLevel(l4, blockSizes[3], poisonRate)
+    l2 = hashLevel(l3, blockSizes[2])
+    l1 = hashLevel(l2, blockSizes[1])
+    master = hashLevel(l1, blockSizes[0])
+    return [l1, l2, l3, l4], master
+
+
+def getSelectorBits(pattern, count, rng):
+    """ Chooses which of the DPFS pair holds each block: "zero", "one", "runs" or "random" """
+    if pattern == "zero":
+        return [0] * count
+    if pattern == "one":
+        return [1] * count
+    if pattern == "runs":
+        bits = []
+        bit = rng.randrange(2)
+        while len(bits) < count:
+            bits += [bit] * rng.randrange(1, 20)
+            bit ^= 1
+        return bits[:count]
+    return [rng.randrange(2) for _ in range(count)]
+
+
+def packSelector(bits):
+    """ Packs selector bits into u32 words, most significant bit first """
+    words = []
+    for i in range(0, alignUp(len(bits), 32), 32):
+        word = 0
+        for j, bit in enumerate(bits[i: i + 32]):
+            word |= bit << (31 - j)
+        words.append(word)
+    return struct.pack('<%dI' % len(words), *words)
+
+
+def buildDPFSPair(active, blockSize, pattern, rng):
+    """ Hides active in a pair of random copies. Returns (copy0, copy1, selector) """
+    bits = getSelectorBits(pattern, (len(active) + blockSize - 1) // blockSize, rng)
+    pair = (bytearray(rng.randbytes(len(active))),
+            bytearray(rng.randbytes(len(active))))
+    for i, bit in enumerate(bits):
+        pos = i * blockSize
+        pair[bit][pos: pos + blockSize] = active[pos: pos + blockSize]
+    return bytes(pair[0]), bytes(pair[1]), packSelector(bits)
+
+
+def buildPartition(inner, externalIVFCL4, rng,
+                   ivfcBlockSizes=(0x200, 0x200, 0x200, 0x1000),
+                   dpfsBlockSizes=(0x80, 0x1000), pattern="random", poisonRate=0):
+    """ Wraps inner in IVFC and DPFS. Returns (partition descriptor, partition) """
+    levels, master = buildIVFC(inner, ivfcBlockSizes, rng, poisonRate)
+
+    # IVFC levels as stored in DPFS level 3
+    ivfc = bytearray()
+    levelOffs = []
+    for i, level in enumerate(levels):
+        pos = alignUp(len(ivfc), ivfcBlockSizes[3] if i == 3 else 8)
+        levelOffs.append(pos)
+        if i == 3 and externalIVFCL4:
+            break
+        ivfc += bytes(pos - len(ivfc)) + level
+    l3Size = alignUp(len(ivfc), dpfsBlockSizes[1])
+    ivfc += rng.randbytes(l3Size - len(ivfc))
+
+    l3Pair0, l3Pair1, l2 = buildDPFSPair(ivfc, dpfsBlockSizes[1], pattern, rng)
+    l2Pair0, l2Pair1, l1 = buildDPFSPair(l2, dpfsBlockSizes[0], pattern, rng)
+    l1Selector = rng.randrange(2)
+    l1Pair = [rng.randbytes(len(l1)), rng.randbytes(len(l1))]
+    l1Pair[l1Selector] = l1
+
+    partition = bytearray()
+    dpfsOffs = []
+    for i, (copy0, copy1) in enumerate((l1Pair, (l2Pair0, l2Pair1), (l3Pair0, l3Pair1))):
+        pos = alignUp(len(partition), 0x1000 if i == 2 else 8)
+        partition += bytes(pos - len(partition)) + copy0 + copy1
+        dpfsOffs.append(pos)
+    IVFCL4OffExt = 0
+    if externalIVFCL4:
+        IVFCL4OffExt = alignUp(len(partition), 0x1000)
+        partition += bytes(IVFCL4OffExt - len(partition)) + levels[3]
+
+    descriptor = struct.pack(
+        '<IIQQQQQQBB2xQ', 0x49464944, 0x00010000, 0x44, 0x78, 0xBC, 0x50,
+        0x10C, len(master), 1 if externalIVFCL4 else 0, l1Selector, IVFCL4OffExt)
+    descriptor += struct.pack('<IIQ', 0x43465649, 0x00020000, len(master))
+    for i in range(4):
+        descriptor += struct.pack('<QQI4x', levelOffs[i], len(levels[i]),
+                                  log2(ivfcBlockSizes[i]))
+    descriptor += struct.pack('<Q', 0x78)
+    descriptor += struct.pack('<IIQQI4xQQI4xQQI4x', 0x53465044, 0x00010000,
+                              dpfsOffs[0], len(l1), 2,
+                              dpfsOffs[1], len(l2), log2(dpfsBlockSizes[0]),
+                              dpfsOffs[2], l3Size, log2(dpfsBlockSizes[1]))
+    descriptor += master
+    return descriptor, bytes(partition)
+
+
+class EntryTables(object):
+    """ Directory and file entry tables with hash tables for a SaveTree
+
+     dirIndex and fileIndex map the tree to entry indices. Unused entries in
+     between are dummies, chained from entry 0.
+    """
+
+    def __init__(self, tree, rng, dirBuckets, fileBuckets, dummyDirs=2, dummyFiles=3):
+        dirCount = len(tree.dirs) + 1 + dummyDirs
+        fileCount = len(tree.files) + 1 + dummyFiles
+
+        # Root is entry 1. Other entries are placed randomly among the dummies
+        slots = list(range(2, dirCount))
+        rng.shuffle(slots)
+        self.dirIndex = [1] + slots[:len(tree.dirs) - 1]
+        self.dirDummies = sorted(slots[len(tree.dirs) - 1:])
+        slots = list(range(1, fileCount))
+        rng.shuffle(slots)
+        self.fileIndex = slots[:len(tree.files)]
+        self.fileDummies = sorted(slots[len(tree.files):])
+
+        # [parent, name, next, first dir / block, first file / size, unknown, collision]
+        self.dirs = [[0, bytes(16), 0, 0, 0, 0, 0] for _ in range(dirCount)]
+        self.files = [[0, bytes(16), 0, 0x80000000, 0, 0, 0] for _ in range(fileCount)]
+
+        for i, (parent, name) in enumerate(tree.dirs):
+            entry = self.dirs[self.dirIndex[i]]
+            entry[1] = name.ljust(16, b'\0')
+            if i != 0:
+                entry[0] = self.dirIndex[parent]
+                parentEntry = self.dirs[entry[0]]
+                entry[2] = parentEntry[3]
+                parentEntry[3] = self.dirIndex[i]
+
+        for i, (parent, name, size) in enumerate(tree.files):
+            entry = self.files[self.fileIndex[i]]
+            entry[0] = self.dirIndex[parent]
+            entry[1] = name.ljust(16, b'\0')
+            entry[4] = size
+            entry[5] = rng.randrange(1 << 32)
+            parentEntry = self.dirs[entry[0]]
+            entry[2] = parentEntry[4]
+            parentEntry[4] = self.fileIndex[i]
+
+        self.dirHashTable = self.buildHashTable(self.dirs, self.dirIndex, dirBuckets)
+        self.fileHashTable = self.buildHashTable(self.files, self.fileIndex, fileBuckets)
+        self.dirMaxCount = dirCount + 5
+        self.fileMaxCount = fileCount + 5
+
+    def buildHashTable(self, entries, used, bucketCount):
+        table = [0] * bucketCount
+        for i in used:
+            entry = entries[i]
+            bucket = savefilesystem.getEntryHash(entry[0], entry[1]) % bucketCount
+            entry[6] = table[bucket]
+            table[bucket] = i
+        return table
+
+    def pack(self, entries, dummies, maxCount, entryFormat, dummyFormat):
+        nextDummy = dict(zip([0] + dummies, dummies + [0]))
+        table = bytearray()
+        for i, entry in enumerate(entries):
+            if i in nextDummy:
+                table += struct.pack(dummyFormat, len(entries), maxCount, nextDummy[i])
+            else:
+                table += struct.pack(entryFormat, *entry)
+        return bytes(table)
+
+    def packDirTable(self):
+        return self.pack(self.dirs, self.dirDummies, self.dirMaxCount,
+                         '<I16sIIIII', '<II28xI')
+
+    def packFileTable(self):
+        return self.pack(self.files, self.fileDummies, self.fileMaxCount,
+                         '<I16sI4xIQII', '<II36xI')
+
+    def setFileBlock(self, i, blockIndex):
+        self.files[self.fileIndex[i]][3] = blockIndex
+
+
+class FatAllocator(object):
+    """ Allocates FAT chains over blockCount blocks
+
+     Blocks are handed out from runs of at most maxRun blocks in random
+     order, so a smaller maxRun gives a more fragmented FAT.
+    """
+
+    def __init__(self, blockCount, rng, maxRun):
+        self.runs = []
+        pos = 0
+        while pos < blockCount:
+            count = min(rng.randrange(1, maxRun + 1), blockCount - pos)
+            self.runs.append((pos, count))
+            pos += count
+        rng.shuffle(self.runs)
+        self.runs.reverse()  # allocates from the end
+        self.entries = [[0, 0] for _ in range(blockCount + 1)]
+
+    def alloc(self, count):
+        """ Allocates count blocks. Returns the chain as a list of (block, count) """
+        chain = []
+        while count > 0:
+            start, runCount = self.runs.pop()
+            taken = min(runCount, count)
+            chain.append((start, taken))
+            if taken < runCount:
+                self.runs.append((start + taken, runCount - taken))
+            count -= taken
+        self.link(chain)
+        return chain
+
+    def link(self, chain):
+        flag = 0x80000000
+        entries = self.entries
+        for i, (start, count) in enumerate(chain):
+            first = start + 1  # shift index
+            last = first + count - 1
+            previous = chain[i - 1][0] + 1 if i > 0 else 0
+            next = chain[i + 1][0] + 1 if i + 1 < len(chain) else 0
+            entries[first] = [previous | (flag if i == 0 else 0),
+                              next | (flag if last > first else 0)]
+            if last > first:
+                entries[first + 1] = [first | flag, last]
+                entries[last] = [first | flag, last]
+
+    def pack(self):
+        """ Chains the remaining blocks as free blocks and packs the FAT """
+        if self.runs:
+            chain = list(reversed(self.runs))
+            self.runs = []
+            self.link(chain)
+            self.entries[0] = [0, chain[0][0] + 1]
+        return b''.join(struct.pack('<II', u, v) for u, v in self.entries)
+
+
+def writeChain(region, blockSize, chain, data):
+    pos = 0
+    for start, count in chain:
+        block = data[pos: pos + count * blockSize]
+        region[start * blockSize: start * blockSize + len(block)] = block
+        pos += count * blockSize
+
+
+def buildSaveImage(tree, rng, hasData=False, blockSize=0x200, maxRun=4,
+                   freeBlocks=20, dirBuckets=7, fileBuckets=11):
+    """ Builds a SAVE image. Returns (save image, data image or None, contents)
+
+     contents maps each file path to its content. With hasData, the data
+     region is the separate data image and the entry tables are stored in the
+     save image; otherwise the tables are stored as files in the data region.
+    """
+    tables = EntryTables(tree, rng, dirBuckets, fileBuckets)
+    getBlockCount = lambda size: (size + blockSize - 1) // blockSize
+    dirTableSize = len(tables.dirs) * 0x28
+    fileTableSize = len(tables.files) * 0x30
+    blockCount = sum(getBlockCount(size) for _, _, size in tree.files) + freeBlocks
+    if not hasData:
+        blockCount += getBlockCount(dirTableSize) + getBlockCount(fileTableSize)
+    fat = FatAllocator(blockCount, rng, maxRun)
+    region = bytearray(rng.randbytes(blockCount * blockSize))
+
+    contents = {}
+    for i, (_, _, size) in enumerate(tree.files):
+        content = rng.randbytes(size)
+        contents[tree.getFilePath(i)] = content
+        if size != 0:
+            chain = fat.alloc(getBlockCount(size))
+            tables.setFileBlock(i, chain[0][0])
+            writeChain(region, blockSize, chain, content)
+
+    dirTable = tables.packDirTable()
+    fileTable = tables.packFileTable()
+    if not hasData:
+        dirChain = fat.alloc(getBlockCount(dirTableSize))
+        fileChain = fat.alloc(getBlockCount(fileTableSize))
+        writeChain(region, blockSize, dirChain, dirTable)
+        writeChain(region, blockSize, fileChain, fileTable)
+
+    image = bytearray(0x88)
+    dirHashTableOff = len(image)
+    image += struct.pack('<%dI' % len(tables.dirHashTable), *tables.dirHashTable)
+    fileHashTableOff = len(image)
+    image += struct.pack('<%dI' % len(tables.fileHashTable), *tables.fileHashTable)
+    fatOff = len(image)
+    image += fat.pack()
+    if hasData:
+        image += bytes(alignUp(len(image), 8) - len(image))
+        dirTableOff = len(image)
+        image += dirTable
+        fileTableOff = len(image)
+        image += fileTable
+        dataRegionOff = 0
+    else:
+        image += bytes(alignUp(len(image), blockSize) - len(image))
+        dataRegionOff = len(image)
+        image += region
+    image += bytes(alignUp(len(image), blockSize) - len(image))
+
+    image[0:0x20] = struct.pack('<IIQQII', 0x45564153, 0x00040000, 0x20,
+                                len(image) // blockSize, blockSize, 0)
+    header = struct.pack('<IIQI4xQI4xQI4xQI4x', 0, blockSize,
+                         dirHashTableOff, len(tables.dirHashTable),
+                         fileHashTableOff, len(tables.fileHashTable),
+                         fatOff, blockCount, dataRegionOff, blockCount)
+    if hasData:
+        header += struct.pack('<QI4xQI4x', dirTableOff, tables.dirMaxCount,
+                              fileTableOff, tables.fileMaxCount)
+    else:
+        header += struct.pack('<III4xIII4x',
+                              dirChain[0][0], getBlockCount(dirTableSize),
+                              tables.dirMaxCount,
+                              fileChain[0][0], getBlockCount(fileTableSize),
+                              tables.fileMaxCount)
+    image[0x20:0x88] = header
+    return bytes(image), bytes(region) if hasData else None, contents
+
+
+def buildVsxeImage(tree, rng, blockSize=0x200):
+    """ Builds a VSXE image. Returns (image, file entry index of each tree file) """
+    tables = EntryTables(tree, rng, 3, 5)
+    getBlockCount = lambda size: (size + blockSize - 1) // blockSize
+    dirTable = tables.packDirTable()
+    fileTable = tables.packFileTable()
+    blockCount = getBlockCount(len(dirTable)) + getBlockCount(len(fileTable))
+    fat = FatAllocator(blockCount, rng, 2)
+    region = bytearray(blockCount * blockSize)
+    dirChain = fat.alloc(getBlockCount(len(dirTable)))
+    fileChain = fat.alloc(getBlockCount(len(fileTable)))
+    writeChain(region, blockSize, dirChain, dirTable)
+    writeChain(region, blockSize, fileChain, fileTable)
+
+    image = bytearray(0x1A0)
+    dirHashTableOff = len(image)
+    image += struct.pack('<3I', *tables.dirHashTable)
+    fileHashTableOff = len(image)
+    image += struct.pack('<5I', *tables.fileHashTable)
+    fatOff = len(image)
+    image += fat.pack()
+    image += bytes(alignUp(len(image), blockSize) - len(image))
+    dataRegionOff = len(image)
+    image += region
+
+    image[0:0x138] = struct.pack('<IIQQIIQIIII256s', 0x45585356, 0x00030000, 0x138,
+                                 len(image) // blockSize, blockSize, 0,
+                                 0, 0, 0, 0, 0, b'')
+    image[0x138:0x1A0] = struct.pack(
+        '<IIQI4xQI4xQI4xQI4xIII4xIII4x', 0, blockSize,
+        dirHashTableOff, 3, fileHashTableOff, 5, fatOff, blockCount,
+        dataRegionOff, blockCount,
+        dirChain[0][0], getBlockCount(len(dirTable)), tables.dirMaxCount,
+        fileChain[0][0], getBlockCount(len(fileTable)), tables.fileMaxCount)
+    return bytes(image), tables.fileIndex
+
+
+def buildContainer(rng, header, partTable, partitions):
+    """ Lays out a DISA/DIFF file. header is packed by the caller's function
+
+     header is called with (secondary table offset, primary table offset,
+     active table, partition offsets). The inactive table is random.
+    """
+    secPartTableOff = 0x200
+    priPartTableOff = alignUp(secPartTableOff + len(partTable), 0x10)
+    activeTable = rng.randrange(2)
+    pos = alignUp(priPartTableOff + len(partTable), 0x1000)
+    partOffs = []
+    for partition in partitions:
+        partOffs.append(pos)
+        pos = alignUp(pos + len(partition), 0x1000)
+
+    container = bytearray(partOffs[-1] + len(partitions[-1]))
+    container[0:0x100] = rng.randbytes(0x100)  # CMAC, signed later
+    container[0x100:0x200] = header(secPartTableOff, priPartTableOff,
+                                    activeTable, partOffs)
+    tables = [rng.randbytes(len(partTable)), rng.randbytes(len(partTable))]
+    tables[activeTable] = partTable
+    container[priPartTableOff: priPartTableOff + len(partTable)] = tables[0]
+    container[secPartTableOff: secPartTableOff + len(partTable)] = tables[1]
+    for pos, partition in zip(partOffs, partitions):
+        container[pos: pos + len(partition)] = partition
+    return container
+
+
+def buildDisa(saveImage, dataImage, rng, **options):
+    """ Wraps a SAVE image and an optional DATA image in a DISA container
+
+     options are passed to buildPartition.
+    """
+    descriptorA, partA = buildPartition(saveImage, False, rng, **options)
+    partTable = descriptorA
+    partitions = [partA]
+    descriptorB = b''
+    if dataImage is not None:
+        descriptorB, partB = buildPartition(dataImage, True, rng, **options)
+        partTable += descriptorB
+        partitions.append(partB)
+
+    def header(secPartTableOff, priPartTableOff, activeTable, partOffs):
+        partBOff, partBSize = (partOffs[1], len(partitions[1])) \
+            if dataImage is not None else (0, 0)
+        return struct.pack('<III4xQQQQQQQQQQQB3x32s116x', 0x41534944, 0x00040000,
+                           len(partitions), secPartTableOff, priPartTableOff,
+                           len(partTable), 0, len(descriptorA),
+                           len(descriptorA), len(descriptorB),
+                           partOffs[0], len(partA), partBOff, partBSize,
+                           activeTable, hashlib.sha256(partTable).digest())
+
+    return buildContainer(rng, header, partTable, partitions)
+
+
+def buildDiff(inner, uniqueId, rng, externalIVFCL4=False, **options):
+    """ Wraps an image in a DIFF container. options are passed to buildPartition """
+    partTable, partition = buildPartition(inner, externalIVFCL4, rng, **options)
+
+    def header(secPartTableOff, priPartTableOff, activeTable, partOffs):
+        return struct.pack('<IIQQQQQI32sQ164x', 0x46464944, 0x00030000,
+                           secPartTableOff, priPartTableOff, len(partTable),
+                           partOffs[0], len(partition), activeTable,
+                           hashlib.sha256(partTable).digest(), uniqueId)
+
+    return buildContainer(rng, header, partTable, [partition])
+
+
+def signContainer(container, digestBlock, key):
+    import cmac
+    container[0:0x10] = cmac.AesCmac(hashlib.sha256(digestBlock).digest(), key)
+
+
+def encryptSd(container, path, key):
+    """ Encrypts a file the way it is stored on SD. AES-CTR is its own inverse """
+    import sd_decrypt
+    return sd_decrypt.SdFile(io.BytesIO(container), path, key).read()
+
+
+def generateSave(path, rng, saveType=None, saveId=None, keyEngine=None,
+                 encrypt=False, dirCount=6, fileCount=25, maxFileSize=3000,
+                 hasData=False, blockSize=0x200, maxRun=4, **options):
+    """ Writes a random DISA file. Returns {path in save: content}
+
+     With saveType ("sd" or "nand"), saveId and keyEngine it is signed, and
+     with encrypt it is also encrypted as a SD save. options are passed to
+     buildPartition.
+    """
+    tree = SaveTree(rng, dirCount, fileCount, maxFileSize)
+    saveImage, dataImage, contents = buildSaveImage(
+        tree, rng, hasData, blockSize, maxRun,
+        dirBuckets=max(7, dirCount // 2 | 1), fileBuckets=max(11, fileCount // 2 | 1))
+    container = buildDisa(saveImage, dataImage, rng, **options)
+    if saveType is not None:
+        signContainer(container, savearchive.getDigestBlock(
+            saveType, saveId, bytes(container[0x100:0x200])),
+            keyEngine.getKeySdNandCmac())
+    if encrypt:
+        container = encryptSd(container, savearchive.getSdPath(saveType, saveId),
+                              keyEngine.getKeySdDecrypt())
+    with open(path, 'wb') as file:
+        file.write(container)
+    return contents
+
+
+def generateExtdata(extdataDir, rng, saveId=None, keyEngine=None, encrypt=False,
+                    dirCount=3, fileCount=8, maxFileSize=5000, **options):
+    """ Writes a random extdata directory. Returns {path in extdata: content}
+
+     With saveId and keyEngine the subfiles are signed, and with encrypt they
+     are encrypted as SD extdata.
+    """
+    tree = SaveTree(rng, dirCount, fileCount, 0)
+    # Unique IDs are kept in the size field
+    tree.files = [(parent, name, rng.randrange(1, 1 << 32))
+                  for parent, name, _ in tree.files]
+    vsxe, fileIndex = buildVsxeImage(tree, rng)
+
+    def writeSubfile(saveSubId, inner, uniqueId):
+        container = buildDiff(inner, uniqueId, rng, rng.random() < 0.5, **options)
+        if saveId is not None:
+            signContainer(container, savearchive.getDiffDigestBlock(
+                "extdata", saveId, saveSubId, bytes(container[0x100:0x200])),
+                keyEngine.getKeySdNandCmac())
+        if encrypt:
+            container = encryptSd(container, savearchive.getSdPath(
+                "extdata", saveId, saveSubId), keyEngine.getKeySdDecrypt())
+        path = os.path.join(extdataDir, "%08x" % (saveSubId >> 32),
+                            "%08x" % (saveSubId & 0xFFFFFFFF))
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as file:
+            file.write(container)
+
+    writeSubfile(1, vsxe, 0)
+    contents = {}
+    for i, (_, _, uniqueId) in enumerate(tree.files):
+        content = rng.randbytes(rng.randrange(1, maxFileSize + 1))
+        contents[tree.getFilePath(i)] = content
+        subfileId = fileIndex[i] + 1
+        writeSubfile(((subfileId // savearchive.ExtdataArchive.dirCapacity) << 32) |
+                     subfileId % savearchive.ExtdataArchive.dirCapacity,
+                     content, uniqueId)
+    return contents
+
+
+def generateDiff(path, rng, size, saveType=None, saveId=None, keyEngine=None,
+                 encrypt=False, **options):
+    """ Writes a random single DIFF file, such as a title database. Returns its content """
+    content = rng.randbytes(size)
+    container = buildDiff(content, 0, rng, **options)
+    if saveType is not None:
+        signContainer(container, savearchive.getDiffDigestBlock(
+            saveType, saveId, None, bytes(container[0x100:0x200])),
+            keyEngine.getKeySdNandCmac())
+    if encrypt:
+        container = encryptSd(container, savearchive.getSdPath(saveType, saveId),
+                              keyEngine.getKeySdDecrypt())
+    with open(path, 'wb') as file:
+        file.write(container)
+    return content
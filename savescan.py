@@ -0,0 +1,231 @@
+# Python 3
+
+""" Checking every save in a SD or NAND dump tree
+
+ findContainers() works out the container type and the IDs of each save,
+ extdata and title database from the path layout:
+
+   SD:   Nintendo 3DS/<id0>/<id1>/title/<high>/<low>/data/00000001.sav
+         Nintendo 3DS/<id0>/<id1>/extdata/00000000/<ExtdataID>
+         Nintendo 3DS/<id0>/<id1>/dbs/title.db, import.db
+   NAND: data/<id0>/sysdata/<SaveID>/00000000
+         data/<id0>/extdata/<ExtdataID-High>/<ExtdataID-low>
+         dbs/*.db
+
+ scan() then checks, and optionally extracts, all of them on a process pool.
+ Encrypted files are detected by their magic, so trees that have already
+ been decrypted work as well.
+"""
+
+import collections
+import concurrent.futures
+import os
+import os.path
+import re
+import struct
+import time
+
+import blobstore
+import diagnostics
+import errors
+import savearchive
+import savefilesystem
+
+
+Container = collections.namedtuple(
+    'Container', ['path', 'relPath', 'kind', 'saveType', 'saveId'])
+
+hexIdPattern = re.compile('^[0-9a-fA-F]{8}$')
+
+
+def isHexId(name):
+    return hexIdPattern.match(name) is not None
+
+
+def findContainers(root):
+    """ Yields a Container for each save, extdata and title database under root
+
+     kind is "disa", "extdata" or "diff". saveType and saveId are what the
+     CMAC and the decryption need, or None if they can't be used.
+    """
+    for dirPath, dirNames, fileNames in os.walk(root):
+        dirNames.sort()
+        parts = os.path.abspath(dirPath).split(os.sep)
+        relPath = os.path.relpath(dirPath, root)
+
+        if len(parts) >= 3 and parts[-3] == "extdata" and \
+                isHexId(parts[-2]) and isHexId(parts[-1]) and \
+                os.path.isfile(os.path.join(dirPath, "00000000", "00000001")):
+            high = int(parts[-2], 16)
+            # NAND extdata CMAC is unsupported
+            saveId = int(parts[-1], 16) if high == 0 else None
+            yield Container(dirPath, relPath, "extdata", "extdata", saveId)
+            dirNames[:] = []
+            continue
+
+        for name in sorted(fileNames):
+            path = os.path.join(dirPath, name)
+            filePath = os.path.normpath(os.path.join(relPath, name))
+            p = parts + [name]
+            if len(p) >= 5 and p[-5] == "title" and isHexId(p[-4]) and \
+                    isHexId(p[-3]) and p[-2] == "data" and p[-1] == "00000001.sav":
+                saveId = (int(p[-4], 16) << 32) | int(p[-3], 16)
+                yield Container(path, filePath, "disa", "sd", saveId)
+            elif len(p) >= 3 and p[-3] == "sysdata" and isHexId(p[-2]) and \
+                    p[-1] == "00000000":
+                yield Container(path, filePath, "disa", "nand", int(p[-2], 16))
+            elif len(p) >= 2 and p[-2] == "dbs" and name.endswith(".db"):
+                # NAND has dbs/ next to data/. Its CMAC is unsupported
+                if os.path.isdir(os.path.join(dirPath, os.pardir, "data")):
+                    yield Container(path, filePath, "diff", None, None)
+                elif name == "title.db":
+                    yield Container(path, filePath, "diff", "titledb", 2)
+                elif name == "import.db":
+                    yield Container(path, filePath, "diff", "titledb", 3)
+
+
+def isEncrypted(path, magic):
+    """ Checks whether a container file doesn't start with a plain header """
+    with open(path, 'rb') as file:
+        file.seek(0x100, os.SEEK_SET)
+        return file.read(4) != magic
+
+
+def checkArchive(archive, outputDir, store=None):
+    """ Verifies the filesystem of an archive and extracts it if outputDir is given """
+    savefilesystem.verifyHashTable(archive.dirHashTable, archive.dirList)
+    savefilesystem.verifyHashTable(archive.fileHashTable, archive.fileList)
+    archive.fat.visitFreeBlock()
+    if outputDir is not None:
+        os.makedirs(outputDir, exist_ok=True)
+    archive.extractAll(outputDir, visit=True, store=store)
+    archive.fat.allVisited()
+
+    # Entry 0 is the dummy list head and directory 1 is the root
+    dirCount = archive.dirList.isDummy.count(0, 2)
+    fileCount = archive.fileList.isDummy.count(0, 1)
+    return dirCount, fileCount
+
+
+def triageContainer(container, keyEngine):
+    """ Checks only the CMAC and the partition table hash of a container
+
+     Returns whether all CMACs were verified rather than skipped.
+    """
+    if container.kind == "disa":
+        decrypt = isEncrypted(container.path, b"DISA")
+        return savearchive.check_disa(container.path, container.saveType,
+                                      container.saveId, decrypt, keyEngine)
+    elif container.kind == "extdata":
+        decrypt = isEncrypted(os.path.join(
+            container.path, "00000000", "00000001"), b"DIFF")
+        results = savearchive.check_extdata(container.path, container.saveId,
+                                            decrypt, keyEngine)
+        return all(verified for _, verified in results)
+    decrypt = isEncrypted(container.path, b"DIFF")
+    return savearchive.check_diff(container.path, container.saveType,
+                                  container.saveId, None, decrypt, keyEngine)
+
+
+def scanContainer(container, keyEngine, outputDir=None, triage=False,
+                  storeDir=None):
+    """ Checks one container. Returns its report entry as a dict
+
+     Extracted files go to outputDir/<path relative to the scanned root>, or
+     with storeDir, are hard links into a blobstore.BlobStore there.
+     With triage, only the headers are checked and nothing is extracted.
+    """
+    report = {
+        "path": container.relPath,
+        "kind": container.kind,
+        "saveType": container.saveType,
+        "saveId": None if container.saveId is None else "%x" % container.saveId,
+    }
+    warnings = []
+
+    def collectWarning(level, message):
+        warnings.append(message)
+
+    output = None
+    if outputDir is not None:
+        output = os.path.join(outputDir, container.relPath)
+    store = None
+    if storeDir is not None:
+        store = blobstore.BlobStore(storeDir)
+
+    previous = (diagnostics.handler, diagnostics.minLevel,
+                diagnostics.repeatLimit)
+    # Keeps the first few warnings of each kind and counts all of them
+    diagnostics.handler = collectWarning
+    diagnostics.minLevel = "Warning"
+    diagnostics.repeatLimit = 10
+    diagnostics.resetCounts()
+    start = time.perf_counter()
+    try:
+        if triage:
+            report["cmacVerified"] = triageContainer(container, keyEngine)
+        elif container.kind == "disa":
+            decrypt = isEncrypted(container.path, b"DISA")
+            report["encrypted"] = decrypt
+            archive = savearchive.open_disa(
+                container.path, container.saveType, container.saveId, decrypt,
+                keyEngine, lazy=False)
+            report["dirs"], report["files"] = checkArchive(archive, output, store)
+        elif container.kind == "extdata":
+            decrypt = isEncrypted(os.path.join(
+                container.path, "00000000", "00000001"), b"DIFF")
+            report["encrypted"] = decrypt
+            archive = savearchive.open_extdata(
+                container.path, container.saveId, decrypt, keyEngine)
+            report["dirs"], report["files"] = checkArchive(archive, output, store)
+        else:
+            decrypt = isEncrypted(container.path, b"DIFF")
+            report["encrypted"] = decrypt
+            image = savearchive.unwrapDiff(
+                container.path, saveType=container.saveType,
+                saveId=container.saveId, decrypt=decrypt,
+                keyEngine=keyEngine).image
+            report["size"] = len(image)
+            if output is not None:
+                os.makedirs(os.path.dirname(output), exist_ok=True)
+                if store is not None:
+                    store.save(output, lambda file: file.write(image))
+                else:
+                    with open(output, 'wb') as file:
+                        file.write(image)
+        report["status"] = "ok"
+    except errors.SaveError as e:
+        report["status"] = "error"
+        report["error"] = str(e)
+    except (OSError, ValueError, IndexError, struct.error) as e:
+        # Truncated or otherwise broken files
+        report["status"] = "error"
+        report["error"] = "%s: %s" % (type(e).__name__, e)
+    finally:
+        report["warningCounts"] = diagnostics.getCounts("Warning")
+        diagnostics.resetCounts()
+        diagnostics.handler, diagnostics.minLevel, \
+            diagnostics.repeatLimit = previous
+    report["warnings"] = warnings
+    report["seconds"] = round(time.perf_counter() - start, 3)
+    return report
+
+
+def scan(root, keyEngine, outputDir=None, processes=1, triage=False,
+         storeDir=None):
+    """ Checks every container under root. Returns the report entries in path order
+
+     keyEngine is passed to the worker processes, so it should hold derived
+     keys (key_engine.DerivedKeys) rather than the secrets.
+    """
+    containers = list(findContainers(root))
+    if processes <= 1:
+        reports = [scanContainer(container, keyEngine, outputDir, triage, storeDir)
+                   for container in containers]
+    else:
+        with concurrent.futures.ProcessPoolExecutor(processes) as pool:
+            reports = list(pool.map(
+                scanContainer, containers, [keyEngine] * len(containers),
+                [outputDir] * len(containers), [triage] * len(containers),
+                [storeDir] * len(containers), chunksize=64 if triage else 1))
+    return reports
@@ -0,0 +1,446 @@
+# Python 3
+
+""" Patching files inside a DISA save in place
+
+ Only the blocks a change touches are rewritten. New file content goes to
+ the blocks its FAT chain already has. The IVFC hashes on the path from
+ those blocks up to the master hash are recomputed. DPFS level 3 blocks
+ holding changed data are written to their inactive copy and their
+ selector bits flipped, the same way up through DPFS levels 2 and 1.
+ Finally the partition table is written to the inactive table, and the
+ header is updated and signed again.
+
+ Nothing active is overwritten before the CMAC and the header, which are
+ written together at the end, so an interrupted patch leaves the previous
+ version of the save. The remaining window is that single write of 0x200
+ bytes: if the storage tears it, the CMAC and the header can disagree.
+ External IVFC level 4 (partition B) isn't covered by DPFS and is updated in
+ place.
+"""
+
+import hashlib
+import io
+import os
+import struct
+
+import diagnostics
+import difi
+import errors
+import savearchive
+import stats
+
+
+def hashBlock(block, blockSize):
+    """ Hashes an IVFC block, padded with zeros to the block size """
+    hash = hashlib.sha256(block)
+    hash.update(b'\x00' * (blockSize - len(block)))
+    return hash.digest()
+
+
+class ContainerFile(object):
+    """ Reads and writes the plain content of a container file
+
+     With sdFile (a sd_decrypt.SdFile on file), reads are decrypted and
+     writes encrypted.
+    """
+
+    def __init__(self, file, sdFile=None):
+        self.file = file
+        self.sdFile = sdFile
+        self.bytesWritten = 0
+
+    def read(self, offset, size):
+        source = self.sdFile if self.sdFile is not None else self.file
+        source.seek(offset, io.SEEK_SET)
+        return source.read(size)
+
+    def write(self, offset, data):
+        if self.sdFile is not None:
+            data = self.sdFile.encryptAt(offset, bytes(data))
+        self.file.seek(offset, io.SEEK_SET)
+        self.file.write(data)
+        self.bytesWritten += len(data)
+
+
+class PartitionWriter(object):
+    """ Applies writes to the inner image of a partition
+
+     Only the DPFS selectors are read upfront. Blocks of DPFS level 3 are
+     read when a write or a hash check needs them.
+    """
+
+    def __init__(self, container, partOff, discriptorRaw):
+        self.container = container
+        self.partOff = partOff
+        self.discriptorRaw = bytearray(discriptorRaw)
+        d = self.discriptor = difi.PartDiscriptor(discriptorRaw)
+
+        self.l1 = bytearray(self.readPair(d.DPFSL1Off, d.DPFSL1Size, d.DPFSL1Selector))
+        l2Pair = (self.readPair(d.DPFSL2Off, d.DPFSL2Size, 0),
+                  self.readPair(d.DPFSL2Off, d.DPFSL2Size, 1))
+        self.l2 = difi.applyDPFSLevel(self.l1, l2Pair, d.DPFSL2BlockSize)
+
+        # Changed DPFS level 3 blocks, and changed blocks of external level 4
+        self.dirtyBlocks = {}
+        self.externalBlocks = {}
+        # Level 4 blocks read and verified through readInner
+        self.innerBlocks = {}
+
+    def readPair(self, off, size, bit, pos=0, length=None):
+        """ Reads from one copy of a DPFS level pair """
+        if length is None:
+            length = size
+        return self.container.read(self.partOff + off + bit * size + pos, length)
+
+    def getBlockRange(self, i):
+        d = self.discriptor
+        start = i * d.DPFSL3BlockSize
+        return start, min(start + d.DPFSL3BlockSize, d.DPFSL3Size)
+
+    def getBlock(self, i):
+        """ Gets a DPFS level 3 block as it is with the writes so far """
+        if i in self.dirtyBlocks:
+            return self.dirtyBlocks[i]
+        d = self.discriptor
+        start, end = self.getBlockRange(i)
+        return self.readPair(d.DPFSL3Off, d.DPFSL3Size,
+                             difi.getSelectorBit(self.l2, i), start, end - start)
+
+    def readActive(self, off, size):
+        """ Reads the active data of DPFS level 3 """
+        blockSize = self.discriptor.DPFSL3BlockSize
+        output = bytearray()
+        while size > 0:
+            i = off // blockSize
+            start, end = self.getBlockRange(i)
+            chunk = self.getBlock(i)[off - start: min(end, off + size) - start]
+            output += chunk
+            off += len(chunk)
+            size -= len(chunk)
+        return output
+
+    def writeActive(self, off, data):
+        blockSize = self.discriptor.DPFSL3BlockSize
+        pos = 0
+        while pos < len(data):
+            i = (off + pos) // blockSize
+            block = self.dirtyBlocks.get(i)
+            if block is None:
+                block = self.dirtyBlocks[i] = bytearray(self.getBlock(i))
+            start, end = self.getBlockRange(i)
+            size = min(len(data) - pos, end - off - pos)
+            block[off + pos - start: off + pos - start + size] = data[pos: pos + size]
+            pos += size
+
+    def getLevels(self):
+        """ Returns (offset, size, block size) of IVFC levels 1-4 """
+        d = self.discriptor
+        return [(d.IVFCL1Off, d.IVFCL1Size, d.IVFCL1BlockSize),
+                (d.IVFCL2Off, d.IVFCL2Size, d.IVFCL2BlockSize),
+                (d.IVFCL3Off, d.IVFCL3Size, d.IVFCL3BlockSize),
+                (d.IVFCL4Off, d.IVFCL4Size, d.IVFCL4BlockSize)]
+
+    def readLevelBlock(self, level, i):
+        off, size, blockSize = self.getLevels()[level]
+        start = i * blockSize
+        end = min(start + blockSize, size)
+        if level == 3 and self.discriptor.externalIVFCL4:
+            if i in self.externalBlocks:
+                return self.externalBlocks[i]
+            return self.container.read(
+                self.partOff + self.discriptor.IVFCL4OffExt + start, end - start)
+        return self.readActive(off + start, end - start)
+
+    def writeLevelBlock(self, level, i, block):
+        off, size, blockSize = self.getLevels()[level]
+        if level == 3 and self.discriptor.externalIVFCL4:
+            self.externalBlocks[i] = block
+            return
+        self.writeActive(off + i * blockSize, block)
+
+    def getStoredHash(self, level, i):
+        """ Gets the hash of block i of a level, as stored in the level above """
+        if level == 0:
+            return self.discriptor.hash[i * 0x20: (i + 1) * 0x20]
+        off, _, _ = self.getLevels()[level - 1]
+        return bytes(self.readActive(off + i * 0x20, 0x20))
+
+    def loadLevelBlock(self, level, i):
+        """ Reads a block of a level and checks it against its stored hash """
+        block = bytearray(self.readLevelBlock(level, i))
+        blockSize = self.getLevels()[level][2]
+        if hashBlock(block, blockSize) != self.getStoredHash(level, i):
+            raise errors.FormatError(
+                "IVFC level %d block %d is corrupted" % (level + 1, i))
+        return block
+
+    def readInner(self, off, size):
+        """ Reads the inner image, verifying each block against its hash """
+        blockSize = self.getLevels()[3][2]
+        output = bytearray()
+        while size > 0:
+            i = off // blockSize
+            block = self.innerBlocks.get(i)
+            if block is None:
+                block = self.innerBlocks[i] = bytes(self.loadLevelBlock(3, i))
+            chunk = block[off - i * blockSize: off - i * blockSize + size]
+            output += chunk
+            off += len(chunk)
+            size -= len(chunk)
+        return output
+
+    def apply(self, writes):
+        """ Applies (offset, data) writes to the inner image and updates the hashes """
+        _, l4Size, l4BlockSize = self.getLevels()[3]
+        changed = {}
+        for off, data in writes:
+            if off + len(data) > l4Size:
+                raise errors.ParameterError("write beyond the partition")
+            pos = 0
+            while pos < len(data):
+                i = (off + pos) // l4BlockSize
+                if i not in changed:
+                    changed[i] = self.loadLevelBlock(3, i)
+                start = off + pos - i * l4BlockSize
+                size = min(len(data) - pos, len(changed[i]) - start)
+                changed[i][start: start + size] = data[pos: pos + size]
+                pos += size
+
+        # Hashes each changed block into the level above, up to the master hash
+        master = bytearray(self.discriptor.hash)
+        for level in (3, 2, 1, 0):
+            blockSize = self.getLevels()[level][2]
+            parents = {}
+            for i, block in sorted(changed.items()):
+                self.writeLevelBlock(level, i, block)
+                hash = hashBlock(block, blockSize)
+                if level == 0:
+                    master[i * 0x20: (i + 1) * 0x20] = hash
+                    continue
+                parentBlockSize = self.getLevels()[level - 1][2]
+                p = i * 0x20 // parentBlockSize
+                if p not in parents:
+                    parents[p] = self.loadLevelBlock(level - 1, p)
+                pos = i * 0x20 - p * parentBlockSize
+                parents[p][pos: pos + 0x20] = hash
+            changed = parents
+        self.discriptor.hash = bytes(master)
+
+    def commit(self):
+        """ Writes the changed blocks to the inactive DPFS copies and flips them
+
+         Returns the updated partition discriptor.
+        """
+        d = self.discriptor
+        for i, block in sorted(self.externalBlocks.items()):
+            self.container.write(self.partOff + d.IVFCL4OffExt + i * d.IVFCL4BlockSize,
+                                 block)
+
+        # Level 3 blocks, selected by level 2
+        dirtyL2 = set()
+        for i, block in sorted(self.dirtyBlocks.items()):
+            bit = difi.getSelectorBit(self.l2, i) ^ 1
+            start, _ = self.getBlockRange(i)
+            self.container.write(
+                self.partOff + d.DPFSL3Off + bit * d.DPFSL3Size + start, block)
+            difi.flipSelectorBit(self.l2, i)
+            dirtyL2.add(difi.getSelectorBitPos(i)[0] // d.DPFSL2BlockSize)
+
+        # Level 2 blocks, selected by level 1
+        for i in sorted(dirtyL2):
+            bit = difi.getSelectorBit(self.l1, i) ^ 1
+            start = i * d.DPFSL2BlockSize
+            end = min(start + d.DPFSL2BlockSize, d.DPFSL2Size)
+            self.container.write(
+                self.partOff + d.DPFSL2Off + bit * d.DPFSL2Size + start,
+                self.l2[start: end])
+            difi.flipSelectorBit(self.l1, i)
+
+        # Level 1, selected by the discriptor
+        if dirtyL2:
+            selector = d.DPFSL1Selector ^ 1
+            self.container.write(
+                self.partOff + d.DPFSL1Off + selector * d.DPFSL1Size, self.l1)
+            self.discriptorRaw[0x39] = selector
+        self.discriptorRaw[d.hashOff: d.hashOff + len(d.hash)] = d.hash
+        return bytes(self.discriptorRaw)
+
+
+class ActiveImage(object):
+    """ The active data of DPFS level 3 of a partition, read on demand """
+
+    def __init__(self, writer):
+        self.writer = writer
+        self.size = writer.discriptor.DPFSL3Size
+
+    def __len__(self):
+        return self.size
+
+    def __getitem__(self, key):
+        start, stop, _ = key.indices(self.size)
+        return bytes(self.writer.readActive(start, max(0, stop - start)))
+
+
+class InnerImage(object):
+    """ The inner image of a partition, read through a PartitionWriter on demand """
+
+    def __init__(self, writer):
+        self.writer = writer
+        self.size = writer.getLevels()[3][1]
+
+    def __len__(self):
+        return self.size
+
+    def __getitem__(self, key):
+        start, stop, _ = key.indices(self.size)
+        return self.writer.readInner(start, max(0, stop - start))
+
+
+def getFileWrites(archive, index, content):
+    """ Maps new content of a file to (partition, offset, data) writes
+
+     The content must use exactly the blocks the file already has, as the FAT
+     isn't changed. If the size changes, the file entry is updated too.
+    """
+    fsHeader = archive.fsHeader
+    blockSize = fsHeader.blockSize
+    fileEntry = archive.fileList[index]
+    extents = []
+    if fileEntry.size != 0 or fileEntry.blockIndex != 0x80000000:
+        extents = archive.fat.getExtents(fileEntry.blockIndex, visit=False)
+    blockCount = sum(count for _, count in extents)
+    if (len(content) + blockSize - 1) // blockSize != blockCount:
+        raise errors.ParameterError(
+            "%d bytes don't fit in the %d blocks of 0x%X bytes allocated to the file"
+            % (len(content), blockCount, blockSize))
+
+    # Files are in the DATA image if there is one, otherwise in the data region
+    if fsHeader.tableInDataRegion:
+        dataPartition, regionOff = 0, fsHeader.dataRegionOff
+    else:
+        dataPartition, regionOff = 1, 0
+
+    writes = []
+    pos = 0
+    for blockIndex, count in extents:
+        if pos >= len(content):
+            break
+        size = min(len(content) - pos, count * blockSize)
+        writes.append((dataPartition, regionOff + blockIndex * blockSize,
+                       content[pos: pos + size]))
+        pos += size
+
+    if len(content) != fileEntry.size:
+        sizeOff = index * 0x30 + 0x20
+        if fsHeader.tableInDataRegion:
+            # The file table is itself a chain in the data region
+            for blockIndex, count in archive.fat.getExtents(
+                    fsHeader.fileTableBlockIndex, visit=False):
+                if sizeOff < count * blockSize:
+                    break
+                sizeOff -= count * blockSize
+            else:
+                raise errors.FormatError("file entry %d is past the file table" % index)
+            entryOff = fsHeader.dataRegionOff + blockIndex * blockSize + sizeOff
+        else:
+            entryOff = fsHeader.fileTableOff + sizeOff
+        writes.append((0, entryOff, struct.pack('<Q', len(content))))
+    return writes
+
+
+def getPartitionWriters(container, disaHeader):
+    """ Opens a PartitionWriter on each partition of a DISA container
+
+     Returns the writers and (discriptor offset, discriptor size, partition
+     offset) of each partition.
+    """
+    partitions = (
+        (disaHeader.partADiscriptorOff, disaHeader.partADiscriptorSize,
+         disaHeader.partAOff),
+        (disaHeader.partBDiscriptorOff, disaHeader.partBDiscriptorSize,
+         disaHeader.partBOff))[0: 2 if disaHeader.hasData else 1]
+    writers = [PartitionWriter(container, partOff, disaHeader.partTable[
+        discriptorOff: discriptorOff + discriptorSize])
+        for discriptorOff, discriptorSize, partOff in partitions]
+    return writers, partitions
+
+
+def patch_disa(file, contents, saveType=None, saveId=None, encrypt=False,
+               keyEngine=None):
+    """ Replaces the content of files in a DISA save in place
+
+     file is a path or a binary file object opened for reading and writing.
+     contents maps paths in the save to their new content, which must need as
+     many blocks as each file has. With saveType and saveId, the CMAC is checked
+     before and signed again after, using the keys from keyEngine. With
+     encrypt, file is an encrypted SD save. Returns the number of bytes
+     written.
+    """
+    if isinstance(file, (str, bytes, os.PathLike)):
+        with open(file, 'r+b') as f:
+            return patch_disa(f, contents, saveType, saveId, encrypt, keyEngine)
+
+    sdFile = None
+    if encrypt:
+        if saveType != "sd":
+            raise errors.ParameterError("only SD save supports decryption.")
+        sdFile = savearchive.cryptoUnwrap(
+            file, savearchive.getSdPath(saveType, saveId), keyEngine)
+    container = ContainerFile(file, sdFile)
+    reader = sdFile if sdFile is not None else file
+
+    key = None
+    if saveType is not None:
+        key = keyEngine.getKeySdNandCmac() if keyEngine is not None else None
+        if saveId is None or key is None:
+            raise errors.ParameterError(
+                "save ID and secrets are needed to sign the save again.")
+    else:
+        diagnostics.info("No save type specified. Will not update the CMAC.")
+
+    disaHeader = savearchive.readDisaHeader(reader, saveType, saveId, keyEngine)
+
+    with stats.stage("patch"):
+        # Only the blocks that lookups and the FAT need are read
+        writers, partitions = getPartitionWriters(container, disaHeader)
+        saveImage = InnerImage(writers[0])
+        archive = savearchive.SaveArchive(
+            saveImage, savearchive.readSaveHeader(saveImage),
+            InnerImage(writers[1]) if disaHeader.hasData else None)
+
+        writes = ([], [])
+        for path, content in contents.items():
+            isDir, index = archive.lookup(path)
+            if isDir:
+                raise IsADirectoryError(path)
+            for partition, off, data in getFileWrites(archive, index, content):
+                writes[partition].append((off, data))
+
+        partTable = bytearray(disaHeader.partTable)
+        for writer, partitionWrites, (discriptorOff, discriptorSize, _) in zip(
+                writers, writes, partitions):
+            if not partitionWrites:
+                continue
+            writer.apply(partitionWrites)
+            partTable[discriptorOff: discriptorOff + discriptorSize] = writer.commit()
+
+        # The new partition table goes to the inactive slot
+        header = bytearray(disaHeader.header)
+        secPartTableOff, priPartTableOff = struct.unpack('<QQ', header[0x10:0x20])
+        activeTable = header[0x68] ^ 1
+        container.write(priPartTableOff if activeTable == 0 else secPartTableOff,
+                        partTable)
+        header[0x68] = activeTable
+        header[0x6C:0x8C] = hashlib.sha256(partTable).digest()
+
+        # The CMAC and the header are written last, in one write of the first
+        # 0x200 bytes, which switches to the new version
+        start = bytearray(container.read(0, 0x100))
+        if key is not None:
+            start[0:0x10] = savearchive.getCmac(
+                savearchive.getDigestBlock(saveType, saveId, bytes(header)), key)
+        container.write(0, start + header)
+        file.flush()
+    stats.add("patch", bytes=container.bytesWritten)
+    diagnostics.info("Wrote %d bytes", container.bytesWritten)
+    return container.bytesWritten
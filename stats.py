@@ -0,0 +1,138 @@
+""" Per-stage timing and counters of reading a save
+
+ Nothing is recorded unless enable() is called. Each stage accumulates:
+   seconds         wall time, summed over calls
+   bytes           bytes processed
+   calls           number of times the stage ran
+   hashedBlocks    SHA-256 blocks verified (IVFC only)
+   poisonedBlocks  blocks whose hash didn't match (IVFC only)
+   peakMemory      peak memory of the process at the end of the stage, in bytes
+
+ Stages can nest, e.g. extracting extdata unwraps its subfiles, so their
+ times overlap. IVFC blocks that are verified lazily are counted as they are
+ read. hook, if set, is called with the stage name and a dict of seconds,
+ bytes and peakMemory each time a stage ends.
+"""
+
+import json
+import sys
+import threading
+import time
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+
+enabled = False
+hook = None
+
+records = {}
+lock = threading.Lock()
+
+fields = ('seconds', 'bytes', 'calls', 'hashedBlocks', 'poisonedBlocks')
+
+
+def getPeakMemory():
+    """ Gets the peak resident memory of the process in bytes, or None if unknown """
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports in KiB, macOS in bytes
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def enable(callback=None):
+    global enabled, hook
+    enabled = True
+    hook = callback
+
+
+def disable():
+    global enabled, hook
+    enabled = False
+    hook = None
+
+
+def reset():
+    with lock:
+        records.clear()
+
+
+def add(name, **counts):
+    """ Adds to the counters of a stage """
+    if not enabled:
+        return
+    with lock:
+        record = records.get(name)
+        if record is None:
+            record = records[name] = dict.fromkeys(fields, 0)
+        for key, value in counts.items():
+            record[key] += value
+
+
+class Stage(object):
+    """ Times a stage as a context manager """
+
+    def __init__(self, name, bytes=0):
+        self.name = name
+        self.bytes = bytes
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *args):
+        seconds = time.perf_counter() - self.start
+        add(self.name, seconds=seconds, bytes=self.bytes, calls=1)
+        peakMemory = getPeakMemory()
+        if peakMemory is not None:
+            with lock:
+                record = records[self.name]
+                record['peakMemory'] = max(record.get('peakMemory', 0), peakMemory)
+        if hook is not None:
+            hook(self.name, {'seconds': seconds, 'bytes': self.bytes,
+                             'peakMemory': peakMemory})
+
+
+class NullStage(object):
+    """ Used while disabled, so that stages cost next to nothing """
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+
+nullStage = NullStage()
+
+
+def stage(name, bytes=0):
+    """ Returns a context manager that times the stage name """
+    if not enabled:
+        return nullStage
+    return Stage(name, bytes)
+
+
+def getSummary():
+    """ Returns the records of all stages, with throughput in MB/s """
+    with lock:
+        summary = {name: dict(record) for name, record in records.items()}
+    for record in summary.values():
+        if record['seconds'] > 0 and record['bytes'] > 0:
+            record['mbPerSecond'] = round(
+                record['bytes'] / record['seconds'] / 1024 / 1024, 1)
+        record['seconds'] = round(record['seconds'], 6)
+    return summary
+
+
+def writeSummary(path):
+    """ Writes getSummary() as JSON to path, or to stdout if path is "-" """
+    summary = json.dumps(getSummary(), indent=1, sort_keys=True)
+    if path == "-":
+        print(summary)
+        return
+    with open(path, 'w') as file:
+        file.write(summary + "\n")